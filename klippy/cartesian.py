@@ -13,6 +13,8 @@ class CartKinematics:
         self.steppers = [stepper.PrinterStepper(
             printer, config.getsection('stepper_' + n), n)
                          for n in ['x', 'y', 'z']]
+        self.stepper_group = printer.mcu.create_stepper_group(
+            [s.mcu_stepper for s in self.steppers])
         self.max_z_velocity = config.getfloat(
             'max_z_velocity', 9999999.9, above=0.)
         self.max_z_accel = config.getfloat(
@@ -100,33 +102,5 @@ class CartKinematics:
     def move(self, move_time, move):
         if self.need_motor_enable:
             self._check_motor_enable(move_time, move)
-        for i in StepList:
-            axis_d = move.axes_d[i]
-            if not axis_d:
-                continue
-            mcu_stepper = self.steppers[i].mcu_stepper
-            mcu_time = mcu_stepper.print_to_mcu_time(move_time)
-            start_pos = move.start_pos[i]
-            axis_r = abs(axis_d) / move.move_d
-            accel = move.accel * axis_r
-            cruise_v = move.cruise_v * axis_r
-
-            # Acceleration steps
-            if move.accel_r:
-                accel_d = move.accel_r * axis_d
-                mcu_stepper.step_const(
-                    mcu_time, start_pos, accel_d, move.start_v * axis_r, accel)
-                start_pos += accel_d
-                mcu_time += move.accel_t
-            # Cruising steps
-            if move.cruise_r:
-                cruise_d = move.cruise_r * axis_d
-                mcu_stepper.step_const(
-                    mcu_time, start_pos, cruise_d, cruise_v, 0.)
-                start_pos += cruise_d
-                mcu_time += move.cruise_t
-            # Deceleration steps
-            if move.decel_r:
-                decel_d = move.decel_r * axis_d
-                mcu_stepper.step_const(
-                    mcu_time, start_pos, decel_d, cruise_v, -accel)
+        self.stepper_group.step_move(
+            move_time, move, move.start_pos, move.axes_d)
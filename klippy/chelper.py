@@ -12,14 +12,21 @@ import cffi
 ######################################################################
 
 COMPILE_CMD = "gcc -Wall -g -O2 -shared -fPIC -o %s %s"
-SOURCE_FILES = ['stepcompress.c', 'serialqueue.c', 'pyhelper.c']
+SOURCE_FILES = ['stepcompress.c', 'serialqueue.c', 'lookahead.c', 'pyhelper.c']
 DEST_LIB = "c_helper.so"
 OTHER_FILES = ['list.h', 'serialqueue.h', 'pyhelper.h']
 
 defs_stepcompress = """
-    struct stepcompress *stepcompress_alloc(uint32_t max_error
+    struct stepcompress *stepcompress_alloc(uint32_t oid);
+    void stepcompress_fill(struct stepcompress *sc, uint32_t max_error
         , uint32_t queue_step_msgid, uint32_t set_next_step_dir_msgid
-        , uint32_t invert_sdir, uint32_t oid);
+        , uint32_t invert_sdir);
+    void stepcompress_set_scale(struct stepcompress *sc, double mcu_freq
+        , double step_dist);
+    void stepcompress_set_time_scale(struct stepcompress *sc
+        , double time_scale);
+    int64_t stepcompress_get_position(struct stepcompress *sc);
+    void stepcompress_set_position(struct stepcompress *sc, int64_t pos);
     void stepcompress_free(struct stepcompress *sc);
     int stepcompress_reset(struct stepcompress *sc, uint64_t last_step_clock);
     int stepcompress_set_homing(struct stepcompress *sc, uint64_t homing_clock);
@@ -27,11 +34,27 @@ defs_stepcompress = """
 
     int stepcompress_push(struct stepcompress *sc, double step_clock
         , int32_t sdir);
-    int32_t stepcompress_push_const(struct stepcompress *sc, double clock_offset
-        , double step_offset, double steps, double start_sv, double accel);
-    int32_t stepcompress_push_delta(struct stepcompress *sc
-        , double clock_offset, double move_sd, double start_sv, double accel
-        , double height, double startxy_sd, double arm_d, double movez_r);
+    int32_t stepcompress_step_const(struct stepcompress *sc, double mcu_time
+        , double start_pos, double dist, double start_v, double accel);
+    int32_t stepcompress_step_delta(struct stepcompress *sc, double mcu_time
+        , double dist, double start_v, double accel
+        , double height_base, double startxy_d, double arm_d, double movez_r);
+    int32_t stepcompress_push_trapezoid(struct stepcompress *sc
+        , double mcu_time, double start_pos
+        , double accel_d, double cruise_d, double decel_d, double retract_d
+        , double start_v, double cruise_v, double decel_v, double retract_v
+        , double accel, double accel_t, double cruise_t, double decel_t);
+    int32_t stepcompress_push_move(struct stepcompress **sc_list, int sc_num
+        , double mcu_time, double *start_pos, double *axes_d, double move_d
+        , double accel_r, double cruise_r, double decel_r
+        , double accel_t, double cruise_t
+        , double start_v, double cruise_v, double accel);
+    int32_t stepcompress_push_delta_move(struct stepcompress **sc_list
+        , int sc_num, double mcu_time, double *towers, double arm_length2
+        , double *start_pos, double *axes_d, double move_d
+        , double accel_r, double cruise_r, double decel_r
+        , double accel_t, double cruise_t
+        , double start_v, double cruise_v, double accel);
 
     struct steppersync *steppersync_alloc(struct serialqueue *sq
         , struct stepcompress **sc_list, int sc_num, int move_num);
@@ -54,10 +77,15 @@ defs_serialqueue = """
     void serialqueue_free_commandqueue(struct command_queue *cq);
     void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
         , uint8_t *msg, int len, uint64_t min_clock, uint64_t req_clock);
+    void serialqueue_send_multi(struct serialqueue *sq
+        , struct command_queue *cq, uint8_t *data, int *lens, int count
+        , uint64_t min_clock, uint64_t req_clock);
     void serialqueue_encode_and_send(struct serialqueue *sq
         , struct command_queue *cq, uint32_t *data, int len
         , uint64_t min_clock, uint64_t req_clock);
     void serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm);
+    int serialqueue_pull_batch(struct serialqueue *sq
+        , struct pull_queue_message *q, int max);
     void serialqueue_set_baud_adjust(struct serialqueue *sq, double baud_adjust);
     void serialqueue_set_clock_est(struct serialqueue *sq, double est_clock
         , double last_ack_time, uint64_t last_ack_clock);
@@ -66,6 +94,24 @@ defs_serialqueue = """
         , struct pull_queue_message *q, int max);
 """
 
+defs_lookahead = """
+    struct move_junction {
+        double accel_r, cruise_r, decel_r;
+        double start_v, cruise_v, end_v;
+        double accel_t, cruise_t, decel_t;
+    };
+
+    struct lookahead *lookahead_alloc(void);
+    void lookahead_free(struct lookahead *la);
+    void lookahead_reset(struct lookahead *la);
+    void lookahead_add_move(struct lookahead *la, double move_d
+        , double max_start_v2, double max_cruise_v2, double delta_v2
+        , double max_smoothed_v2, double smooth_delta_v2);
+    void lookahead_expire(struct lookahead *la, int count);
+    struct move_junction *lookahead_get_junctions(struct lookahead *la);
+    int lookahead_flush(struct lookahead *la, int leftover, int lazy);
+"""
+
 defs_pyhelper = """
     void set_python_logging_callback(void (*func)(const char *));
     double get_monotonic(void);
@@ -107,6 +153,7 @@ def get_ffi():
         FFI_main = cffi.FFI()
         FFI_main.cdef(defs_stepcompress)
         FFI_main.cdef(defs_serialqueue)
+        FFI_main.cdef(defs_lookahead)
         FFI_main.cdef(defs_pyhelper)
         FFI_lib = FFI_main.dlopen(os.path.join(srcdir, DEST_LIB))
         # Setup error logging
@@ -13,6 +13,8 @@ class CoreXYKinematics:
         self.steppers = [stepper.PrinterStepper(
             printer, config.getsection('stepper_' + n), n)
                          for n in ['x', 'y', 'z']]
+        self.stepper_group = printer.mcu.create_stepper_group(
+            [s.mcu_stepper for s in self.steppers])
         self.steppers[0].mcu_endstop.add_stepper(self.steppers[1].mcu_stepper)
         self.steppers[1].mcu_endstop.add_stepper(self.steppers[0].mcu_stepper)
         self.max_z_velocity = config.getfloat(
@@ -114,33 +116,4 @@ class CoreXYKinematics:
         eyp = move.end_pos[1]
         axes_d = ((exp + eyp) - move_start_pos[0],
                   (exp - eyp) - move_start_pos[1], move.axes_d[2])
-        for i in StepList:
-            axis_d = axes_d[i]
-            if not axis_d:
-                continue
-            mcu_stepper = self.steppers[i].mcu_stepper
-            mcu_time = mcu_stepper.print_to_mcu_time(move_time)
-            start_pos = move_start_pos[i]
-            axis_r = abs(axis_d) / move.move_d
-            accel = move.accel * axis_r
-            cruise_v = move.cruise_v * axis_r
-
-            # Acceleration steps
-            if move.accel_r:
-                accel_d = move.accel_r * axis_d
-                mcu_stepper.step_const(
-                    mcu_time, start_pos, accel_d, move.start_v * axis_r, accel)
-                start_pos += accel_d
-                mcu_time += move.accel_t
-            # Cruising steps
-            if move.cruise_r:
-                cruise_d = move.cruise_r * axis_d
-                mcu_stepper.step_const(
-                    mcu_time, start_pos, cruise_d, cruise_v, 0.)
-                start_pos += cruise_d
-                mcu_time += move.cruise_t
-            # Deceleration steps
-            if move.decel_r:
-                decel_d = move.decel_r * axis_d
-                mcu_stepper.step_const(
-                    mcu_time, start_pos, decel_d, cruise_v, -accel)
+        self.stepper_group.step_move(move_time, move, move_start_pos, axes_d)
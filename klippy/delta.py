@@ -17,6 +17,8 @@ class DeltaKinematics:
         self.steppers = [stepper.PrinterStepper(
             printer, config.getsection('stepper_' + n), n)
                          for n in ['a', 'b', 'c']]
+        self.stepper_group = printer.mcu.create_stepper_group(
+            [s.mcu_stepper for s in self.steppers])
         self.need_motor_enable = self.need_home = True
         self.max_velocity = self.max_z_velocity = self.max_accel = 0.
         radius = config.getfloat('delta_radius', above=0.)
@@ -36,6 +38,7 @@ class DeltaKinematics:
         self.towers = [(math.cos(math.radians(angle)) * radius,
                         math.sin(math.radians(angle)) * radius)
                        for angle in angles]
+        self.towers_xy = [v for tower in self.towers for v in tower]
         # Find the point where an XY move could result in excessive
         # tower movement
         half_min_step_dist = min([s.step_dist for s in self.steppers]) * .5
@@ -168,61 +171,8 @@ class DeltaKinematics:
     def move(self, move_time, move):
         if self.need_motor_enable:
             self._check_motor_enable(move_time)
-        axes_d = move.axes_d
-        move_d = move.move_d
-        movexy_r = 1.
-        movez_r = 0.
-        inv_movexy_d = 1. / move_d
-        if not axes_d[0] and not axes_d[1]:
-            # Z only move
-            movez_r = axes_d[2] * inv_movexy_d
-            movexy_r = inv_movexy_d = 0.
-        elif axes_d[2]:
-            # XY+Z move
-            movexy_d = math.sqrt(axes_d[0]**2 + axes_d[1]**2)
-            movexy_r = movexy_d * inv_movexy_d
-            movez_r = axes_d[2] * inv_movexy_d
-            inv_movexy_d = 1. / movexy_d
-
-        origx, origy, origz = move.start_pos[:3]
-
-        accel = move.accel
-        cruise_v = move.cruise_v
-        accel_d = move.accel_r * move_d
-        cruise_d = move.cruise_r * move_d
-        decel_d = move.decel_r * move_d
-
-        for i in StepList:
-            # Calculate a virtual tower along the line of movement at
-            # the point closest to this stepper's tower.
-            towerx_d = self.towers[i][0] - origx
-            towery_d = self.towers[i][1] - origy
-            vt_startxy_d = (towerx_d*axes_d[0] + towery_d*axes_d[1])*inv_movexy_d
-            tangentxy_d2 = towerx_d**2 + towery_d**2 - vt_startxy_d**2
-            vt_arm_d = math.sqrt(self.arm_length2 - tangentxy_d2)
-            vt_startz = origz
-
-            # Generate steps
-            mcu_stepper = self.steppers[i].mcu_stepper
-            mcu_time = mcu_stepper.print_to_mcu_time(move_time)
-            if accel_d:
-                mcu_stepper.step_delta(
-                    mcu_time, accel_d, move.start_v, accel,
-                    vt_startz, vt_startxy_d, vt_arm_d, movez_r)
-                vt_startz += accel_d * movez_r
-                vt_startxy_d -= accel_d * movexy_r
-                mcu_time += move.accel_t
-            if cruise_d:
-                mcu_stepper.step_delta(
-                    mcu_time, cruise_d, cruise_v, 0.,
-                    vt_startz, vt_startxy_d, vt_arm_d, movez_r)
-                vt_startz += cruise_d * movez_r
-                vt_startxy_d -= cruise_d * movexy_r
-                mcu_time += move.cruise_t
-            if decel_d:
-                mcu_stepper.step_delta(
-                    mcu_time, decel_d, cruise_v, -accel,
-                    vt_startz, vt_startxy_d, vt_arm_d, movez_r)
+        self.stepper_group.step_delta_move(
+            move_time, move, self.towers_xy, self.arm_length2)
 
 
 ######################################################################
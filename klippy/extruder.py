@@ -181,31 +181,14 @@ class PrinterExtruder:
                         # There is still only a decel phase (no retraction)
                         decel_d -= extra_decel_d
 
-        # Prepare for steps
+        # Generate steps
         mcu_stepper = self.stepper.mcu_stepper
-        mcu_time = mcu_stepper.print_to_mcu_time(move_time)
-
-        # Acceleration steps
-        if accel_d:
-            mcu_stepper.step_const(mcu_time, start_pos, accel_d, start_v, accel)
-            start_pos += accel_d
-            mcu_time += accel_t
-        # Cruising steps
-        if cruise_d:
-            mcu_stepper.step_const(mcu_time, start_pos, cruise_d, cruise_v, 0.)
-            start_pos += cruise_d
-            mcu_time += cruise_t
-        # Deceleration steps
-        if decel_d:
-            mcu_stepper.step_const(mcu_time, start_pos, decel_d, decel_v, -accel)
-            start_pos += decel_d
-            mcu_time += decel_t
-        # Retraction steps
-        if retract_d:
-            mcu_stepper.step_const(
-                mcu_time, start_pos, -retract_d, retract_v, accel)
-            start_pos -= retract_d
-        self.extrude_pos = start_pos
+        mcu_stepper.step_trapezoid(
+            mcu_stepper.print_to_mcu_time(move_time), start_pos,
+            accel_d, cruise_d, decel_d, retract_d,
+            start_v, cruise_v, decel_v, retract_v,
+            accel, accel_t, cruise_t, decel_t)
+        self.extrude_pos = start_pos + accel_d + cruise_d + decel_d - retract_d
 
 # Dummy extruder class used when a printer has no extruder at all
 class DummyExtruder:
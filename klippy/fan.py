@@ -12,9 +12,9 @@ class PrinterFan:
         self.last_fan_value = 0.
         self.last_fan_time = 0.
         self.kick_start_time = config.getfloat('kick_start_time', 0.1, minval=0.)
-        pin = config.get('pin')
+        mcu, pin = printer.lookup_pin_mcu(config.get('pin'))
         hard_pwm = config.getint('hard_pwm', 0)
-        self.mcu_fan = printer.mcu.create_pwm(pin, PWM_CYCLE_TIME, hard_pwm, 0.)
+        self.mcu_fan = mcu.create_pwm(pin, PWM_CYCLE_TIME, hard_pwm, 0.)
     # External commands
     def set_speed(self, print_time, value):
         value = max(0., min(1., value))
@@ -3,25 +3,42 @@
 # Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, re, logging, collections
-import homing, extruder
+import os, re, mmap, errno, logging, collections
+import homing, extruder, gcodebin
 
 # Parse out incoming GCode and find and translate head movements
 class GCodeParser:
     RETRY_TIME = 0.100
-    def __init__(self, printer, fd, is_fileinput=False):
+    OUTPUT_MAX = 65536
+    OUTPUT_FLUSH_TIME = 1.
+    def __init__(self, printer, fd, is_fileinput=False, input_chunk=65536):
         self.printer = printer
         self.fd = fd
         self.is_fileinput = is_fileinput
         # Input handling
         self.reactor = printer.reactor
         self.is_processing_data = False
+        self.is_input_paused = False
         self.fd_handle = None
+        self.input_handler = self.process_data
         if not is_fileinput:
-            self.fd_handle = self.reactor.register_fd(self.fd, self.process_data)
+            self.fd_handle = self.reactor.register_fd(
+                self.fd, self.process_data, self.write_output)
         self.partial_input = ""
         self.bytes_read = 0
         self.input_log = collections.deque([], 50)
+        # Memory mapped file input
+        self.input_map = None
+        self.input_chunk = input_chunk
+        self.input_pos = self.input_end = 0
+        self.input_decoder = None
+        if is_fileinput:
+            self._setup_file_input()
+        # Response buffering
+        self.output_buffer = []
+        self.output_size = self.bytes_written = 0
+        self.is_output_blocked = False
+        self.output_timer = self.reactor.register_timer(self.flush_output)
         # Command handling
         self.gcode_handlers = self.build_handlers(False)
         self.is_printer_ready = False
@@ -34,6 +51,7 @@ class GCodeParser:
         self.last_position = [0.0, 0.0, 0.0, 0.0]
         self.homing_add = [0.0, 0.0, 0.0, 0.0]
         self.axis2pos = {'X': 0, 'Y': 1, 'Z': 2, 'E': 3}
+        self.move_params = {'X': 0, 'Y': 1, 'Z': 2, 'E': 3, 'F': 4}
     def build_handlers(self, is_ready):
         handlers = self.all_handlers
         if not is_ready:
@@ -45,7 +63,8 @@ class GCodeParser:
             gcode_handlers.update({ a: f for a in aliases })
         return gcode_handlers
     def stats(self, eventtime):
-        return "gcodein=%d" % (self.bytes_read,)
+        return "gcodein=%d gcodeout=%d" % (
+            self.bytes_read, self.bytes_written)
     def set_printer_ready(self, is_ready):
         if self.is_printer_ready == is_ready:
             return
@@ -73,7 +92,8 @@ class GCodeParser:
                 extruder_fan.printer_ready=True
                 
         if self.is_fileinput and self.fd_handle is None:
-            self.fd_handle = self.reactor.register_fd(self.fd, self.process_data)
+            self.fd_handle = self.reactor.register_fd(
+                self.fd, self.input_handler)
     def motor_heater_off(self):
         if self.toolhead is None:
             return
@@ -87,33 +107,101 @@ class GCodeParser:
     def dump_debug(self):
         logging.info("Dumping gcode input %d blocks" % (
             len(self.input_log),))
+        if self.input_map is not None:
+            for eventtime, offset, length in self.input_log:
+                logging.info("Read %f: offset=%d %s" % (
+                    eventtime, offset,
+                    repr(self.input_map[offset:offset+length])))
+            return
         for eventtime, data in self.input_log:
             logging.info("Read %f: %s" % (eventtime, repr(data)))
     # Parse input into commands
     args_r = re.compile('([a-zA-Z_]+|[a-zA-Z*])')
+    move_r = re.compile('G[01](?: +[XYZEF][-+]?[0-9.]+)* *$')
+    def parse_move(self, line):
+        # Parse a simple G0/G1 line into [X, Y, Z, E, speed] values
+        values = [None, None, None, None, None]
+        move_params = self.move_params
+        try:
+            for param in line.split()[1:]:
+                values[move_params[param[0]]] = float(param[1:])
+        except ValueError:
+            return None
+        speed = values[4]
+        if speed is not None:
+            speed /= 60.
+            if speed <= 0.:
+                return None
+            values[4] = speed
+        return values
     def process_commands(self, commands, need_ack=True):
         prev_need_ack = self.need_ack
+        move_r = self.move_r
         for line in commands:
             # Ignore comments and leading/trailing spaces
             line = origline = line.strip()
             cpos = line.find(';')
             if cpos >= 0:
                 line = line[:cpos]
-            # Break command into parts
-            parts = self.args_r.split(line)[1:]
-            params = { parts[i].upper(): parts[i+1].strip()
-                       for i in range(0, len(parts), 2) }
-            params['#original'] = origline
-            if parts and parts[0].upper() == 'N':
-                # Skip line number at start of command
-                del parts[:2]
-            if not parts:
-                self.cmd_default(params)
-                continue
-            params['#command'] = cmd = parts[0].upper() + parts[1].strip()
+            # Handle common G0/G1 commands without building a params dict
+            params = None
+            if self.is_printer_ready and move_r.match(line):
+                params = self.parse_move(line)
+            if params is not None:
+                cmd = line[:2]
+                handler = self.fast_move
+            else:
+                # Break command into parts
+                parts = self.args_r.split(line)[1:]
+                params = { parts[i].upper(): parts[i+1].strip()
+                           for i in range(0, len(parts), 2) }
+                params['#original'] = origline
+                if parts and parts[0].upper() == 'N':
+                    # Skip line number at start of command
+                    del parts[:2]
+                if not parts:
+                    self.cmd_default(params)
+                    continue
+                params['#command'] = cmd = parts[0].upper() + parts[1].strip()
+                handler = self.gcode_handlers.get(cmd, self.cmd_default)
             # Invoke handler for command
             self.need_ack = need_ack
-            handler = self.gcode_handlers.get(cmd, self.cmd_default)
+            try:
+                handler(params)
+            except error as e:
+                self.respond_error(str(e))
+            except:
+                logging.exception("Exception in command handler")
+                self.toolhead.force_shutdown()
+                self.respond_error('Internal error on command:"%s"' % (cmd,))
+                if self.is_fileinput:
+                    self.printer.request_exit('exit_eof')
+                    self.need_ack = prev_need_ack
+                    return False
+            self.ack()
+        self.need_ack = prev_need_ack
+        return True
+    def process_records(self, records, need_ack=True):
+        # Process commands decoded from a binary G-Code file
+        prev_need_ack = self.need_ack
+        for cmd, params in records:
+            if cmd is None:
+                if not self.process_commands([params], need_ack):
+                    break
+                continue
+            handler = self.fast_move
+            speed = params[4]
+            if speed is not None:
+                if speed > 0.:
+                    params[4] = speed / 60.
+                else:
+                    # Let cmd_G1() report the invalid speed
+                    handler = self.cmd_G1
+                    params = self._move_params(cmd, params)
+            if not self.is_printer_ready:
+                handler = self.cmd_default
+                params = {'#command': cmd, '#original': cmd}
+            self.need_ack = need_ack
             try:
                 handler(params)
             except error as e:
@@ -127,6 +215,16 @@ class GCodeParser:
                     break
             self.ack()
         self.need_ack = prev_need_ack
+    def _move_params(self, cmd, values):
+        # Build the cmd_G1() params of a decoded binary G0/G1 record
+        params = {'#command': cmd}
+        parts = [cmd]
+        for a, v in zip('XYZEF', values):
+            if v is not None:
+                params[a] = repr(v)
+                parts.append(a + params[a])
+        params['#original'] = " ".join(parts)
+        return params
     def process_data(self, eventtime):
         data = os.read(self.fd, 4096)
         self.input_log.append((eventtime, data))
@@ -139,32 +237,163 @@ class GCodeParser:
                 return
             if not self.is_fileinput and lines[0].strip().upper() == 'M112':
                 self.cmd_M112({})
-            self.reactor.unregister_fd(self.fd_handle)
-            self.fd_handle = None
+            self.is_input_paused = True
+            self.update_fd_wake()
             while self.is_processing_data:
                 eventtime = self.reactor.pause(eventtime + 0.100)
         self.is_processing_data = True
         self.process_commands(lines)
         self.is_processing_data = False
-        if self.fd_handle is None:
-            self.fd_handle = self.reactor.register_fd(self.fd, self.process_data)
+        if self.is_input_paused:
+            self.is_input_paused = False
+            self.update_fd_wake()
+        self.write_output(eventtime)
         if not data and self.is_fileinput:
             self.motor_heater_off()
             self.printer.request_exit('exit_eof')
+    def update_fd_wake(self):
+        self.reactor.set_fd_wake(self.fd_handle, not self.is_input_paused
+                                 , self.is_output_blocked)
+    # Memory mapped file input
+    def _setup_file_input(self):
+        try:
+            input_map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            # Not a regular (non-empty) file - use os.read() instead
+            return
+        self.input_map = input_map
+        self.input_pos = os.lseek(self.fd, 0, os.SEEK_CUR)
+        if input_map[:len(gcodebin.HEADER)] == gcodebin.HEADER:
+            # Pre-parsed binary G-Code file
+            self.input_pos = max(self.input_pos, len(gcodebin.HEADER))
+            self.input_end = len(input_map)
+            self.input_decoder = gcodebin.Decoder()
+            self.input_handler = self.process_binary_data
+            return
+        # Only complete lines are processed
+        self.input_end = input_map.rfind('\n') + 1
+        self.input_handler = self.process_file_data
+    def process_file_data(self, eventtime):
+        if self.is_processing_data:
+            self.is_input_paused = True
+            self.update_fd_wake()
+            while self.is_processing_data:
+                eventtime = self.reactor.pause(eventtime + 0.100)
+        input_map = self.input_map
+        pos = self.input_pos
+        end = pos + self.input_chunk
+        if end >= self.input_end:
+            end = self.input_end
+        else:
+            nl = input_map.rfind('\n', pos, end)
+            if nl < 0:
+                nl = input_map.find('\n', end)
+            end = nl + 1
+        if end <= pos:
+            self.motor_heater_off()
+            self.printer.request_exit('exit_eof')
+            return
+        self.input_log.append((eventtime, pos, end - pos))
+        self.bytes_read += end - pos
+        self.input_pos = end
+        os.lseek(self.fd, end, os.SEEK_SET)
+        lines = input_map[pos:end].split('\n')
+        lines.pop()
+        self.is_processing_data = True
+        self.process_commands(lines)
+        self.is_processing_data = False
+        if self.is_input_paused:
+            self.is_input_paused = False
+            self.update_fd_wake()
+    def process_binary_data(self, eventtime):
+        if self.is_processing_data:
+            self.is_input_paused = True
+            self.update_fd_wake()
+            while self.is_processing_data:
+                eventtime = self.reactor.pause(eventtime + 0.100)
+        pos = self.input_pos
+        if pos >= self.input_end:
+            self.motor_heater_off()
+            self.printer.request_exit('exit_eof')
+            return
+        end = min(pos + self.input_chunk, self.input_end)
+        try:
+            end, records = self.input_decoder.decode(self.input_map, pos, end)
+        except gcodebin.error as e:
+            self.respond_error("Invalid binary G-Code file: %s" % (str(e),))
+            self.motor_heater_off()
+            self.printer.request_exit('exit_eof')
+            return
+        self.input_log.append((eventtime, pos, end - pos))
+        self.bytes_read += end - pos
+        self.input_pos = end
+        os.lseek(self.fd, end, os.SEEK_SET)
+        self.is_processing_data = True
+        self.process_records(records)
+        self.is_processing_data = False
+        if self.is_input_paused:
+            self.is_input_paused = False
+            self.update_fd_wake()
     # Response handling
+    def write_output(self, eventtime):
+        if not self.output_buffer:
+            return
+        data = "".join(self.output_buffer)
+        try:
+            count = os.write(self.fd, data)
+        except OSError as e:
+            count = 0
+            if e.errno != errno.EAGAIN:
+                logging.warning("Discarding gcode output: %s" % (str(e),))
+                count = len(data)
+        self.bytes_written += count
+        if count < len(data):
+            self.output_buffer = [data[count:]]
+        else:
+            self.output_buffer = []
+        self.output_size = len(data) - count
+        is_blocked = self.output_size > 0
+        if is_blocked != self.is_output_blocked:
+            # Wait for the fd to become writable before trying again
+            self.is_output_blocked = is_blocked
+            self.update_fd_wake()
+    def flush_output(self, eventtime):
+        self.write_output(eventtime)
+        return self.reactor.NEVER
+    def wait_output(self, max_size, timeout=None):
+        eventtime = self.reactor.monotonic()
+        endtime = self.reactor.NEVER
+        if timeout is not None:
+            endtime = eventtime + timeout
+        while 1:
+            self.write_output(eventtime)
+            if self.output_size <= max_size or eventtime > endtime:
+                return
+            eventtime = self.reactor.pause(eventtime + 0.005)
+    def finish_output(self):
+        if not self.is_fileinput:
+            self.wait_output(0, self.OUTPUT_FLUSH_TIME)
+    def queue_output(self, data):
+        self.output_buffer.append(data)
+        self.output_size += len(data)
+        if self.output_size > self.OUTPUT_MAX:
+            # Output isn't being read - stall until the client catches up
+            self.wait_output(self.OUTPUT_MAX)
+        elif not self.is_output_blocked:
+            self.reactor.update_timer(self.output_timer, self.reactor.NOW)
     def ack(self, msg=None):
         if not self.need_ack or self.is_fileinput:
             return
         if msg:
-            os.write(self.fd, "ok %s\n" % (msg,))
+            self.queue_output("ok %s\n" % (msg,))
         else:
-            os.write(self.fd, "ok\n")
+            self.queue_output("ok\n")
         self.need_ack = False
     def respond(self, msg):
         logging.debug(msg)
         if self.is_fileinput:
             return
-        os.write(self.fd, msg+"\n")
+        self.queue_output(msg+"\n")
     def respond_info(self, msg):
         lines = [l.strip() for l in msg.strip().split('\n')]
         self.respond("// " + "\n// ".join(lines))
@@ -286,7 +515,7 @@ class GCodeParser:
         'M82', 'M83', 'M18', 'M105', 'M104', 'M109', 'M112', 'M114', 'M115',
         'M140', 'M190', 'M106', 'M107', 'M206', 'M400',
         'IGNORE', 'QUERY_ENDSTOPS', 'PID_TUNE', 'RESTART', 'FIRMWARE_RESTART',
-        'STATUS', 'HELP']
+        'STATUS', 'REACTOR_STATS', 'HELP']
     cmd_G1_aliases = ['G0']
     def cmd_G1(self, params):
         # Move
@@ -314,6 +543,24 @@ class GCodeParser:
         except homing.EndstopError as e:
             self.respond_error(str(e))
             self.last_position = self.toolhead.get_position()
+    def fast_move(self, values):
+        # Move using the values from parse_move()
+        for p in (0, 1, 2, 3):
+            v = values[p]
+            if v is not None:
+                if not self.absolutecoord or (p>2 and not self.absoluteextrude):
+                    # value relative to position of last move
+                    self.last_position[p] += v
+                else:
+                    # value relative to base coordinate position
+                    self.last_position[p] = v + self.base_position[p]
+        if values[4] is not None:
+            self.speed = values[4]
+        try:
+            self.toolhead.move(self.last_position, self.speed)
+        except homing.EndstopError as e:
+            self.respond_error(str(e))
+            self.last_position = self.toolhead.get_position()
     def cmd_G4(self, params):
         # Dwell
         if 'S' in params:
@@ -475,6 +722,31 @@ class GCodeParser:
             self.respond_info(msg)
         else:
             self.respond_error(msg)
+    cmd_REACTOR_STATS_when_not_ready = True
+    cmd_REACTOR_STATS_help = "Report time spent in host event callbacks"
+    def cmd_REACTOR_STATS(self, params):
+        if 'S' in params:
+            if not self.get_int('S', params):
+                self.reactor.disable_stats()
+                self.respond_info("Reactor statistics disabled")
+                return
+            slow_time = self.get_float('T', params, 0.100)
+            if not 0.001 <= slow_time <= 60.:
+                # The watchdog thread wakes every slow_time/2 seconds
+                self.respond_error(
+                    "Slow callback time must be between 0.001 and 60 seconds")
+                return
+            self.reactor.enable_stats(slow_time)
+            self.respond_info("Reactor statistics enabled (slow time %.3fs)" % (
+                slow_time,))
+            return
+        report = self.reactor.get_stats()
+        if report is None:
+            self.respond_info("Reactor statistics not enabled"
+                              " (use REACTOR_STATS S1 to enable)")
+            return
+        logging.info("Reactor stats:\n%s" % (report,))
+        self.respond_info(report or "No reactor callbacks run")
     cmd_HELP_when_not_ready = True
     def cmd_HELP(self, params):
         cmdhelp = []
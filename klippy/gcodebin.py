@@ -0,0 +1,160 @@
+# Pre-parsed binary G-Code file format
+#
+# Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import struct
+
+# File layout: an 8 byte header followed by a list of records.  Each
+# record starts with a one byte opcode:
+#   TEXT: a uint32 length followed by the text of a G-Code line.
+#   MOVE_G0/MOVE_G1: a uint16 field mask followed by the X, Y, Z, E,
+#     and F values that are present.  The mask holds two bits per
+#     field (X in the low bits) describing how the field is stored.
+# All values are little endian.
+HEADER = "KLGCODE\x01"
+
+OP_TEXT = 0x01
+OP_MOVE_G0 = 0x10
+OP_MOVE_G1 = 0x11
+
+FIELD_NONE, FIELD_FLOAT32, FIELD_FLOAT64, FIELD_DECIMAL = range(4)
+FIELD_FORMATS = {
+    FIELD_FLOAT32: 'f', FIELD_FLOAT64: 'd', FIELD_DECIMAL: 'iB' }
+MAX_DECIMAL_PLACES = 22
+
+class error(Exception):
+    pass
+
+def _same_float(a, b):
+    return struct.pack('<d', a) == struct.pack('<d', b)
+
+def _decimal(text, value):
+    # Try to store the value as an integer and a power of ten - this
+    # is exact as 'digits / 10.**places' is correctly rounded
+    text = text.lstrip('+')
+    if '.' in text:
+        ipart, fpart = text.split('.')
+    else:
+        ipart, fpart = text, ''
+    places = len(fpart)
+    if places > MAX_DECIMAL_PLACES:
+        return None
+    digits = int((ipart + fpart).lstrip('-') or '0')
+    if ipart.startswith('-'):
+        digits = -digits
+    if digits < -2**31 or digits >= 2**31:
+        return None
+    if not _same_float(digits / 10.**places, value):
+        return None
+    return digits, places
+
+
+######################################################################
+# Encoding
+######################################################################
+
+def encode_text(line):
+    return struct.pack('<BI', OP_TEXT, len(line)) + line
+
+# Encode a G0/G1 move.  The 'fields' parameter is a list of five
+# (text, value) pairs (or None) for the X, Y, Z, E, and F parameters.
+def encode_move(is_g1, fields):
+    mask = 0
+    fmt = '<BH'
+    args = []
+    for i, field in enumerate(fields):
+        if field is None:
+            continue
+        text, value = field
+        if value - value != 0:
+            raise error("Can not encode non-finite value '%s'" % (text,))
+        ftype = FIELD_FLOAT64
+        fargs = [value]
+        if _same_float(struct.unpack('<f', struct.pack('<f', value))[0]
+                       , value):
+            ftype = FIELD_FLOAT32
+        else:
+            dec = _decimal(text, value)
+            if dec is not None:
+                ftype = FIELD_DECIMAL
+                fargs = list(dec)
+        mask |= ftype << (i * 2)
+        fmt += FIELD_FORMATS[ftype]
+        args.extend(fargs)
+    opcode = OP_MOVE_G0
+    if is_g1:
+        opcode = OP_MOVE_G1
+    return struct.pack(fmt, opcode, mask, *args)
+
+
+######################################################################
+# Decoding
+######################################################################
+
+# Returns a list of (struct, field list) describing a move field mask
+def _build_move_decoder(mask):
+    fmt = '<'
+    fields = []
+    for i in range(5):
+        ftype = (mask >> (i * 2)) & 0x03
+        if ftype == FIELD_NONE:
+            continue
+        fmt += FIELD_FORMATS[ftype]
+        fields.append((i, ftype == FIELD_DECIMAL))
+    return struct.Struct(fmt), fields
+
+class Decoder:
+    def __init__(self):
+        self.move_decoders = {}
+        self.text_struct = struct.Struct('<I')
+        self.mask_struct = struct.Struct('<H')
+        self.powers = [10.**i for i in range(MAX_DECIMAL_PLACES + 1)]
+    # Decode the records in data[pos:end].  Returns the position of
+    # the first record not decoded and a list of (cmd, params) tuples.
+    # For moves 'params' is a list of X, Y, Z, E, F values (None if
+    # not present) and for other commands 'cmd' is None and 'params'
+    # is the text of the line.
+    def decode(self, data, pos, end):
+        try:
+            return self._decode(data, pos, end)
+        except (struct.error, IndexError) as e:
+            raise error("Invalid record after offset %d" % (pos,))
+    def _decode(self, data, pos, end):
+        records = []
+        move_decoders = self.move_decoders
+        powers = self.powers
+        while pos < end:
+            opcode = ord(data[pos])
+            if opcode == OP_TEXT:
+                length, = self.text_struct.unpack_from(data, pos + 1)
+                pos += 5
+                records.append((None, data[pos:pos+length]))
+                pos += length
+                continue
+            if opcode != OP_MOVE_G0 and opcode != OP_MOVE_G1:
+                raise error("Invalid opcode %d at offset %d" % (opcode, pos))
+            mask, = self.mask_struct.unpack_from(data, pos + 1)
+            decoder = move_decoders.get(mask)
+            if decoder is None:
+                decoder = move_decoders[mask] = _build_move_decoder(mask)
+            mstruct, fields = decoder
+            vals = mstruct.unpack_from(data, pos + 3)
+            for v in vals:
+                # Only nan and inf values are not equal to zero here
+                if v - v != 0:
+                    raise error("Invalid move value at offset %d" % (pos,))
+            pos += 3 + mstruct.size
+            values = [None, None, None, None, None]
+            j = 0
+            for i, is_decimal in fields:
+                if is_decimal:
+                    values[i] = vals[j] / powers[vals[j+1]]
+                    j += 2
+                else:
+                    values[i] = vals[j]
+                    j += 1
+            records.append((opcode == OP_MOVE_G1 and 'G1' or 'G0', values))
+        if pos > len(data):
+            raise error("Truncated record at end of file")
+        return pos, records
@@ -55,15 +55,18 @@ class PrinterHeater:
         self.target_temp = 0.
         algos = {'watermark': ControlBangBang, 'pid': ControlPID}
         algo = config.getchoice('control', algos)
-        heater_pin = config.get('heater_pin')
-        sensor_pin = config.get('sensor_pin')
+        mcu, heater_pin = printer.lookup_pin_mcu(config.get('heater_pin'))
+        sensor_mcu, sensor_pin = printer.lookup_pin_mcu(
+            config.get('sensor_pin'))
+        if sensor_mcu is not mcu:
+            raise config.error(
+                "heater_pin and sensor_pin must be on the same mcu")
         if algo is ControlBangBang and self.max_power == 1.:
-            self.mcu_pwm = printer.mcu.create_digital_out(
-                heater_pin, MAX_HEAT_TIME)
+            self.mcu_pwm = mcu.create_digital_out(heater_pin, MAX_HEAT_TIME)
         else:
-            self.mcu_pwm = printer.mcu.create_pwm(
+            self.mcu_pwm = mcu.create_pwm(
                 heater_pin, PWM_CYCLE_TIME, 0, MAX_HEAT_TIME)
-        self.mcu_adc = printer.mcu.create_adc(sensor_pin)
+        self.mcu_adc = mcu.create_adc(sensor_pin)
         adc_range = [self.calc_adc(self.min_temp), self.calc_adc(self.max_temp)]
         self.mcu_adc.set_minmax(SAMPLE_TIME, SAMPLE_COUNT,
                                 minval=min(adc_range), maxval=max(adc_range))
@@ -6,7 +6,7 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import sys, optparse, ConfigParser, logging, time, threading
 import gcode, toolhead, util, mcu, fan, heater, extruder, reactor, queuelogger, extruder_auto_fan
-import msgproto
+import msgproto, pins
 
 message_ready = "Printer is ready"
 
@@ -121,7 +121,8 @@ class ConfigLogger():
 
 class Printer:
     def __init__(self, conffile, input_fd, startup_state
-                 , is_fileinput=False, version="?", bglogger=None):
+                 , is_fileinput=False, version="?", bglogger=None
+                 , input_chunk=65536):
         self.conffile = conffile
         self.startup_state = startup_state
         self.software_version = version
@@ -130,7 +131,8 @@ class Printer:
             bglogger.set_rollover_info("config", None)
         self.reactor = reactor.Reactor()
         self.objects = {}
-        self.gcode = gcode.GCodeParser(self, input_fd, is_fileinput)
+        self.gcode = gcode.GCodeParser(
+            self, input_fd, is_fileinput, input_chunk)
         self.stats_timer = self.reactor.register_timer(self.stats)
         self.connect_timer = self.reactor.register_timer(
             self.connect, self.reactor.NOW)
@@ -141,6 +143,17 @@ class Printer:
         self.run_result = None
         self.fileconfig = None
         self.mcu = None
+        self.mcus = []
+        self.is_shutdown = False
+        self.warm_serials = {}
+    def set_warm_serials(self, serials):
+        self.warm_serials = dict(serials)
+    def get_warm_serial(self, name):
+        return self.warm_serials.pop(name, None)
+    def _disconnect_warm_serials(self):
+        for serial in self.warm_serials.values():
+            serial.disconnect()
+        self.warm_serials.clear()
     def set_fileoutput(self, debugoutput, dictionary):
         self.debugoutput = debugoutput
         self.dictionary = dictionary
@@ -150,7 +163,7 @@ class Printer:
             self.gcode.dump_debug()
             self.need_dump_debug = False
         toolhead = self.objects.get('toolhead')
-        if toolhead is None or self.mcu is None:
+        if toolhead is None or not self.mcus:
             return eventtime + 1.
         is_active, thstats = toolhead.stats(eventtime)
         if not is_active and not force_output:
@@ -158,11 +171,24 @@ class Printer:
         out = []
         out.append(self.gcode.stats(eventtime))
         out.append(thstats)
-        out.append(self.mcu.stats(eventtime))
+        for m in self.mcus:
+            out.append(m.stats(eventtime))
         logging.info("Stats %.1f: %s" % (eventtime, ' '.join(out)))
         return eventtime + 1.
     def add_object(self, name, obj):
         self.objects[name] = obj
+    def get_mcus(self):
+        return list(self.mcus)
+    def lookup_pin_mcu(self, pin):
+        # Find the mcu a pin description refers to (pins without an
+        # "mcu_name:" prefix are on the main mcu)
+        name, mcu_pin = pins.split_mcu_name(pin)
+        if name is None:
+            return self.mcu, mcu_pin
+        for m in self.mcus:
+            if m.get_name() == name:
+                return m, mcu_pin
+        raise ConfigParser.Error("Unknown mcu '%s' in pin '%s'" % (name, pin))
     def load_config(self):
         self.fileconfig = ConfigParser.RawConfigParser()
         res = self.fileconfig.read(self.conffile)
@@ -172,8 +198,19 @@ class Printer:
         if self.bglogger is not None:
             ConfigLogger(self.fileconfig, self.bglogger)
         self.mcu = mcu.MCU(self, ConfigWrapper(self, 'mcu'))
+        self.mcus = [self.mcu] + [
+            mcu.MCU(self, ConfigWrapper(self, section))
+            for section in self.fileconfig.sections()
+            if section.startswith('mcu ')]
+        # Close any reused connections that no mcu section claimed
+        self._disconnect_warm_serials()
         if self.debugoutput is not None:
             self.mcu.connect_file(self.debugoutput, self.dictionary)
+            # Additional mcus write to their own "<output>.<name>" file
+            for m in self.mcus[1:]:
+                output = open("%s.%s" % (
+                    self.debugoutput.name, m.get_name()), 'wb')
+                m.connect_file(output, self.dictionary)
         # Create printer components
         config = ConfigWrapper(self, 'printer')
         for m in [extruder, fan, heater, toolhead,extruder_auto_fan]:
@@ -196,7 +233,8 @@ class Printer:
             self.load_config()
             if self.debugoutput is None:
                 self.reactor.update_timer(self.stats_timer, self.reactor.NOW)
-            self.mcu.connect()
+            for m in self.mcus:
+                m.connect()
             self.gcode.set_printer_ready(True)
             self.state_message = message_ready
         except ConfigParser.Error as e:
@@ -228,34 +266,68 @@ class Printer:
         except:
             logging.exception("Unhandled exception during run")
             return
+        self.gcode.finish_output()
         return self.run_result
     def get_state_message(self):
         return self.state_message
     def note_shutdown(self, msg):
+        if self.is_shutdown:
+            return
+        self.is_shutdown = True
         if self.state_message == message_ready:
             self.need_dump_debug = True
         self.state_message = "Firmware shutdown: %s%s" % (
             msg, message_shutdown)
         self.gcode.set_printer_ready(False)
+        # Stop any other micro-controllers too
+        for m in self.mcus:
+            if not m.is_shutdown:
+                m.force_shutdown()
     def note_mcu_error(self, msg):
         self.state_message = "%s%s" % (msg, message_restart)
         self.gcode.set_printer_ready(False)
         self.gcode.motor_heater_off()
     def disconnect(self):
         try:
-            if self.mcu is not None:
+            self._disconnect_warm_serials()
+            if self.mcus:
                 self.stats(self.reactor.monotonic(), force_output=True)
-                self.mcu.disconnect()
+            for m in self.mcus:
+                m.disconnect()
         except:
             logging.exception("Unhandled exception during disconnect")
+        self.reactor.finalize()
+    def warm_disconnect(self):
+        # Disconnect, but keep the mcu connections open for reuse.
+        # Returns None unless every connection can be reused.
+        serials = {}
+        try:
+            self._disconnect_warm_serials()
+            if self.mcus:
+                self.stats(self.reactor.monotonic(), force_output=True)
+            for m in self.mcus:
+                serial = m.warm_disconnect()
+                if serial is not None:
+                    serials[m.get_name()] = serial
+        except:
+            logging.exception("Unhandled exception during warm_disconnect")
+        self.reactor.finalize()
+        if not self.mcus or len(serials) != len(self.mcus):
+            for serial in serials.values():
+                serial.disconnect()
+            return None
+        return serials
     def firmware_restart(self):
         try:
-            if self.mcu is not None:
+            self._disconnect_warm_serials()
+            if self.mcus:
                 self.stats(self.reactor.monotonic(), force_output=True)
-                self.mcu.microcontroller_restart()
-                self.mcu.disconnect()
+            for m in self.mcus:
+                m.microcontroller_restart()
+                m.disconnect()
         except:
             logging.exception("Unhandled exception during firmware_restart")
+        self.reactor.finalize()
     def get_startup_state(self):
         return self.startup_state
     def request_exit(self, result="exit"):
@@ -280,6 +352,9 @@ def main():
                     help="write output to file instead of to serial port")
     opts.add_option("-i", "--debuginput", dest="inputfile",
                     help="read commands from file instead of from tty port")
+    opts.add_option("--input-chunk", dest="input_chunk", type="int",
+                    default=65536,
+                    help="bytes of debuginput file to process at a time")
     opts.add_option("-I", "--input-tty", dest="inputtty", default='/tmp/printer',
                     help="input tty name (default is /tmp/printer)")
     opts.add_option("-l", "--logfile", dest="logfile",
@@ -291,6 +366,8 @@ def main():
     options, args = opts.parse_args()
     if len(args) != 1:
         opts.error("Incorrect number of arguments")
+    if options.input_chunk <= 0:
+        opts.error("--input-chunk must be greater than zero")
     conffile = args[0]
 
     input_fd = debuginput = debugoutput = bglogger = None
@@ -322,17 +399,21 @@ def main():
 
     # Start firmware
     res = 'startup'
+    warm_serials = None
     while 1:
         is_fileinput = debuginput is not None
-        printer = Printer(
-            conffile, input_fd, res, is_fileinput, software_version, bglogger)
+        printer = Printer(conffile, input_fd, res, is_fileinput,
+                          software_version, bglogger, options.input_chunk)
+        if warm_serials is not None:
+            printer.set_warm_serials(warm_serials)
         if debugoutput:
             proto_dict = read_dictionary(options.read_dictionary)
             printer.set_fileoutput(debugoutput, proto_dict)
         res = printer.run()
         if res == 'restart':
-            printer.disconnect()
-            time.sleep(1.)
+            warm_serials = printer.warm_disconnect()
+            if warm_serials is None:
+                time.sleep(1.)
             logging.info("Restarting printer")
             continue
         elif res == 'firmware_restart':
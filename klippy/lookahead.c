@@ -0,0 +1,218 @@
+// Move queue "look-ahead" junction planning
+//
+// Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+//
+// This is an alternative implementation of the MoveQueue.flush()
+// code in toolhead.py.  The per-move parameters are stored in
+// parallel arrays and the backward pass (along with the trapezoid
+// generator of Move.set_junction()) is run over them in a single
+// call.  The math (and order of operations) mirrors the python code
+// exactly so that both implementations produce identical results.
+
+#include <math.h> // sqrt
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+
+struct move_junction {
+    double accel_r, cruise_r, decel_r;
+    double start_v, cruise_v, end_v;
+    double accel_t, cruise_t, decel_t;
+};
+
+struct delayed_move {
+    int pos;
+    double start_v2, end_v2;
+};
+
+struct lookahead {
+    int count, alloc;
+    // Move parameters (one entry per queued move)
+    double *move_d, *max_start_v2, *max_cruise_v2, *delta_v2;
+    double *max_smoothed_v2, *smooth_delta_v2;
+    // Results
+    struct move_junction *junctions;
+    // Temporary storage
+    struct delayed_move *delayed;
+};
+
+// Equivalent of python's min(a, b)
+static inline double
+pmin(double a, double b)
+{
+    return b < a ? b : a;
+}
+
+// Allocate a new 'lookahead' object
+struct lookahead *
+lookahead_alloc(void)
+{
+    struct lookahead *la = malloc(sizeof(*la));
+    memset(la, 0, sizeof(*la));
+    return la;
+}
+
+// Free memory associated with a 'lookahead' object
+void
+lookahead_free(struct lookahead *la)
+{
+    if (!la)
+        return;
+    free(la->move_d);
+    free(la->max_start_v2);
+    free(la->max_cruise_v2);
+    free(la->delta_v2);
+    free(la->max_smoothed_v2);
+    free(la->smooth_delta_v2);
+    free(la->junctions);
+    free(la->delayed);
+    free(la);
+}
+
+// Discard all queued moves
+void
+lookahead_reset(struct lookahead *la)
+{
+    la->count = 0;
+}
+
+#define EXPAND(la, field) \
+    la->field = realloc(la->field, la->alloc * sizeof(*la->field))
+
+// Add a move to the end of the queue
+void
+lookahead_add_move(struct lookahead *la, double move_d, double max_start_v2
+                   , double max_cruise_v2, double delta_v2
+                   , double max_smoothed_v2, double smooth_delta_v2)
+{
+    if (la->count >= la->alloc) {
+        la->alloc = la->alloc ? la->alloc * 2 : 1024;
+        EXPAND(la, move_d);
+        EXPAND(la, max_start_v2);
+        EXPAND(la, max_cruise_v2);
+        EXPAND(la, delta_v2);
+        EXPAND(la, max_smoothed_v2);
+        EXPAND(la, smooth_delta_v2);
+        EXPAND(la, junctions);
+        EXPAND(la, delayed);
+    }
+    int pos = la->count++;
+    la->move_d[pos] = move_d;
+    la->max_start_v2[pos] = max_start_v2;
+    la->max_cruise_v2[pos] = max_cruise_v2;
+    la->delta_v2[pos] = delta_v2;
+    la->max_smoothed_v2[pos] = max_smoothed_v2;
+    la->smooth_delta_v2[pos] = smooth_delta_v2;
+}
+
+#define SHIFT(la, field, count) \
+    memmove(la->field, &la->field[count], (la->count - count) \
+            * sizeof(*la->field))
+
+// Remove the given number of moves from the start of the queue
+void
+lookahead_expire(struct lookahead *la, int count)
+{
+    if (count <= 0)
+        return;
+    if (count > la->count)
+        count = la->count;
+    SHIFT(la, move_d, count);
+    SHIFT(la, max_start_v2, count);
+    SHIFT(la, max_cruise_v2, count);
+    SHIFT(la, delta_v2, count);
+    SHIFT(la, max_smoothed_v2, count);
+    SHIFT(la, smooth_delta_v2, count);
+    SHIFT(la, junctions, count);
+    la->count -= count;
+}
+
+// Return the trapezoid results of the queued moves
+struct move_junction *
+lookahead_get_junctions(struct lookahead *la)
+{
+    return la->junctions;
+}
+
+// Determine accel, cruise, and decel portions of a move
+static void
+set_junction(struct lookahead *la, int pos
+             , double start_v2, double cruise_v2, double end_v2)
+{
+    struct move_junction *mj = &la->junctions[pos];
+    double move_d = la->move_d[pos], inv_delta_v2 = 1. / la->delta_v2[pos];
+    double accel_r = mj->accel_r = (cruise_v2 - start_v2) * inv_delta_v2;
+    double decel_r = mj->decel_r = (cruise_v2 - end_v2) * inv_delta_v2;
+    double cruise_r = mj->cruise_r = 1. - accel_r - decel_r;
+    double start_v = mj->start_v = sqrt(start_v2);
+    double cruise_v = mj->cruise_v = sqrt(cruise_v2);
+    double end_v = mj->end_v = sqrt(end_v2);
+    mj->accel_t = accel_r * move_d / ((start_v + cruise_v) * 0.5);
+    mj->cruise_t = cruise_r * move_d / cruise_v;
+    mj->decel_t = decel_r * move_d / ((end_v + cruise_v) * 0.5);
+}
+
+// Traverse queue from last to first move and determine maximum
+// junction speed assuming the robot comes to a complete stop after
+// the last move.  Returns the number of moves that may be flushed or
+// -1 if a lazy flush found nothing to flush.
+int
+lookahead_flush(struct lookahead *la, int leftover, int lazy)
+{
+    int update_flush_count = lazy, flush_count = la->count;
+    int delayed_count = 0, i, j;
+    double next_end_v2 = 0., next_smoothed_v2 = 0., peak_cruise_v2 = 0.;
+    for (i=flush_count-1; i>=leftover; i--) {
+        double reachable_start_v2 = next_end_v2 + la->delta_v2[i];
+        double start_v2 = pmin(la->max_start_v2[i], reachable_start_v2);
+        double smooth_delta_v2 = la->smooth_delta_v2[i];
+        double reachable_smoothed_v2 = next_smoothed_v2 + smooth_delta_v2;
+        double smoothed_v2 = pmin(la->max_smoothed_v2[i]
+                                  , reachable_smoothed_v2);
+        if (smoothed_v2 < reachable_smoothed_v2) {
+            // It's possible for this move to accelerate
+            if (smoothed_v2 + smooth_delta_v2 > next_smoothed_v2
+                || delayed_count) {
+                // This move can decelerate or this is a full accel
+                // move after a full decel move
+                if (update_flush_count && peak_cruise_v2) {
+                    flush_count = i;
+                    update_flush_count = 0;
+                }
+                peak_cruise_v2 = pmin(la->max_cruise_v2[i], (
+                    smoothed_v2 + reachable_smoothed_v2) * .5);
+                if (delayed_count) {
+                    // Propagate peak_cruise_v2 to any delayed moves
+                    if (!update_flush_count && i < flush_count) {
+                        for (j=0; j<delayed_count; j++) {
+                            struct delayed_move *dm = &la->delayed[j];
+                            double mc_v2 = pmin(peak_cruise_v2, dm->start_v2);
+                            set_junction(la, dm->pos, pmin(dm->start_v2, mc_v2)
+                                         , mc_v2, pmin(dm->end_v2, mc_v2));
+                        }
+                    }
+                    delayed_count = 0;
+                }
+            }
+            if (!update_flush_count && i < flush_count) {
+                double cruise_v2 = pmin(pmin((start_v2 + reachable_start_v2)
+                                             * .5, la->max_cruise_v2[i])
+                                        , peak_cruise_v2);
+                set_junction(la, i, pmin(start_v2, cruise_v2), cruise_v2
+                             , pmin(next_end_v2, cruise_v2));
+            }
+        } else {
+            // Delay calculating this move until peak_cruise_v2 is known
+            struct delayed_move *dm = &la->delayed[delayed_count++];
+            dm->pos = i;
+            dm->start_v2 = start_v2;
+            dm->end_v2 = next_end_v2;
+        }
+        next_end_v2 = start_v2;
+        next_smoothed_v2 = smoothed_v2;
+    }
+    if (update_flush_count)
+        return -1;
+    return flush_count;
+}
@@ -19,22 +19,22 @@ def parse_pin_extras(pin, can_pullup=False):
         pin = pin[1:].strip()
     return pin, pullup, invert
 
-STEPCOMPRESS_ERROR_RET = -989898989
-
 class MCU_stepper:
     def __init__(self, mcu, step_pin, dir_pin):
         self._mcu = mcu
         self._oid = mcu.create_oid(self)
         self._step_pin, pullup, self._invert_step = parse_pin_extras(step_pin)
         self._dir_pin, pullup, self._invert_dir = parse_pin_extras(dir_pin)
-        self._commanded_pos = 0
         self._step_dist = self._inv_step_dist = 1.
-        self._velocity_factor = self._accel_factor = 0.
         self._mcu_position_offset = 0
         self._mcu_freq = self._min_stop_interval = 0.
         self._reset_cmd = self._get_position_cmd = None
-        self._ffi_lib = self._stepqueue = None
+        ffi_main, self._ffi_lib = chelper.get_ffi()
+        self._stepqueue = ffi_main.gc(self._ffi_lib.stepcompress_alloc(
+            self._oid), self._ffi_lib.stepcompress_free)
         self.print_to_mcu_time = mcu.print_to_mcu_time
+    def get_mcu(self):
+        return self._mcu
     def set_min_stop_interval(self, min_stop_interval):
         self._min_stop_interval = min_stop_interval
     def set_step_distance(self, step_dist):
@@ -42,8 +42,6 @@ class MCU_stepper:
         self._inv_step_dist = 1. / step_dist
     def build_config(self):
         self._mcu_freq = self._mcu.get_mcu_freq()
-        self._velocity_factor = 1. / (self._mcu_freq * self._step_dist)
-        self._accel_factor = 1. / (self._mcu_freq**2 * self._step_dist)
         max_error = self._mcu.get_max_stepper_error()
         min_stop_interval = max(0., self._min_stop_interval - max_error)
         self._mcu.add_config_cmd(
@@ -60,25 +58,31 @@ class MCU_stepper:
             "reset_step_clock oid=%c clock=%u")
         self._get_position_cmd = self._mcu.lookup_command(
             "stepper_get_position oid=%c")
-        ffi_main, self._ffi_lib = chelper.get_ffi()
         max_error = int(max_error * self._mcu_freq)
-        self._stepqueue = ffi_main.gc(self._ffi_lib.stepcompress_alloc(
-            max_error, step_cmd.msgid, dir_cmd.msgid,
-            self._invert_dir, self._oid),
-                                      self._ffi_lib.stepcompress_free)
+        self._ffi_lib.stepcompress_fill(
+            self._stepqueue, max_error, step_cmd.msgid, dir_cmd.msgid,
+            self._invert_dir)
+        self._ffi_lib.stepcompress_set_scale(
+            self._stepqueue, self._mcu_freq, self._step_dist)
+    def set_time_scale(self, time_scale):
+        self._ffi_lib.stepcompress_set_time_scale(self._stepqueue, time_scale)
     def get_oid(self):
         return self._oid
+    def get_stepqueue(self):
+        return self._stepqueue
+    def _get_commanded_pos(self):
+        return self._ffi_lib.stepcompress_get_position(self._stepqueue)
     def set_position(self, pos):
         if pos >= 0.:
             steppos = int(pos * self._inv_step_dist + 0.5)
         else:
             steppos = int(pos * self._inv_step_dist - 0.5)
-        self._mcu_position_offset += self._commanded_pos - steppos
-        self._commanded_pos = steppos
+        self._mcu_position_offset += self._get_commanded_pos() - steppos
+        self._ffi_lib.stepcompress_set_position(self._stepqueue, steppos)
     def get_commanded_position(self):
-        return self._commanded_pos * self._step_dist
+        return self._get_commanded_pos() * self._step_dist
     def get_mcu_position(self):
-        return self._commanded_pos + self._mcu_position_offset
+        return self._get_commanded_pos() + self._mcu_position_offset
     def note_homing_start(self, homing_clock):
         ret = self._ffi_lib.stepcompress_set_homing(
             self._stepqueue, homing_clock)
@@ -98,7 +102,7 @@ class MCU_stepper:
         pos = params['pos']
         if self._invert_dir:
             pos = -pos
-        self._mcu_position_offset = pos - self._commanded_pos
+        self._mcu_position_offset = pos - self._get_commanded_pos()
     def reset_step_clock(self, mcu_time):
         clock = int(mcu_time * self._mcu_freq)
         ret = self._ffi_lib.stepcompress_reset(self._stepqueue, clock)
@@ -114,31 +118,76 @@ class MCU_stepper:
         ret = self._ffi_lib.stepcompress_push(self._stepqueue, clock, sdir)
         if ret:
             raise error("Internal error in stepcompress")
-        if sdir:
-            self._commanded_pos += 1
-        else:
-            self._commanded_pos -= 1
     def step_const(self, mcu_time, start_pos, dist, start_v, accel):
-        inv_step_dist = self._inv_step_dist
-        step_offset = self._commanded_pos - start_pos * inv_step_dist
-        count = self._ffi_lib.stepcompress_push_const(
-            self._stepqueue, mcu_time * self._mcu_freq, step_offset,
-            dist * inv_step_dist, start_v * self._velocity_factor,
-            accel * self._accel_factor)
-        if count == STEPCOMPRESS_ERROR_RET:
+        ret = self._ffi_lib.stepcompress_step_const(
+            self._stepqueue, mcu_time, start_pos, dist, start_v, accel)
+        if ret:
             raise error("Internal error in stepcompress")
-        self._commanded_pos += count
     def step_delta(self, mcu_time, dist, start_v, accel
                    , height_base, startxy_d, arm_d, movez_r):
-        inv_step_dist = self._inv_step_dist
-        height = self._commanded_pos - height_base * inv_step_dist
-        count = self._ffi_lib.stepcompress_push_delta(
-            self._stepqueue, mcu_time * self._mcu_freq, dist * inv_step_dist,
-            start_v * self._velocity_factor, accel * self._accel_factor,
-            height, startxy_d * inv_step_dist, arm_d * inv_step_dist, movez_r)
-        if count == STEPCOMPRESS_ERROR_RET:
+        ret = self._ffi_lib.stepcompress_step_delta(
+            self._stepqueue, mcu_time, dist, start_v, accel,
+            height_base, startxy_d, arm_d, movez_r)
+        if ret:
+            raise error("Internal error in stepcompress")
+    def step_trapezoid(self, mcu_time, start_pos, accel_d, cruise_d, decel_d
+                       , retract_d, start_v, cruise_v, decel_v, retract_v
+                       , accel, accel_t, cruise_t, decel_t):
+        ret = self._ffi_lib.stepcompress_push_trapezoid(
+            self._stepqueue, mcu_time, start_pos,
+            accel_d, cruise_d, decel_d, retract_d,
+            start_v, cruise_v, decel_v, retract_v,
+            accel, accel_t, cruise_t, decel_t)
+        if ret:
             raise error("Internal error in stepcompress")
-        self._commanded_pos += count
+
+# Generate the steps of a move on a group of steppers with a single
+# call into the C code (one call per mcu if the steppers are on
+# several micro-controllers)
+class MCU_stepper_group:
+    def __init__(self, mcu, mcu_steppers):
+        self._mcu_steppers = mcu_steppers
+        ffi_main, self._ffi_lib = chelper.get_ffi()
+        by_mcu = {}
+        for i, s in enumerate(mcu_steppers):
+            by_mcu.setdefault(s.get_mcu(), []).append(i)
+        self._groups = []
+        for m, indexes in by_mcu.items():
+            sc_list = ffi_main.new('struct stepcompress *[]', [
+                mcu_steppers[i].get_stepqueue() for i in indexes])
+            select = select_pairs = None
+            if len(indexes) != len(mcu_steppers):
+                select = lambda v, ind=indexes: [v[i] for i in ind]
+                select_pairs = lambda v, ind=indexes: [
+                    v[i*2+j] for i in ind for j in (0, 1)]
+            self._groups.append((m.print_to_mcu_time, sc_list, len(indexes)
+                                 , select, select_pairs))
+    def step_move(self, move_time, move, start_pos, axes_d):
+        for print_to_mcu_time, sc_list, sc_num, select, sp in self._groups:
+            sc_start_pos, sc_axes_d = start_pos, axes_d
+            if select is not None:
+                sc_start_pos, sc_axes_d = select(start_pos), select(axes_d)
+            ret = self._ffi_lib.stepcompress_push_move(
+                sc_list, sc_num, print_to_mcu_time(move_time),
+                sc_start_pos, sc_axes_d, move.move_d,
+                move.accel_r, move.cruise_r, move.decel_r,
+                move.accel_t, move.cruise_t,
+                move.start_v, move.cruise_v, move.accel)
+            if ret:
+                raise error("Internal error in stepcompress")
+    def step_delta_move(self, move_time, move, towers, arm_length2):
+        for print_to_mcu_time, sc_list, sc_num, s, select_pairs in self._groups:
+            sc_towers = towers
+            if select_pairs is not None:
+                sc_towers = select_pairs(towers)
+            ret = self._ffi_lib.stepcompress_push_delta_move(
+                sc_list, sc_num, print_to_mcu_time(move_time),
+                sc_towers, arm_length2, move.start_pos, move.axes_d,
+                move.move_d, move.accel_r, move.cruise_r, move.decel_r,
+                move.accel_t, move.cruise_t,
+                move.start_v, move.cruise_v, move.accel)
+            if ret:
+                raise error("Internal error in stepcompress")
 
 class MCU_endstop:
     error = error
@@ -156,9 +205,12 @@ class MCU_endstop:
         self._next_query_clock = self._home_timeout_clock = 0
         self._retry_query_ticks = 0
         self._last_state = {}
+        self._state_completion = None
         mcu.add_init_callback(self._init_callback)
         self.print_to_mcu_time = mcu.print_to_mcu_time
     def add_stepper(self, stepper):
+        if stepper.get_mcu() is not self._mcu:
+            raise error("Endstop and stepper must be on the same mcu")
         self._steppers.append(stepper)
     def build_config(self):
         self._mcu_freq = self._mcu.get_mcu_freq()
@@ -193,12 +245,25 @@ class MCU_endstop:
             s.note_homing_finalized()
         self._home_timeout_clock = int(mcu_time * self._mcu_freq)
     def home_wait(self):
+        self._wait_state()
+    def _wait_state(self):
         eventtime = self._mcu.monotonic()
-        while self._check_busy(eventtime):
-            eventtime = self._mcu.pause(eventtime + 0.1)
+        while 1:
+            # Create the completion before checking the state so that
+            # a response arriving in between wakes the wait below
+            completion = self._state_completion = self._mcu.completion()
+            if not self._check_busy(eventtime):
+                break
+            completion.wait(eventtime + 0.1)
+            eventtime = self._mcu.monotonic()
+        self._state_completion = None
     def _handle_end_stop_state(self, params):
+        # Called from the background thread
         logging.debug("end_stop_state %s" % (params,))
         self._last_state = params
+        completion = self._state_completion
+        if completion is not None:
+            self._mcu.async_complete(completion, params)
     def _check_busy(self, eventtime):
         # Check if need to send an end_stop_query command
         if self._mcu.is_fileoutput():
@@ -231,10 +296,16 @@ class MCU_endstop:
         self._homing = False
         self._min_query_time = self._mcu.monotonic()
         self._next_query_clock = clock
+        if self._mcu.is_fileoutput():
+            return
+        # Queue the query now - the host serialqueue holds it until
+        # the mcu clock reaches min_clock, so there is no need to wait
+        # for a status message reporting that the clock has been reached
+        self._next_query_clock = clock + self._retry_query_ticks
+        msg = self._query_cmd.encode(self._oid)
+        self._mcu.send(msg, minclock=clock, cq=self._cmd_queue)
     def query_endstop_wait(self):
-        eventtime = self._mcu.monotonic()
-        while self._check_busy(eventtime):
-            eventtime = self._mcu.pause(eventtime + 0.1)
+        self._wait_state()
         return self._last_state.get('pin', self._invert) ^ self._invert
 
 class MCU_digital_out:
@@ -373,8 +444,14 @@ class MCU_adc:
 class MCU:
     error = error
     COMM_TIMEOUT = 3.5
+    SYNC_HORIZON = 2.0
+    MAX_SYNC_ADJUST = 0.000500
     def __init__(self, printer, config):
         self._printer = printer
+        self._section = config.section
+        self._name = self._section
+        if self._name.startswith('mcu '):
+            self._name = self._name[4:]
         # Serial port
         self._serialport = config.get('serial', '/dev/ttyS0')
         if self._serialport.startswith("/dev/rpmsg_"):
@@ -382,11 +459,23 @@ class MCU:
             baud = 0
         else:
             baud = config.getint('baud', 250000, minval=2400)
-        self.serial = serialhdl.SerialReader(
-            printer.reactor, self._serialport, baud)
+        self.serial = printer.get_warm_serial(self._name)
+        self._is_warm = False
+        if self.serial is not None:
+            if (self.serial.serialport == self._serialport
+                and self.serial.baud == baud):
+                self.serial.set_reactor(printer.reactor)
+                self._is_warm = True
+            else:
+                self.serial.disconnect()
+                self.serial = None
+        if self.serial is None:
+            self.serial = serialhdl.SerialReader(
+                printer.reactor, self._serialport, baud)
         self.is_shutdown = False
         self._shutdown_msg = ""
         self._is_fileoutput = False
+        self._is_timeout = False
         self._timeout_timer = printer.reactor.register_timer(
             self.timeout_handler)
         rmethods = {m: m for m in ['arduino', 'command', 'rpi_usb']}
@@ -394,7 +483,7 @@ class MCU:
             'restart_method', rmethods, 'arduino')
         # Config building
         if printer.bglogger is not None:
-            printer.bglogger.set_rollover_info("mcu", None)
+            printer.bglogger.set_rollover_info(self._section, None)
         self._config_error = config.error
         self._emergency_stop_cmd = self._reset_cmd = None
         self._oids = []
@@ -411,6 +500,7 @@ class MCU:
         self._steppersync = None
         # Print time to clock epoch calculations
         self._print_start_time = 0.
+        self._print_scale = 1.
         self._mcu_freq = 0.
         # Stats
         self._stats_sumsq_base = 0.
@@ -428,7 +518,8 @@ class MCU:
             return
         self.is_shutdown = True
         self._shutdown_msg = params['#msg']
-        logging.info("%s: %s" % (params['#name'], self._shutdown_msg))
+        logging.info("MCU '%s' %s: %s" % (
+            self._name, params['#name'], self._shutdown_msg))
         pst = self._print_start_time
         logging.info("Clock last synchronized at %.6f (%d)" % (
             pst, int(pst * self._mcu_freq)))
@@ -443,7 +534,12 @@ class MCU:
         self._printer.reactor.pause(self._printer.reactor.monotonic() + 2.000)
         raise error("Attempt firmware restart failed")
     def connect(self):
-        if not self._is_fileoutput:
+        if self._is_warm:
+            logging.info("Reusing existing connection to mcu '%s'" % (
+                self._name,))
+            self._printer.reactor.update_timer(
+                self._timeout_timer, self.monotonic() + self.COMM_TIMEOUT)
+        elif not self._is_fileoutput:
             if (self._restart_method == 'rpi_usb'
                 and not os.path.exists(self._serialport)):
                 # Try toggling usb power
@@ -479,20 +575,39 @@ class MCU:
         timeout = last_clock_time + self.COMM_TIMEOUT
         if eventtime < timeout:
             return timeout
-        logging.info("Timeout with firmware (eventtime=%f last_status=%f)" % (
-            eventtime, last_clock_time))
-        self._printer.note_mcu_error("Lost communication with firmware")
+        logging.info("Timeout with mcu '%s' (eventtime=%f last_status=%f)" % (
+            self._name, eventtime, last_clock_time))
+        self._is_timeout = True
+        self._printer.note_mcu_error(
+            "Lost communication with mcu '%s'" % (self._name,))
         return self._printer.reactor.NEVER
     def disconnect(self):
-        self.serial.disconnect()
+        if self.serial is not None:
+            self.serial.disconnect()
         if self._steppersync is not None:
             self._ffi_lib.steppersync_free(self._steppersync)
             self._steppersync = None
+    def warm_disconnect(self):
+        # Release the serial connection so that it can be reused by a
+        # host only restart.  Returns None if it can't be reused.
+        if (self._is_fileoutput or self.is_shutdown or self._is_timeout
+            or self._steppersync is None):
+            self.disconnect()
+            return None
+        serial = self.serial
+        self.serial = None
+        self.disconnect()
+        return serial
     def stats(self, eventtime):
-        return "%s mcu_task_avg=%.06f mcu_task_stddev=%.06f" % (
+        msg = "%s mcu_task_avg=%.06f mcu_task_stddev=%.06f" % (
             self.serial.stats(eventtime),
             self._mcu_tick_avg, self._mcu_tick_stddev)
+        if self._name == 'mcu':
+            return msg
+        return ' '.join(["%s:%s" % (self._name, p) for p in msg.split()])
     def force_shutdown(self):
+        if self._emergency_stop_cmd is None:
+            return
         self.send(self._emergency_stop_cmd.encode())
     def microcontroller_restart(self):
         reactor = self._printer.reactor
@@ -522,6 +637,8 @@ class MCU:
         serialhdl.arduino_reset(self._serialport, reactor)
     def is_fileoutput(self):
         return self._is_fileoutput
+    def get_name(self):
+        return self._name
     # Configuration phase
     def _add_custom(self):
         for line in self._custom.split('\n'):
@@ -568,9 +685,10 @@ class MCU:
                 # Only configure mcu after usb power reset
                 self._check_restart("full reset before config")
             # Send config commands
-            logging.info("Sending printer configuration...")
-            for c in self._config_cmds:
-                self.send(self.create_command(c))
+            logging.info("Sending configuration to mcu '%s'..." % (self._name,))
+            starttime = self.monotonic()
+            cmds = [self.create_command(c) for c in self._config_cmds]
+            self.serial.send_multi(cmds)
             if not self._is_fileoutput:
                 config_params = self.serial.send_with_response(msg, 'config')
                 if not config_params['is_config']:
@@ -578,13 +696,17 @@ class MCU:
                         raise error("Firmware error during config: %s" % (
                             self._shutdown_msg,))
                     raise error("Unable to configure printer")
+            logging.info("Sent %d config commands (%d bytes) in %.3fs" % (
+                len(cmds), sum([len(c) for c in cmds])
+                , self.monotonic() - starttime))
         elif self._printer.get_startup_state() == 'firmware_restart':
             raise error("Failed automated reset of micro-controller")
         if self._config_crc != config_params['crc']:
             self._check_restart("CRC mismatch")
             raise error("Printer CRC does not match config")
         move_count = config_params['move_count']
-        logging.info("Configured (%d moves)" % (move_count,))
+        logging.info("Configured mcu '%s' (%d moves)" % (
+            self._name, move_count))
         if self._printer.bglogger is not None:
             msgparser = self.serial.msgparser
             info = [
@@ -593,7 +715,8 @@ class MCU:
                     len(msgparser.messages_by_id), msgparser.version),
                 "MCU config: %s" % (" ".join(
                     ["%s=%s" % (k, v) for k, v in msgparser.config.items()]))]
-            self._printer.bglogger.set_rollover_info("mcu", "\n".join(info))
+            self._printer.bglogger.set_rollover_info(
+                self._section, "\n".join(info))
         stepqueues = tuple(s._stepqueue for s in self._steppers)
         self._steppersync = self._ffi_lib.steppersync_alloc(
             self.serial.serialqueue, stepqueues, len(stepqueues), move_count)
@@ -620,6 +743,8 @@ class MCU:
     # Wrappers for mcu object creation
     def create_stepper(self, step_pin, dir_pin):
         return MCU_stepper(self, step_pin, dir_pin)
+    def create_stepper_group(self, mcu_steppers):
+        return MCU_stepper_group(self, mcu_steppers)
     def create_endstop(self, pin):
         return MCU_endstop(self, pin)
     def create_digital_out(self, pin, max_duration=2.):
@@ -631,7 +756,44 @@ class MCU:
     def create_adc(self, pin):
         return MCU_adc(self, pin)
     # Clock syncing
+    def _is_clock_synced(self):
+        # Secondary mcus follow the main mcu's clock
+        return self._printer.mcu is not self and not self._is_fileoutput
+    def _calc_clock_sync(self):
+        # Map print_time to this mcu's time via the main mcu's time and
+        # the estimated frequency and offset of both mcu clocks
+        main = self._printer.mcu
+        main_freq = main.get_mcu_freq()
+        m_time, m_clock, m_est_clock = main.serial.get_clock_est()
+        s_time, s_clock, s_est_clock = self.serial.get_clock_est()
+        scale = main_freq * s_est_clock / (m_est_clock * self._mcu_freq)
+        main_start_clock = main.print_to_mcu_time(0.) * main_freq
+        start_time = m_time + (main_start_clock - m_clock) / m_est_clock
+        start_clock = s_clock + (start_time - s_time) * s_est_clock
+        return scale, start_clock / self._mcu_freq
+    def _sync_print_time(self, print_time):
+        # Steer the mapping towards the current clock estimates while
+        # keeping it continuous at print_time (events up to print_time
+        # may already be queued)
+        scale, offset = self._calc_clock_sync()
+        mcu_time = self.print_to_mcu_time(print_time)
+        adjust = (print_time * scale + offset - mcu_time) / self.SYNC_HORIZON
+        scale += max(-self.MAX_SYNC_ADJUST, min(self.MAX_SYNC_ADJUST, adjust))
+        self._set_print_scale(scale)
+        self._print_start_time = mcu_time - print_time * scale
+    def _set_print_scale(self, scale):
+        # Step times within a move must use the same scale as the move
+        # start times (or consecutive moves may overlap)
+        self._print_scale = scale
+        for s in self._steppers:
+            s.set_time_scale(scale)
     def set_print_start_time(self, eventtime):
+        if self._is_clock_synced():
+            scale, self._print_start_time = self._calc_clock_sync()
+            self._set_print_scale(scale)
+            logging.debug("Synchronizing mcu '%s' to main mcu (scale=%.9f)" % (
+                self._name, self._print_scale))
+            return
         clock = self.serial.get_clock(eventtime)
         logging.debug("Synchronizing mcu clock at %.6f to %d" % (
             eventtime, clock))
@@ -640,11 +802,11 @@ class MCU:
     def get_print_buffer_time(self, eventtime, print_time):
         if self.is_shutdown:
             return 0.
-        mcu_time = print_time + self._print_start_time
+        mcu_time = self.print_to_mcu_time(print_time)
         est_mcu_time = self.serial.get_clock(eventtime) / self._mcu_freq
         return mcu_time - est_mcu_time
     def print_to_mcu_time(self, print_time):
-        return print_time + self._print_start_time
+        return print_time * self._print_scale + self._print_start_time
     def get_mcu_freq(self):
         return self._mcu_freq
     def get_last_clock(self):
@@ -654,16 +816,21 @@ class MCU:
     # Move command queuing
     def send(self, cmd, minclock=0, reqclock=0, cq=None):
         self.serial.send(cmd, minclock, reqclock, cq=cq)
-    def flush_moves(self, print_time):
+    def flush_moves(self, print_time, last_print_time):
+        if last_print_time and self._is_clock_synced():
+            self._sync_print_time(last_print_time)
         if self._steppersync is None:
             return
-        mcu_time = print_time + self._print_start_time
-        clock = int(mcu_time * self._mcu_freq)
+        clock = int(self.print_to_mcu_time(print_time) * self._mcu_freq)
         ret = self._ffi_lib.steppersync_flush(self._steppersync, clock)
         if ret:
             raise error("Internal error in stepcompress")
     def pause(self, waketime):
         return self._printer.reactor.pause(waketime)
+    def completion(self):
+        return self._printer.reactor.completion()
+    def async_complete(self, completion, result):
+        self._printer.reactor.async_complete(completion, result)
     def monotonic(self):
         return self._printer.reactor.monotonic()
     def __del__(self):
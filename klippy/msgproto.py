@@ -22,20 +22,35 @@ MESSAGE_PAYLOAD_MAX = MESSAGE_MAX - MESSAGE_MIN
 MESSAGE_SEQ_MASK = 0x0f
 MESSAGE_DEST = 0x10
 MESSAGE_SYNC = '\x7E'
+MESSAGE_SYNC_BYTE = 0x7E
 
 class error(Exception):
     pass
 
-def crc16_ccitt(buf):
-    crc = 0xffff
-    for data in buf:
-        data = ord(data)
-        data ^= crc & 0xff
+# The crc16 used by the firmware processes one byte at a time (see
+# crc16_ccitt() in src/generic/crc16_ccitt.c) - precompute the effect
+# of each byte value on the crc so it can be applied with one lookup.
+def _build_crc16_table():
+    table = []
+    for data in range(256):
         data ^= (data & 0x0f) << 4
-        crc = ((data << 8) | (crc >> 8)) ^ (data >> 4) ^ (data << 3)
-    crc = chr(crc >> 8) + chr(crc & 0xff)
+        table.append(((data << 8) ^ (data >> 4) ^ (data << 3)) & 0xffff)
+    return table
+CRC16_TABLE = _build_crc16_table()
+
+# Return the crc of the first 'count' bytes of a bytearray
+def _crc16(data, count):
+    crc = 0xffff
+    table = CRC16_TABLE
+    for c in data[:count]:
+        crc = (crc >> 8) ^ table[(crc ^ c) & 0xff]
     return crc
 
+def crc16_ccitt(buf):
+    data = bytearray(buf)
+    crc = _crc16(data, len(data))
+    return chr(crc >> 8) + chr(crc & 0xff)
+
 class PT_uint32:
     is_int = 1
     max_length = 5
@@ -97,6 +112,66 @@ def convert_msg_format(msgformat):
     mf = mf.replace('%.*s', '%s').replace('%*s', '%s')
     return mf
 
+# Generate python source that encodes/parses a list of parameters.
+# The generated code performs the same operations (in the same
+# order) as the PT_xxx encode() and parse() methods.
+def _gen_encode_param(out, v, t):
+    if not t.is_int:
+        out.append("    out.append(len(%s))" % (v,))
+        out.append("    out.extend(bytearray(%s))" % (v,))
+        return
+    indent = "    "
+    for limit, neg_limit in [(0x60, 0x20), (0x3000, 0x1000)
+                             , (0x180000, 0x80000), (0xc000000, 0x4000000)]:
+        out.append("%sif %s >= %#x or %s < -%#x:" % (
+            indent, v, limit, v, neg_limit))
+        indent += "    "
+    for shift in [28, 21, 14, 7]:
+        out.append("%sout.append((%s>>%d) & 0x7f | 0x80)" % (indent, v, shift))
+        indent = indent[:-4]
+    out.append("%sout.append(%s & 0x7f)" % (indent, v))
+
+def _gen_parse_param(out, v, t):
+    if not t.is_int:
+        out.append("    l = s[pos]")
+        out.append("    %s = str(bytearray(s[pos+1:pos+l+1]))" % (v,))
+        out.append("    pos += l+1")
+        return
+    out.append("    c = s[pos]")
+    out.append("    pos += 1")
+    out.append("    %s = c & 0x7f" % (v,))
+    out.append("    if (c & 0x60) == 0x60:")
+    out.append("        %s |= -0x20" % (v,))
+    out.append("    while c & 0x80:")
+    out.append("        c = s[pos]")
+    out.append("        pos += 1")
+    out.append("        %s = (%s<<7) | (c & 0x7f)" % (v, v))
+    if not t.signed:
+        out.append("    %s = int(%s & 0xffffffff)" % (v, v))
+
+def _compile_message(msgid, param_names):
+    args = ["v%d" % (i,) for i in range(len(param_names))]
+    keys = ["k%d" % (i,) for i in range(len(param_names))]
+    out = ["def encode(%s):" % (", ".join(args),)
+           , "    out = [%d]" % (msgid,)]
+    for v, (name, t) in zip(args, param_names):
+        _gen_encode_param(out, v, t)
+    out.append("    return out")
+    out.append("def encode_by_name(**params):")
+    out.append("    return encode(%s)" % (
+        ", ".join(["params[%s]" % (k,) for k in keys]),))
+    out.append("def parse(s, pos):")
+    out.append("    pos += 1")
+    for v, (name, t) in zip(args, param_names):
+        _gen_parse_param(out, v, t)
+    out.append("    return {%s}, pos" % (
+        ", ".join(["%s: %s" % (k, v) for k, v in zip(keys, args)]),))
+    # Parameter names are passed in so the parsed dictionaries use
+    # the same key objects as the generic code
+    namespace = { k: name for k, (name, t) in zip(keys, param_names) }
+    exec "\n".join(out) in namespace
+    return namespace['encode'], namespace['encode_by_name'], namespace['parse']
+
 class MessageFormat:
     def __init__(self, msgid, msgformat):
         self.msgid = msgid
@@ -108,6 +183,10 @@ class MessageFormat:
         self.param_types = [MessageTypes[fmt] for name, fmt in argparts]
         self.param_names = [(name, MessageTypes[fmt]) for name, fmt in argparts]
         self.name_to_type = dict(self.param_names)
+        # Replace the generic encode/parse methods with versions
+        # specialized for this message format
+        self.encode, self.encode_by_name, self.parse = _compile_message(
+            msgid, self.param_names)
     def encode(self, *params):
         out = []
         out.append(self.msgid)
@@ -190,24 +269,28 @@ class MessageParser:
         self.version = ""
         self.raw_identify_data = ""
         self._init_messages(DefaultMessages, DefaultMessages.keys())
+    # Check for a valid message at the start of 's' (a str, bytearray,
+    # buffer, or memoryview).  Only the message itself is copied.
     def check_packet(self, s):
         if len(s) < MESSAGE_MIN:
             return 0
-        msglen = ord(s[MESSAGE_POS_LEN])
+        msg = bytearray(s[:MESSAGE_MAX])
+        msglen = msg[MESSAGE_POS_LEN]
         if msglen < MESSAGE_MIN or msglen > MESSAGE_MAX:
             return -1
-        msgseq = ord(s[MESSAGE_POS_SEQ])
+        msgseq = msg[MESSAGE_POS_SEQ]
         if (msgseq & ~MESSAGE_SEQ_MASK) != MESSAGE_DEST:
             return -1
-        if len(s) < msglen:
+        if len(msg) < msglen:
             # Need more data
             return 0
-        if s[msglen-MESSAGE_TRAILER_SYNC] != MESSAGE_SYNC:
+        if msg[msglen-MESSAGE_TRAILER_SYNC] != MESSAGE_SYNC_BYTE:
             return -1
-        msgcrc = s[msglen-MESSAGE_TRAILER_CRC:msglen-MESSAGE_TRAILER_CRC+2]
-        crc = crc16_ccitt(s[:msglen-MESSAGE_TRAILER_SIZE])
+        msgcrc = ((msg[msglen-MESSAGE_TRAILER_CRC] << 8)
+                  | msg[msglen-MESSAGE_TRAILER_CRC+1])
+        crc = _crc16(msg, msglen-MESSAGE_TRAILER_SIZE)
         if crc != msgcrc:
-            #logging.debug("got crc %s vs %s" % (repr(crc), repr(msgcrc)))
+            #logging.debug("got crc %04x vs %04x" % (crc, msgcrc))
             return -1
         return msglen
     def dump(self, s):
@@ -244,11 +327,15 @@ class MessageParser:
         return params
     def encode(self, seq, cmd):
         msglen = MESSAGE_MIN + len(cmd)
-        seq = (seq & MESSAGE_SEQ_MASK) | MESSAGE_DEST
-        out = [chr(msglen), chr(seq), cmd]
-        out.append(crc16_ccitt(''.join(out)))
-        out.append(MESSAGE_SYNC)
-        return ''.join(out)
+        out = bytearray(msglen)
+        out[MESSAGE_POS_LEN] = msglen
+        out[MESSAGE_POS_SEQ] = (seq & MESSAGE_SEQ_MASK) | MESSAGE_DEST
+        out[MESSAGE_HEADER_SIZE:msglen-MESSAGE_TRAILER_SIZE] = cmd
+        crc = _crc16(out, msglen-MESSAGE_TRAILER_SIZE)
+        out[msglen-MESSAGE_TRAILER_CRC] = crc >> 8
+        out[msglen-MESSAGE_TRAILER_CRC+1] = crc & 0xff
+        out[msglen-MESSAGE_TRAILER_SYNC] = MESSAGE_SYNC_BYTE
+        return str(out)
     def _parse_buffer(self, value):
         tval = int(value, 16)
         out = []
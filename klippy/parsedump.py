@@ -23,23 +23,27 @@ def main():
 
     f = open(data_filename, 'rb')
     fd = f.fileno()
-    data = ""
+    data = bytearray()
     while 1:
         newdata = os.read(fd, 4096)
         if not newdata:
             break
-        data += newdata
+        data.extend(newdata)
+        view = memoryview(data)
+        pos = 0
         while 1:
-            l = mp.check_packet(data)
+            l = mp.check_packet(view[pos:])
             if l == 0:
                 break
             if l < 0:
                 logging.error("Invalid data")
-                data = data[-l:]
+                pos += -l
                 continue
-            msgs = mp.dump(bytearray(data[:l]))
+            msgs = mp.dump(data[pos:pos+l])
             sys.stdout.write('\n'.join(msgs[1:]) + '\n')
-            data = data[l:]
+            pos += l
+        del view
+        del data[:pos]
 
 if __name__ == '__main__':
     main()
@@ -154,6 +154,16 @@ def get_pin_map(mcu, mapping_name=None):
         update_map_beaglebone(pins, mcu)
     return pins
 
+# Split an optional "mcu_name:" prefix from a pin description.
+# Returns the mcu name (or None) and the pin description without it.
+def split_mcu_name(pin):
+    desc = pin.lstrip('^! ')
+    extras = pin[:len(pin)-len(desc)]
+    name, sep, desc = desc.partition(':')
+    if not sep:
+        return None, pin
+    return name.strip(), extras + desc.strip()
+
 # Translate pin names and tick times in a firmware command
 re_pin = re.compile(r'(?P<prefix>[ _]pin=)(?P<name>[^ ]*)')
 re_ticks = re.compile(r'TICKS\((?P<ticks>[^)]*)\)')
@@ -3,73 +3,231 @@
 # Copyright (C) 2016,2017  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import select, math, time
+import sys, os, errno, select, math, time, heapq, collections
+import logging, threading, traceback
 import greenlet
-import chelper
+import chelper, util
+
+_NOW = 0.
+_NEVER = 9999999999999999.
 
 class ReactorTimer:
     def __init__(self, callback, waketime):
         self.callback = callback
         self.waketime = waketime
+        self.heap_entry = None
+        self.is_registered = True
 
 class ReactorFileHandler:
-    def __init__(self, fd, callback):
+    def __init__(self, fd, read_callback, write_callback):
         self.fd = fd
-        self.callback = callback
+        self.read_callback = read_callback
+        self.write_callback = write_callback
     def fileno(self):
         return self.fd
 
+# Optional tracking of the time spent in each timer and fd callback
+class ReactorStats:
+    BUCKET_TIME = 0.000016
+    BUCKETS = 17
+    def __init__(self, reactor, slow_time):
+        self.monotonic = reactor.monotonic
+        self.slow_time = slow_time
+        self.histograms = {}
+        self.current = None
+        self.main_thread = threading.current_thread().ident
+        # Background thread that logs the stack of slow callbacks
+        self.is_active = True
+        self.watchdog = threading.Thread(target=self._watchdog)
+        self.watchdog.daemon = True
+        self.watchdog.start()
+    def stop(self):
+        self.is_active = False
+    def _watchdog(self):
+        reported = None
+        while self.is_active:
+            time.sleep(self.slow_time * .5)
+            current = self.current
+            if current is None or current is reported:
+                continue
+            name, starttime, runtime = current
+            runtime += self.monotonic() - starttime
+            if runtime < self.slow_time:
+                continue
+            reported = current
+            frame = sys._current_frames().get(self.main_thread)
+            if frame is None:
+                continue
+            logging.warning("Reactor callback %s running for %.3fs:\n%s" % (
+                name, runtime, "".join(traceback.format_stack(frame))))
+    def _get_name(self, callback):
+        name = getattr(callback, '__name__', None) or repr(callback)
+        obj = getattr(callback, '__self__', None)
+        if obj is not None:
+            name = "%s.%s" % (obj.__class__.__name__, name)
+        return name
+    def start_callback(self, name, runtime=0.):
+        self.current = (name, self.monotonic(), runtime)
+    def pause_callback(self):
+        current = self.current
+        if current is None:
+            return None
+        self.current = None
+        name, starttime, runtime = current
+        return name, runtime + self.monotonic() - starttime
+    def stop_callback(self):
+        paused = self.pause_callback()
+        if paused is None:
+            return
+        name, runtime = paused
+        hist = self.histograms.get(name)
+        if hist is None:
+            hist = self.histograms[name] = [0, 0., 0.] + [0] * self.BUCKETS
+        hist[0] += 1
+        hist[1] += runtime
+        hist[2] = max(hist[2], runtime)
+        bucket = max(0, math.frexp(runtime / self.BUCKET_TIME)[1])
+        hist[3 + min(bucket, self.BUCKETS - 1)] += 1
+        if runtime >= self.slow_time:
+            logging.warning("Reactor callback %s took %.3fs" % (name, runtime))
+    def call(self, callback, eventtime):
+        self.start_callback(self._get_name(callback))
+        try:
+            return callback(eventtime)
+        finally:
+            self.stop_callback()
+    def get_report(self):
+        out = []
+        for name, hist in sorted(self.histograms.items(),
+                                 key=(lambda i: -i[1][1])):
+            count, total, maxtime = hist[:3]
+            buckets = ["<%dus:%d" % (self.BUCKET_TIME * 1000000. * 2**i, c)
+                       for i, c in enumerate(hist[3:-1]) if c]
+            if hist[-1]:
+                buckets.append("more:%d" % (hist[-1],))
+            out.append("%s: count=%d avg=%.3fms max=%.3fms %s" % (
+                name, count, total * 1000. / count, maxtime * 1000.,
+                " ".join(buckets)))
+        return "\n".join(out)
+
+# Result of an operation that a greenlet may wait on
+class ReactorCompletion:
+    class sentinel: pass
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.result = self.sentinel
+        self.waiting = None
+    def test(self):
+        return self.result is not self.sentinel
+    def complete(self, result):
+        self.result = result
+        timer = getattr(self.waiting, 'timer', None)
+        if timer is not None:
+            self.reactor.update_timer(timer, self.reactor.NOW)
+    def wait(self, waketime=_NEVER, waketime_result=None):
+        if self.result is self.sentinel:
+            self.waiting = greenlet.getcurrent()
+            self.reactor.pause(waketime)
+            self.waiting = None
+            if self.result is self.sentinel:
+                return waketime_result
+        return self.result
+
 class ReactorGreenlet(greenlet.greenlet):
     def __init__(self, run):
         greenlet.greenlet.__init__(self, run=run)
         self.timer = None
 
 class SelectReactor:
-    NOW = 0.
-    NEVER = 9999999999999999.
+    NOW = _NOW
+    NEVER = _NEVER
     def __init__(self):
-        self._fds = []
-        self._timers = []
-        self._next_timer = self.NEVER
+        self._read_fds = []
+        self._write_fds = []
+        self._timer_heap = []
+        self._timer_seq = 0
+        self._invalid_timers = 0
         self._process = False
         self._g_dispatch = None
         self._greenlets = []
+        self._stats = None
+        self._async_queue = collections.deque()
+        self._pipe_fds = self._pipe_handler = None
         self.monotonic = chelper.get_ffi()[1].get_monotonic
     # Timers
-    def _note_time(self, t):
-        nexttime = t.waketime
-        if nexttime < self._next_timer:
-            self._next_timer = nexttime
+    #
+    # Pending timers are stored in a heap of [waketime, seq, timer]
+    # entries.  Changing a timer marks its old entry as invalid (by
+    # clearing the timer field) and pushes a new one.  Invalid entries
+    # are discarded when they reach the top of the heap, and the heap
+    # is rebuilt if they make up more than half of it.
+    def _push_timer(self, t):
+        if not t.is_registered or t.waketime >= self.NEVER:
+            return
+        entry = [t.waketime, self._timer_seq, t]
+        self._timer_seq += 1
+        t.heap_entry = entry
+        heapq.heappush(self._timer_heap, entry)
+    def _invalidate_timer(self, t):
+        entry = t.heap_entry
+        if entry is None:
+            return
+        entry[2] = t.heap_entry = None
+        self._invalid_timers += 1
+        heap = self._timer_heap
+        if self._invalid_timers > 64 and self._invalid_timers * 2 > len(heap):
+            heap[:] = [e for e in heap if e[2] is not None]
+            heapq.heapify(heap)
+            self._invalid_timers = 0
     def update_timer(self, t, nexttime):
+        self._invalidate_timer(t)
         t.waketime = nexttime
-        self._note_time(t)
+        self._push_timer(t)
     def register_timer(self, callback, waketime = NEVER):
         handler = ReactorTimer(callback, waketime)
-        timers = list(self._timers)
-        timers.append(handler)
-        self._timers = timers
-        self._note_time(handler)
+        self._push_timer(handler)
         return handler
     def unregister_timer(self, handler):
-        timers = list(self._timers)
-        timers.pop(timers.index(handler))
-        self._timers = timers
+        self._invalidate_timer(handler)
+        handler.is_registered = False
     def _check_timers(self, eventtime):
-        if eventtime < self._next_timer:
-            return min(1., max(.001, self._next_timer - eventtime))
-        self._next_timer = self.NEVER
+        heap = self._timer_heap
         g_dispatch = self._g_dispatch
-        for t in self._timers:
-            if eventtime >= t.waketime:
-                t.waketime = self.NEVER
-                t.waketime = t.callback(eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._end_greenlet(g_dispatch)
-                    return 0.
-            self._note_time(t)
-        if eventtime >= self._next_timer:
+        seq_limit = self._timer_seq
+        did_callback = False
+        while heap and eventtime >= heap[0][0]:
+            entry = heap[0]
+            t = entry[2]
+            if t is None:
+                heapq.heappop(heap)
+                self._invalid_timers -= 1
+                continue
+            if entry[1] >= seq_limit:
+                # Timer was rearmed during this pass - run it on the next
+                break
+            heapq.heappop(heap)
+            t.heap_entry = None
+            t.waketime = self.NEVER
+            if self._stats is None:
+                nexttime = t.callback(eventtime)
+            else:
+                nexttime = self._stats.call(t.callback, eventtime)
+            self.update_timer(t, nexttime)
+            did_callback = True
+            if g_dispatch is not self._g_dispatch:
+                self._end_greenlet(g_dispatch)
+                return 0.
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+            self._invalid_timers -= 1
+        if not heap:
+            return 1.
+        nexttime = heap[0][0]
+        if eventtime >= nexttime:
             return 0.
-        return min(1., max(.001, self._next_timer - self.monotonic()))
+        if did_callback:
+            eventtime = self.monotonic()
+        return min(1., max(.001, nexttime - eventtime))
     # Greenlets
     def _sys_pause(self, waketime):
         # Pause using system sleep for when reactor not running
@@ -78,6 +236,16 @@ class SelectReactor:
             time.sleep(delay)
         return self.monotonic()
     def pause(self, waketime):
+        stats = self._stats
+        if stats is not None:
+            # Don't count the time spent paused against the callback
+            paused = stats.pause_callback()
+            eventtime = self._pause(waketime)
+            if paused is not None and self._stats is stats:
+                stats.start_callback(*paused)
+            return eventtime
+        return self._pause(waketime)
+    def _pause(self, waketime):
         g = greenlet.getcurrent()
         if g is not self._g_dispatch:
             if self._g_dispatch is None:
@@ -97,31 +265,110 @@ class SelectReactor:
         self._g_dispatch.switch(self.NEVER)
         self._g_dispatch = g_old
     # File descriptors
-    def register_fd(self, fd, callback):
-        handler = ReactorFileHandler(fd, callback)
-        self._fds.append(handler)
+    def register_fd(self, fd, read_callback, write_callback=None):
+        handler = ReactorFileHandler(fd, read_callback, write_callback)
+        self.set_fd_wake(handler, True, False)
         return handler
     def unregister_fd(self, handler):
-        self._fds.pop(self._fds.index(handler))
+        if handler in self._read_fds:
+            self._read_fds.pop(self._read_fds.index(handler))
+        if handler in self._write_fds:
+            self._write_fds.pop(self._write_fds.index(handler))
+    def set_fd_wake(self, handler, is_readable=True, is_writeable=False):
+        if handler in self._read_fds:
+            if not is_readable:
+                self._read_fds.pop(self._read_fds.index(handler))
+        elif is_readable:
+            self._read_fds.append(handler)
+        if handler in self._write_fds:
+            if not is_writeable:
+                self._write_fds.pop(self._write_fds.index(handler))
+        elif is_writeable:
+            self._write_fds.append(handler)
+    # Completions
+    def completion(self):
+        return ReactorCompletion(self)
+    def async_complete(self, completion, result):
+        # May be called from any thread - the completion is run from
+        # the reactor after it is woken via the pipe
+        self._async_queue.append((completion, result))
+        pipe_fds = self._pipe_fds
+        if pipe_fds is not None:
+            try:
+                os.write(pipe_fds[1], '.')
+            except OSError:
+                pass
+    def _got_pipe_signal(self, eventtime):
+        try:
+            os.read(self._pipe_fds[0], 4096)
+        except OSError:
+            pass
+        while self._async_queue:
+            completion, result = self._async_queue.popleft()
+            completion.complete(result)
+    def _setup_async_callbacks(self):
+        if self._pipe_fds is not None:
+            return
+        pipe_fds = os.pipe()
+        for fd in pipe_fds:
+            util.set_nonblock(fd)
+        self._pipe_handler = self.register_fd(
+            pipe_fds[0], self._got_pipe_signal)
+        self._pipe_fds = pipe_fds
+        if self._async_queue:
+            os.write(pipe_fds[1], '.')
+    def finalize(self):
+        if self._pipe_fds is not None:
+            self.unregister_fd(self._pipe_handler)
+            for fd in self._pipe_fds:
+                os.close(fd)
+            self._pipe_fds = self._pipe_handler = None
+    # Callback statistics
+    def enable_stats(self, slow_time):
+        self.disable_stats()
+        self._stats = ReactorStats(self, slow_time)
+    def disable_stats(self):
+        if self._stats is not None:
+            self._stats.stop()
+            self._stats = None
+    def get_stats(self):
+        if self._stats is None:
+            return None
+        return self._stats.get_report()
     # Main loop
     def _dispatch_loop(self):
         self._g_dispatch = g_dispatch = greenlet.getcurrent()
         eventtime = self.monotonic()
         while self._process:
             timeout = self._check_timers(eventtime)
-            res = select.select(self._fds, [], [], timeout)
+            res = select.select(self._read_fds, self._write_fds, [], timeout)
             eventtime = self.monotonic()
             for fd in res[0]:
-                fd.callback(eventtime)
+                if self._stats is None:
+                    fd.read_callback(eventtime)
+                else:
+                    self._stats.call(fd.read_callback, eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
                     break
+            else:
+                for fd in res[1]:
+                    if self._stats is None:
+                        fd.write_callback(eventtime)
+                    else:
+                        self._stats.call(fd.write_callback, eventtime)
+                    if g_dispatch is not self._g_dispatch:
+                        self._end_greenlet(g_dispatch)
+                        eventtime = self.monotonic()
+                        break
         self._g_dispatch = None
     def run(self):
+        self._setup_async_callbacks()
         self._process = True
         g_next = ReactorGreenlet(run=self._dispatch_loop)
         g_next.switch()
+        self.disable_stats()
     def end(self):
         self._process = False
 
@@ -131,18 +378,21 @@ class PollReactor(SelectReactor):
         self._poll = select.poll()
         self._fds = {}
     # File descriptors
-    def register_fd(self, fd, callback):
-        handler = ReactorFileHandler(fd, callback)
-        fds = self._fds.copy()
-        fds[fd] = callback
-        self._fds = fds
+    def register_fd(self, fd, read_callback, write_callback=None):
+        handler = ReactorFileHandler(fd, read_callback, write_callback)
+        self._fds[fd] = handler
         self._poll.register(handler, select.POLLIN | select.POLLHUP)
         return handler
     def unregister_fd(self, handler):
         self._poll.unregister(handler)
-        fds = self._fds.copy()
-        del fds[handler.fd]
-        self._fds = fds
+        del self._fds[handler.fd]
+    def set_fd_wake(self, handler, is_readable=True, is_writeable=False):
+        flags = select.POLLHUP
+        if is_readable:
+            flags |= select.POLLIN
+        if is_writeable:
+            flags |= select.POLLOUT
+        self._poll.modify(handler, flags)
     # Main loop
     def _dispatch_loop(self):
         self._g_dispatch = g_dispatch = greenlet.getcurrent()
@@ -152,11 +402,26 @@ class PollReactor(SelectReactor):
             res = self._poll.poll(int(math.ceil(timeout * 1000.)))
             eventtime = self.monotonic()
             for fd, event in res:
-                self._fds[fd](eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._end_greenlet(g_dispatch)
-                    eventtime = self.monotonic()
-                    break
+                if event & (select.POLLIN | select.POLLHUP):
+                    callback = self._fds[fd].read_callback
+                    if self._stats is None:
+                        callback(eventtime)
+                    else:
+                        self._stats.call(callback, eventtime)
+                    if g_dispatch is not self._g_dispatch:
+                        self._end_greenlet(g_dispatch)
+                        eventtime = self.monotonic()
+                        break
+                if event & select.POLLOUT:
+                    callback = self._fds[fd].write_callback
+                    if self._stats is None:
+                        callback(eventtime)
+                    else:
+                        self._stats.call(callback, eventtime)
+                    if g_dispatch is not self._g_dispatch:
+                        self._end_greenlet(g_dispatch)
+                        eventtime = self.monotonic()
+                        break
         self._g_dispatch = None
 
 class EPollReactor(SelectReactor):
@@ -164,38 +429,84 @@ class EPollReactor(SelectReactor):
         SelectReactor.__init__(self)
         self._epoll = select.epoll()
         self._fds = {}
+        self._file_fds = {}
     # File descriptors
-    def register_fd(self, fd, callback):
-        handler = ReactorFileHandler(fd, callback)
-        fds = self._fds.copy()
-        fds[fd] = callback
-        self._fds = fds
-        self._epoll.register(fd, select.EPOLLIN | select.EPOLLHUP)
+    def register_fd(self, fd, read_callback, write_callback=None):
+        handler = ReactorFileHandler(fd, read_callback, write_callback)
+        try:
+            self._epoll.register(fd, select.EPOLLIN | select.EPOLLHUP)
+        except IOError as e:
+            if e.errno != errno.EPERM:
+                raise
+            # Regular files can't be used with epoll - as with poll
+            # they are always reported as ready
+            self._file_fds[fd] = select.EPOLLIN
+        self._fds[fd] = handler
         return handler
     def unregister_fd(self, handler):
-        self._epoll.unregister(handler.fd)
-        fds = self._fds.copy()
-        del fds[handler.fd]
-        self._fds = fds
+        if handler.fd in self._file_fds:
+            del self._file_fds[handler.fd]
+        else:
+            self._epoll.unregister(handler.fd)
+        del self._fds[handler.fd]
+    def set_fd_wake(self, handler, is_readable=True, is_writeable=False):
+        flags = select.EPOLLHUP
+        if is_readable:
+            flags |= select.EPOLLIN
+        if is_writeable:
+            flags |= select.EPOLLOUT
+        if handler.fd in self._file_fds:
+            self._file_fds[handler.fd] = flags & ~select.EPOLLHUP
+            return
+        self._epoll.modify(handler.fd, flags)
     # Main loop
+    def _poll_files(self, timeout):
+        ready = [(fd, ev) for fd, ev in self._file_fds.items() if ev]
+        if ready:
+            timeout = 0.
+        res = self._epoll.poll(timeout)
+        res.extend(ready)
+        return res
     def _dispatch_loop(self):
         self._g_dispatch = g_dispatch = greenlet.getcurrent()
         eventtime = self.monotonic()
         while self._process:
             timeout = self._check_timers(eventtime)
-            res = self._epoll.poll(timeout)
+            if self._file_fds:
+                res = self._poll_files(timeout)
+            else:
+                res = self._epoll.poll(timeout)
             eventtime = self.monotonic()
             for fd, event in res:
-                self._fds[fd](eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._end_greenlet(g_dispatch)
-                    eventtime = self.monotonic()
-                    break
+                if event & (select.EPOLLIN | select.EPOLLHUP):
+                    callback = self._fds[fd].read_callback
+                    if self._stats is None:
+                        callback(eventtime)
+                    else:
+                        self._stats.call(callback, eventtime)
+                    if g_dispatch is not self._g_dispatch:
+                        self._end_greenlet(g_dispatch)
+                        eventtime = self.monotonic()
+                        break
+                if event & select.EPOLLOUT:
+                    callback = self._fds[fd].write_callback
+                    if self._stats is None:
+                        callback(eventtime)
+                    else:
+                        self._stats.call(callback, eventtime)
+                    if g_dispatch is not self._g_dispatch:
+                        self._end_greenlet(g_dispatch)
+                        eventtime = self.monotonic()
+                        break
         self._g_dispatch = None
 
-# Use the poll based reactor if it is available
+# Use the epoll based reactor if it is available
 try:
-    select.poll
-    Reactor = PollReactor
+    select.epoll
+    Reactor = EPollReactor
 except:
-    Reactor = SelectReactor
+    try:
+        select.poll
+        Reactor = PollReactor
+    except:
+        Reactor = SelectReactor
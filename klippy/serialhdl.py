@@ -3,7 +3,7 @@
 # Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading
+import os, logging, threading, struct, zlib, math
 import serial
 
 import msgproto, chelper, util
@@ -13,6 +13,7 @@ class error(Exception):
 
 class SerialReader:
     BITS_PER_BYTE = 10.
+    PULL_BATCH = 32
     def __init__(self, reactor, serialport, baud):
         self.reactor = reactor
         self.serialport = serialport
@@ -25,39 +26,54 @@ class SerialReader:
         self.serialqueue = None
         self.default_cmd_queue = self.alloc_command_queue()
         self.stats_buf = self.ffi_main.new('char[4096]')
-        # MCU time/clock tracking
-        self.last_ack_time = self.last_ack_rtt_time = 0.
-        self.last_ack_clock = self.last_ack_rtt_clock = 0
-        self.est_clock = 0.
+        # MCU time/clock tracking.  The clock state is published as an
+        # immutable (ref_time, ref_clock, est_clock, last_ack_time,
+        # last_ack_clock) tuple that is replaced (under self.lock) on
+        # each update, so readers don't need to take the lock.
+        self.clock_state = (0., 0., 0., 0., 0)
+        self.clock_regression = ClockRegression()
         # Threading
         self.lock = threading.Lock()
         self.background_thread = None
         # Message handlers
         self.status_timer = self.reactor.register_timer(self._status_event)
         self.status_cmd = None
+        self.handlers = {}
+        self._reset_handlers()
+    def _reset_handlers(self):
         handlers = {
             '#unknown': self.handle_unknown,
             '#output': self.handle_output, 'status': self.handle_status,
             'shutdown': self.handle_output, 'is_shutdown': self.handle_output
         }
-        self.handlers = { (k, None): v for k, v in handlers.items() }
+        with self.lock:
+            self.handlers = { (k, None): v for k, v in handlers.items() }
     def _bg_thread(self):
-        response = self.ffi_main.new('struct pull_queue_message *')
+        ffi_main = self.ffi_main
+        responses = ffi_main.new(
+            'struct pull_queue_message[%d]' % (self.PULL_BATCH,))
+        msg_size = ffi_main.sizeof('struct pull_queue_message')
+        msg_offset = ffi_main.offsetof('struct pull_queue_message', 'msg')
         while 1:
-            self.ffi_lib.serialqueue_pull(self.serialqueue, response)
-            count = response.len
+            count = self.ffi_lib.serialqueue_pull_batch(
+                self.serialqueue, responses, self.PULL_BATCH)
             if count <= 0:
                 break
-            params = self.msgparser.parse(response.msg[0:count])
-            params['#sent_time'] = response.sent_time
-            params['#receive_time'] = response.receive_time
-            with self.lock:
-                hdl = (params['#name'], params.get('oid'))
-                hdl = self.handlers.get(hdl, self.handle_default)
-            try:
-                hdl(params)
-            except:
-                logging.exception("Exception in serial callback")
+            # Copy all the message data with a single buffer view
+            data = bytearray(ffi_main.buffer(responses, count * msg_size))
+            for i in range(count):
+                response = responses[i]
+                pos = i * msg_size + msg_offset
+                params = self.msgparser.parse(data[pos:pos+response.len])
+                params['#sent_time'] = response.sent_time
+                params['#receive_time'] = response.receive_time
+                with self.lock:
+                    hdl = (params['#name'], params.get('oid'))
+                    hdl = self.handlers.get(hdl, self.handle_default)
+                try:
+                    hdl(params)
+                except:
+                    logging.exception("Exception in serial callback")
     def connect(self):
         # Initial connection
         logging.info("Starting serial connect")
@@ -86,6 +102,9 @@ class SerialReader:
                 logging.warn("Timeout on serial connect")
                 self.disconnect()
                 continue
+            logging.info("Obtained data dictionary (%d bytes) from %s in %.3fs"
+                         % (len(identify_data), sbs.get_source()
+                            , self.reactor.monotonic() - starttime))
             break
         msgparser = msgproto.MessageParser()
         msgparser.process_identify(identify_data)
@@ -108,11 +127,13 @@ class SerialReader:
         # Load initial last_ack_clock/last_ack_time
         uptime_msg = msgparser.create_command('get_uptime')
         params = self.send_with_response(uptime_msg, 'uptime')
-        self.last_ack_clock = (params['high'] << 32) | params['clock']
-        self.last_ack_time = params['#receive_time']
+        with self.lock:
+            self._update_clock(
+                params['#sent_time'], params['#receive_time']
+                , (params['high'] << 32) | params['clock'])
         # Make sure est_clock is calculated
         starttime = eventtime = self.reactor.monotonic()
-        while not self.est_clock:
+        while not self.clock_state[2]:
             if eventtime > starttime + 5.:
                 raise error("timeout on est_clock calculation")
             eventtime = self.reactor.pause(eventtime + 0.010)
@@ -123,12 +144,19 @@ class SerialReader:
         if pace:
             est_clock = float(self.msgparser.config['CLOCK_FREQ'])
         self.serialqueue = self.ffi_lib.serialqueue_alloc(self.ser.fileno(), 1)
-        self.est_clock = est_clock
-        self.last_ack_time = self.reactor.monotonic()
-        self.last_ack_clock = 0
+        eventtime = self.reactor.monotonic()
+        self.clock_state = (eventtime, 0., est_clock, eventtime, 0)
         self.ffi_lib.serialqueue_set_clock_est(
-            self.serialqueue, self.est_clock, self.last_ack_time
-            , self.last_ack_clock)
+            self.serialqueue, est_clock, eventtime, 0)
+    def set_reactor(self, reactor):
+        # Transfer an open connection to a new reactor (for a host only
+        # restart) - callbacks registered by previous users are dropped
+        self._reset_handlers()
+        self.reactor.unregister_timer(self.status_timer)
+        self.reactor = reactor
+        self.status_timer = reactor.register_timer(self._status_event)
+        if self.status_cmd is not None:
+            reactor.update_timer(self.status_timer, reactor.NOW)
     def disconnect(self):
         if self.serialqueue is not None:
             self.ffi_lib.serialqueue_exit(self.serialqueue)
@@ -145,8 +173,15 @@ class SerialReader:
         sqstats = self.ffi_lib.serialqueue_get_stats(
             self.serialqueue, self.stats_buf, len(self.stats_buf))
         sqstats = self.ffi_main.string(self.stats_buf)
-        tstats = " est_clock=%.3f last_ack_time=%.3f last_ack_clock=%d" % (
-            self.est_clock, self.last_ack_time, self.last_ack_clock)
+        ref_time, ref_clock, est_clock, ack_time, ack_clock = self.clock_state
+        with self.lock:
+            cr = self.clock_regression
+            tstats = (" est_clock=%.3f clock_stddev=%.6f min_rtt=%.6f"
+                      " clock_samples=%d clock_outliers=%d"
+                      " last_ack_time=%.3f last_ack_clock=%d" % (
+                          est_clock, cr.get_stddev(), cr.get_min_rtt()
+                          , len(cr.samples), cr.outliers
+                          , ack_time, ack_clock))
         return sqstats + tstats
     def _status_event(self, eventtime):
         self.send(self.status_cmd)
@@ -160,25 +195,35 @@ class SerialReader:
             del self.handlers[name, oid]
     # Clock tracking
     def get_clock(self, eventtime):
-        with self.lock:
-            return int(self.last_ack_clock
-                       + (eventtime - self.last_ack_time) * self.est_clock)
+        ref_time, ref_clock, est_clock, ack_time, ack_clock = self.clock_state
+        return int(ref_clock + (eventtime - ref_time) * est_clock)
     def translate_clock(self, raw_clock):
-        with self.lock:
-            last_ack_clock = self.last_ack_clock
+        last_ack_clock = self.clock_state[4]
         clock_diff = (last_ack_clock - raw_clock) & 0xffffffff
         if clock_diff & 0x80000000:
             return last_ack_clock + 0x100000000 - clock_diff
         return last_ack_clock - clock_diff
     def get_last_clock(self):
-        with self.lock:
-            return self.last_ack_clock, self.last_ack_time
+        ref_time, ref_clock, est_clock, ack_time, ack_clock = self.clock_state
+        return ack_clock, ack_time
+    def get_clock_est(self):
+        ref_time, ref_clock, est_clock, ack_time, ack_clock = self.clock_state
+        return ref_time, ref_clock, est_clock
     # Command sending
     def send(self, cmd, minclock=0, reqclock=0, cq=None):
         if cq is None:
             cq = self.default_cmd_queue
         self.ffi_lib.serialqueue_send(
             self.serialqueue, cq, cmd, len(cmd), minclock, reqclock)
+    def send_multi(self, cmds, minclock=0, reqclock=0, cq=None):
+        if cq is None:
+            cq = self.default_cmd_queue
+        data = []
+        for cmd in cmds:
+            data.extend(cmd)
+        lens = [len(cmd) for cmd in cmds]
+        self.ffi_lib.serialqueue_send_multi(
+            self.serialqueue, cq, data, lens, len(lens), minclock, reqclock)
     def encode_and_send(self, data, minclock, reqclock, cq):
         self.ffi_lib.serialqueue_encode_and_send(
             self.serialqueue, cq, data, len(data), minclock, reqclock)
@@ -211,27 +256,32 @@ class SerialReader:
     # Default message handlers
     def handle_status(self, params):
         with self.lock:
-            # Update last_ack_time / last_ack_clock
-            ack_clock = (self.last_ack_clock & ~0xffffffff) | params['clock']
-            if ack_clock < self.last_ack_clock:
+            # Extend the 32bit clock to 64bits
+            last_ack_clock = self.clock_state[4]
+            if not last_ack_clock:
+                # Initial clock not yet loaded from get_uptime
+                return
+            ack_clock = (last_ack_clock & ~0xffffffff) | params['clock']
+            if ack_clock < last_ack_clock:
                 ack_clock += 0x100000000
-            sent_time = params['#sent_time']
-            self.last_ack_time = receive_time = params['#receive_time']
-            self.last_ack_clock = ack_clock
-            # Update est_clock (if applicable)
-            if receive_time > self.last_ack_rtt_time + 1. and sent_time:
-                if self.last_ack_rtt_time:
-                    timedelta = receive_time - self.last_ack_rtt_time
-                    clockdelta = ack_clock - self.last_ack_rtt_clock
-                    estclock = clockdelta / timedelta
-                    if estclock > self.est_clock and self.est_clock:
-                        self.est_clock = (self.est_clock * 63. + estclock) / 64.
-                    else:
-                        self.est_clock = estclock
-                self.last_ack_rtt_time = sent_time
-                self.last_ack_rtt_clock = ack_clock
+            self._update_clock(
+                params['#sent_time'], params['#receive_time'], ack_clock)
+    def _update_clock(self, sent_time, receive_time, clock):
+        # Add a clock sample and publish a new clock_state (caller must
+        # hold self.lock)
+        ref_time, ref_clock, est_clock = self.clock_state[:3]
+        cr = self.clock_regression
+        if (sent_time and cr.add_sample(sent_time, receive_time, clock)
+            and cr.freq):
+            ref_time, ref_clock, est_clock = cr.time_avg, cr.clock_avg, cr.freq
+            # Give serialqueue a conservative (low) clock so that
+            # messages are not released before their min_clock
+            safe_clock = cr.clock_avg - 3. * cr.get_stddev() * cr.freq
             self.ffi_lib.serialqueue_set_clock_est(
-                self.serialqueue, self.est_clock, receive_time, ack_clock)
+                self.serialqueue, cr.freq, cr.time_avg
+                , max(0, int(safe_clock)))
+        self.clock_state = (ref_time, ref_clock, est_clock
+                            , receive_time, clock)
     def handle_unknown(self, params):
         logging.warn("Unknown message type %d: %s" % (
             params['#msgid'], repr(params['#msg'])))
@@ -242,6 +292,86 @@ class SerialReader:
     def __del__(self):
         self.disconnect()
 
+# Estimate the mcu clock frequency and offset using a linear regression
+# over a window of recent (host time, mcu clock) samples.  A sample is
+# taken at the midpoint of the query round trip, so samples with a
+# round trip time well above the recent minimum are ignored.
+class ClockRegression:
+    WINDOW = 30
+    RTT_SLACK = 0.001
+    RESET_ERROR = 0.050
+    MIN_SPAN = 0.900
+    def __init__(self):
+        self.samples = []
+        self.rtts = []
+        self.outliers = 0
+        self.time_avg = self.clock_avg = 0.
+        self.freq = 0.
+        self.variance = 0.
+    def get_min_rtt(self):
+        if not self.rtts:
+            return 0.
+        return min(self.rtts)
+    def get_stddev(self):
+        # Estimated error (in seconds) of a clock prediction
+        if not self.freq:
+            return 0.
+        return math.sqrt(self.variance) / self.freq
+    def add_sample(self, sent_time, receive_time, clock):
+        # Returns True if the sample was used
+        rtt = receive_time - sent_time
+        self.rtts.append(rtt)
+        del self.rtts[:-self.WINDOW]
+        min_rtt = min(self.rtts)
+        if rtt > min_rtt + max(min_rtt, self.RTT_SLACK):
+            self.outliers += 1
+            return False
+        sample_time = sent_time + .5 * rtt
+        if self.freq:
+            pred_clock = (self.clock_avg
+                          + (sample_time - self.time_avg) * self.freq)
+            if abs(clock - pred_clock) > self.RESET_ERROR * self.freq:
+                logging.info("Resetting clock estimate (error %.6fs)" % (
+                    (clock - pred_clock) / self.freq,))
+                del self.samples[:]
+        self.samples.append((sample_time, clock))
+        del self.samples[:-self.WINDOW]
+        self._update()
+        return True
+    def _update(self):
+        count = len(self.samples)
+        base_time, base_clock = self.samples[0]
+        if self.samples[-1][0] - base_time < self.MIN_SPAN:
+            # Not enough data for a frequency estimate yet
+            if self.freq:
+                self.time_avg, self.clock_avg = self.samples[-1]
+            return
+        time_avg = clock_avg = 0.
+        for t, c in self.samples:
+            time_avg += t - base_time
+            clock_avg += c - base_clock
+        time_avg /= count
+        clock_avg /= count
+        time_var = covariance = 0.
+        for t, c in self.samples:
+            dt = t - base_time - time_avg
+            time_var += dt * dt
+            covariance += dt * (c - base_clock - clock_avg)
+        if time_var <= 0.:
+            return
+        freq = covariance / time_var
+        variance = 0.
+        if count > 2:
+            for t, c in self.samples:
+                diff = (c - base_clock - clock_avg
+                        - (t - base_time - time_avg) * freq)
+                variance += diff * diff
+            variance /= count - 2
+        self.time_avg = base_time + time_avg
+        self.clock_avg = base_clock + clock_avg
+        self.freq = freq
+        self.variance = variance
+
 # Class to retry sending of a query command until a given response is received
 class SerialRetryCommand:
     TIMEOUT_TIME = 5.0
@@ -251,7 +381,7 @@ class SerialRetryCommand:
         self.cmd = cmd
         self.name = name
         self.oid = oid
-        self.response = None
+        self.completion = self.serial.reactor.completion()
         self.min_query_time = self.serial.reactor.monotonic()
         self.serial.register_callback(self.handle_callback, self.name, self.oid)
         self.send_timer = self.serial.reactor.register_timer(
@@ -260,52 +390,124 @@ class SerialRetryCommand:
         self.serial.unregister_callback(self.name, self.oid)
         self.serial.reactor.unregister_timer(self.send_timer)
     def send_event(self, eventtime):
-        if self.response is not None:
+        if self.completion.test():
             return self.serial.reactor.NEVER
         self.serial.send(self.cmd)
         return eventtime + self.RETRY_TIME
     def handle_callback(self, params):
+        # Called from the background thread
         last_sent_time = params['#sent_time']
         if last_sent_time >= self.min_query_time:
-            self.response = params
+            self.serial.reactor.async_complete(self.completion, params)
     def get_response(self):
-        eventtime = self.serial.reactor.monotonic()
-        while self.response is None:
-            eventtime = self.serial.reactor.pause(eventtime + 0.05)
-            if eventtime > self.min_query_time + self.TIMEOUT_TIME:
-                self.unregister()
-                raise error("Timeout on wait for '%s' response" % (self.name,))
+        response = self.completion.wait(
+            self.min_query_time + self.TIMEOUT_TIME)
         self.unregister()
-        return self.response
+        if response is None:
+            raise error("Timeout on wait for '%s' response" % (self.name,))
+        return response
 
 # Code to start communication and download message type dictionary
 class SerialBootStrap:
     RETRY_TIME = 0.500
+    CACHE_DIR = "~/.cache/klippy"
+    INFO_OFFSET = 0xffffffff
     def __init__(self, serial):
         self.serial = serial
         self.identify_data = ""
+        self.identify_info = None
+        self.is_info_done = False
+        self.from_cache = False
         self.identify_cmd = self.serial.msgparser.lookup_command(
             "identify offset=%u count=%c")
+        self.completion = self.serial.reactor.completion()
         self.is_done = False
         self.serial.register_callback(self.handle_identify, 'identify_response')
         self.serial.register_callback(self.handle_unknown, '#unknown')
         self.send_timer = self.serial.reactor.register_timer(
             self.send_event, self.serial.reactor.NOW)
     def get_identify_data(self, timeout):
-        eventtime = self.serial.reactor.monotonic()
-        while not self.is_done and eventtime <= timeout:
-            eventtime = self.serial.reactor.pause(eventtime + 0.05)
+        identify_data = self.completion.wait(timeout)
         self.serial.unregister_callback('identify_response')
         self.serial.reactor.unregister_timer(self.send_timer)
-        if not self.is_done:
+        if identify_data is not None and not self.from_cache:
+            self._write_cache(identify_data)
+        return identify_data
+    def get_source(self):
+        if self.from_cache:
+            return "cache"
+        return "mcu"
+    # Identify data cache (keyed by the crc32 and size the mcu reports)
+    def _cache_filename(self):
+        crc, size = self.identify_info
+        return os.path.join(os.path.expanduser(self.CACHE_DIR)
+                            , "identify-%08x-%d.zlib" % (crc, size))
+    def _check_data(self, data):
+        crc, size = self.identify_info
+        return len(data) == size and zlib.crc32(data) & 0xffffffff == crc
+    def _read_cache(self):
+        filename = self._cache_filename()
+        try:
+            f = open(filename, 'rb')
+            data = f.read()
+            f.close()
+        except IOError:
             return None
-        return self.identify_data
+        if not self._check_data(data):
+            logging.info("Removing invalid data dictionary cache %s" % (
+                filename,))
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+            return None
+        return data
+    def _write_cache(self, data):
+        if self.identify_info is None:
+            return
+        if not self._check_data(data):
+            logging.warn("Data dictionary does not match mcu reported crc")
+            return
+        filename = self._cache_filename()
+        tmpname = "%s.%d.tmp" % (filename, os.getpid())
+        try:
+            dirname = os.path.dirname(filename)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            f = open(tmpname, 'wb')
+            f.write(data)
+            f.close()
+            os.rename(tmpname, filename)
+        except (IOError, OSError) as e:
+            logging.warn("Unable to write data dictionary cache %s: %s" % (
+                filename, e))
+    # Callbacks (called from the background thread)
     def handle_identify(self, params):
-        if self.is_done or params['offset'] != len(self.identify_data):
+        if self.is_done:
+            return
+        if params['offset'] == self.INFO_OFFSET:
+            if self.is_info_done:
+                return
+            self.is_info_done = True
+            msgdata = params['data']
+            if len(msgdata) == 8:
+                # Mcu reported the crc32 and size of its data dictionary
+                self.identify_info = struct.unpack('<II', msgdata)
+                data = self._read_cache()
+                if data is not None:
+                    self.from_cache = self.is_done = True
+                    self.serial.reactor.async_complete(self.completion, data)
+                    return
+            imsg = self.identify_cmd.encode(0, 40)
+            self.serial.send(imsg)
+            return
+        if not self.is_info_done or params['offset'] != len(self.identify_data):
             return
         msgdata = params['data']
         if not msgdata:
             self.is_done = True
+            self.serial.reactor.async_complete(
+                self.completion, self.identify_data)
             return
         self.identify_data += msgdata
         imsg = self.identify_cmd.encode(len(self.identify_data), 40)
@@ -313,7 +515,10 @@ class SerialBootStrap:
     def send_event(self, eventtime):
         if self.is_done:
             return self.serial.reactor.NEVER
-        imsg = self.identify_cmd.encode(len(self.identify_data), 40)
+        offset = len(self.identify_data)
+        if not self.is_info_done:
+            offset = self.INFO_OFFSET
+        imsg = self.identify_cmd.encode(offset, 40)
         self.serial.send(imsg)
         return eventtime + self.RETRY_TIME
     def handle_unknown(self, params):
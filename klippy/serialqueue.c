@@ -262,7 +262,8 @@ f4: *p++ = v & 0x7f;
 
 struct command_queue {
     struct list_head stalled_queue, ready_queue;
-    struct list_node node;
+    uint64_t pending_seq;
+    int heap_pos[2];
 };
 
 // Allocate a 'struct queue_message' object
@@ -325,6 +326,120 @@ message_queue_free(struct list_head *root)
 }
 
 
+/****************************************************************
+ * Command queue heaps
+ ****************************************************************/
+
+// The command queues with pending messages are tracked in two binary
+// min-heaps - one ordered by the req_clock of the first message on
+// each queue's ready_queue and one by the min_clock of the first
+// message on each queue's stalled_queue.  Ties are broken by the
+// order the queues became pending.
+
+#define CQH_READY   0
+#define CQH_STALLED 1
+
+struct cq_heap {
+    struct command_queue **queues;
+    int count, size, type;
+};
+
+// Return the sort key of a command queue in the given heap
+static inline uint64_t
+cqheap_key(struct cq_heap *h, struct command_queue *cq)
+{
+    if (h->type == CQH_READY)
+        return list_first_entry(&cq->ready_queue, struct queue_message
+                                , node)->req_clock;
+    return list_first_entry(&cq->stalled_queue, struct queue_message
+                            , node)->min_clock;
+}
+
+// Check if command queue 'a' should be ahead of 'b' in the heap
+static inline int
+cqheap_less(struct cq_heap *h, struct command_queue *a
+            , struct command_queue *b)
+{
+    uint64_t akey = cqheap_key(h, a), bkey = cqheap_key(h, b);
+    return akey < bkey || (akey == bkey && a->pending_seq < b->pending_seq);
+}
+
+static inline void
+cqheap_set(struct cq_heap *h, int pos, struct command_queue *cq)
+{
+    h->queues[pos] = cq;
+    cq->heap_pos[h->type] = pos;
+}
+
+// Return the command queue with the lowest key (or NULL if empty)
+static inline struct command_queue *
+cqheap_first(struct cq_heap *h)
+{
+    return h->count ? h->queues[0] : NULL;
+}
+
+// Move the command queue at 'pos' to its proper place in the heap
+static void
+cqheap_fix(struct cq_heap *h, int pos)
+{
+    struct command_queue *cq = h->queues[pos];
+    while (pos) {
+        int parent = (pos - 1) / 2;
+        if (!cqheap_less(h, cq, h->queues[parent]))
+            break;
+        cqheap_set(h, pos, h->queues[parent]);
+        pos = parent;
+    }
+    for (;;) {
+        int child = pos * 2 + 1;
+        if (child >= h->count)
+            break;
+        if (child + 1 < h->count
+            && cqheap_less(h, h->queues[child + 1], h->queues[child]))
+            child++;
+        if (!cqheap_less(h, h->queues[child], cq))
+            break;
+        cqheap_set(h, pos, h->queues[child]);
+        pos = child;
+    }
+    cqheap_set(h, pos, cq);
+}
+
+// Make sure the heap has space for 'count' command queues
+static void
+cqheap_reserve(struct cq_heap *h, int count)
+{
+    if (count <= h->size)
+        return;
+    int size = h->size ? h->size : 16;
+    while (size < count)
+        size *= 2;
+    h->queues = realloc(h->queues, size * sizeof(*h->queues));
+    h->size = size;
+}
+
+// Add a command queue to the heap
+static void
+cqheap_add(struct cq_heap *h, struct command_queue *cq)
+{
+    int pos = h->count++;
+    cqheap_set(h, pos, cq);
+    cqheap_fix(h, pos);
+}
+
+// Remove a command queue from the heap
+static void
+cqheap_del(struct cq_heap *h, struct command_queue *cq)
+{
+    int pos = cq->heap_pos[h->type];
+    h->count--;
+    if (pos < h->count) {
+        cqheap_set(h, pos, h->queues[h->count]);
+        cqheap_fix(h, pos);
+    }
+}
+
+
 /****************************************************************
  * Serialqueue interface
  ****************************************************************/
@@ -349,11 +464,12 @@ struct serialqueue {
     double last_receive_sent_time;
     // Retransmit support
     uint64_t send_seq, receive_seq;
-    uint64_t retransmit_seq, rtt_sample_seq;
+    uint64_t retransmit_seq, rtt_sample_seq, ignore_nak_seq;
     struct list_head sent_queue;
     double srtt, rttvar, rto;
     // Pending transmission message queues
-    struct list_head pending_queues;
+    struct cq_heap ready_queues, stalled_queues;
+    uint64_t pending_seq;
     int ready_bytes, stalled_bytes;
     uint64_t need_kick_clock;
     // Received messages
@@ -362,6 +478,7 @@ struct serialqueue {
     struct list_head old_sent, old_receive;
     // Stats
     uint32_t bytes_write, bytes_read, bytes_retransmit, bytes_invalid;
+    uint32_t fast_retransmits, timeout_retransmits;
 };
 
 #define SQPF_SERIAL 0
@@ -422,6 +539,35 @@ kick_bg_thread(struct serialqueue *sq)
         report_errno("pipe write", ret);
 }
 
+// Resend the blocks in the sent_queue - the mcu discards all blocks
+// after a missing one, so everything from the first unacknowledged
+// block on must be sent again
+static void
+retransmit_sent(struct serialqueue *sq, double eventtime)
+{
+    uint8_t buf[MESSAGE_MAX * MESSAGE_SEQ_MASK + 1];
+    int buflen = 0;
+    buf[buflen++] = MESSAGE_SYNC;
+    struct queue_message *qm;
+    list_for_each_entry(qm, &sq->sent_queue, node) {
+        memcpy(&buf[buflen], qm->msg, qm->len);
+        buflen += qm->len;
+    }
+    int ret = write(sq->serial_fd, buf, buflen);
+    if (ret < 0)
+        report_errno("retransmit write", ret);
+    sq->bytes_retransmit += buflen;
+    // The mcu naks every copy of a block it already received, so naks
+    // are ignored until the acks pass the blocks resent here
+    sq->retransmit_seq = sq->send_seq;
+    sq->ignore_nak_seq = (sq->receive_seq > sq->retransmit_seq
+                          ? sq->receive_seq : sq->retransmit_seq);
+    sq->rtt_sample_seq = 0;
+    if (eventtime > sq->idle_time)
+        sq->idle_time = eventtime;
+    sq->idle_time += buflen * sq->baud_adjust;
+}
+
 // Update internal state when the receive sequence increases
 static void
 update_receive_seq(struct serialqueue *sq, double eventtime, uint64_t rseq)
@@ -487,10 +633,17 @@ handle_message(struct serialqueue *sq, double eventtime, int len)
     if (rseq != sq->receive_seq)
         // New sequence number
         update_receive_seq(sq, eventtime, rseq);
-    else if (len == MESSAGE_MIN && rseq > sq->retransmit_seq
-             && !list_empty(&sq->sent_queue))
-        // Duplicate sequence number in an empty message is a nak
-        pollreactor_update_timer(&sq->pr, SQPT_RETRANSMIT, PR_NOW);
+    else if (len == MESSAGE_MIN && rseq > sq->ignore_nak_seq
+             && !list_empty(&sq->sent_queue)) {
+        // Duplicate sequence number in an empty message is a nak -
+        // resend from the block the mcu is missing.  Blocks still in
+        // the tty output buffer are not flushed and the rto is not
+        // backed off (the mcu is responding).
+        retransmit_sent(sq, eventtime);
+        sq->fast_retransmits++;
+        pollreactor_update_timer(&sq->pr, SQPT_RETRANSMIT
+                                 , sq->idle_time + sq->rto);
+    }
 
     if (len > MESSAGE_MIN) {
         // Add message to receive queue
@@ -560,26 +713,14 @@ retransmit_event(struct serialqueue *sq, double eventtime)
     pthread_mutex_lock(&sq->lock);
 
     // Retransmit all pending messages
-    uint8_t buf[MESSAGE_MAX * MESSAGE_SEQ_MASK + 1];
-    int buflen = 0;
-    buf[buflen++] = MESSAGE_SYNC;
-    struct queue_message *qm;
-    list_for_each_entry(qm, &sq->sent_queue, node) {
-        memcpy(&buf[buflen], qm->msg, qm->len);
-        buflen += qm->len;
-    }
-    ret = write(sq->serial_fd, buf, buflen);
-    if (ret < 0)
-        report_errno("retransmit write", ret);
-    sq->bytes_retransmit += buflen;
+    sq->idle_time = eventtime;
+    retransmit_sent(sq, eventtime);
+    sq->timeout_retransmits++;
 
     // Update rto
     sq->rto *= 2.0;
     if (sq->rto > MAX_RTO)
         sq->rto = MAX_RTO;
-    sq->retransmit_seq = sq->send_seq;
-    sq->rtt_sample_seq = 0;
-    sq->idle_time = eventtime + buflen * sq->baud_adjust;
     double waketime = sq->idle_time + sq->rto;
 
     pthread_mutex_unlock(&sq->lock);
@@ -595,26 +736,17 @@ build_and_send_command(struct serialqueue *sq, double eventtime)
 
     while (sq->ready_bytes) {
         // Find highest priority message (message with lowest req_clock)
-        uint64_t min_clock = MAX_CLOCK;
-        struct command_queue *q, *cq = NULL;
-        struct queue_message *qm = NULL;
-        list_for_each_entry(q, &sq->pending_queues, node) {
-            if (!list_empty(&q->ready_queue)) {
-                struct queue_message *m = list_first_entry(
-                    &q->ready_queue, struct queue_message, node);
-                if (m->req_clock < min_clock) {
-                    min_clock = m->req_clock;
-                    cq = q;
-                    qm = m;
-                }
-            }
-        }
+        struct command_queue *cq = cqheap_first(&sq->ready_queues);
+        struct queue_message *qm = list_first_entry(
+            &cq->ready_queue, struct queue_message, node);
         // Append message to outgoing command
         if (out->len + qm->len > sizeof(out->msg) - MESSAGE_TRAILER_SIZE)
             break;
         list_del(&qm->node);
-        if (list_empty(&cq->ready_queue) && list_empty(&cq->stalled_queue))
-            list_del(&cq->node);
+        if (list_empty(&cq->ready_queue))
+            cqheap_del(&sq->ready_queues, cq);
+        else
+            cqheap_fix(&sq->ready_queues, cq->heap_pos[CQH_READY]);
         memcpy(&out->msg[out->len], qm->msg, qm->len);
         out->len += qm->len;
         sq->ready_bytes -= qm->len;
@@ -668,29 +800,41 @@ check_send_command(struct serialqueue *sq, double eventtime)
     uint64_t ack_clock = (uint64_t)(timedelta * sq->est_clock) + sq->last_ack_clock;
     uint64_t min_stalled_clock = MAX_CLOCK, min_ready_clock = MAX_CLOCK;
     struct command_queue *cq;
-    list_for_each_entry(cq, &sq->pending_queues, node) {
+    while ((cq = cqheap_first(&sq->stalled_queues))) {
+        struct queue_message *qm = list_first_entry(
+            &cq->stalled_queue, struct queue_message, node);
+        if (ack_clock < qm->min_clock) {
+            min_stalled_clock = qm->min_clock;
+            break;
+        }
         // Move messages from the stalled_queue to the ready_queue
+        if (list_empty(&cq->ready_queue)) {
+            list_del(&qm->node);
+            list_add_tail(&qm->node, &cq->ready_queue);
+            sq->stalled_bytes -= qm->len;
+            sq->ready_bytes += qm->len;
+            cqheap_add(&sq->ready_queues, cq);
+        }
         while (!list_empty(&cq->stalled_queue)) {
-            struct queue_message *qm = list_first_entry(
+            qm = list_first_entry(
                 &cq->stalled_queue, struct queue_message, node);
-            if (ack_clock < qm->min_clock) {
-                if (qm->min_clock < min_stalled_clock)
-                    min_stalled_clock = qm->min_clock;
+            if (ack_clock < qm->min_clock)
                 break;
-            }
             list_del(&qm->node);
             list_add_tail(&qm->node, &cq->ready_queue);
             sq->stalled_bytes -= qm->len;
             sq->ready_bytes += qm->len;
         }
-        // Update min_ready_clock
-        if (!list_empty(&cq->ready_queue)) {
-            struct queue_message *qm = list_first_entry(
-                &cq->ready_queue, struct queue_message, node);
-            if (qm->req_clock < min_ready_clock)
-                min_ready_clock = qm->req_clock;
-        }
+        if (list_empty(&cq->stalled_queue))
+            cqheap_del(&sq->stalled_queues, cq);
+        else
+            cqheap_fix(&sq->stalled_queues, cq->heap_pos[CQH_STALLED]);
     }
+    // Update min_ready_clock
+    cq = cqheap_first(&sq->ready_queues);
+    if (cq)
+        min_ready_clock = list_first_entry(
+            &cq->ready_queue, struct queue_message, node)->req_clock;
 
     // Check for messages to send
     if (sq->ready_bytes >= MESSAGE_PAYLOAD_MAX)
@@ -772,7 +916,8 @@ serialqueue_alloc(int serial_fd, int write_only)
 
     // Queues
     sq->need_kick_clock = MAX_CLOCK;
-    list_init(&sq->pending_queues);
+    sq->ready_queues.type = CQH_READY;
+    sq->stalled_queues.type = CQH_STALLED;
     list_init(&sq->sent_queue);
     list_init(&sq->receive_queue);
 
@@ -824,13 +969,17 @@ serialqueue_free(struct serialqueue *sq)
     message_queue_free(&sq->receive_queue);
     message_queue_free(&sq->old_sent);
     message_queue_free(&sq->old_receive);
-    while (!list_empty(&sq->pending_queues)) {
-        struct command_queue *cq = list_first_entry(
-            &sq->pending_queues, struct command_queue, node);
-        list_del(&cq->node);
+    int i;
+    for (i=0; i<sq->ready_queues.count; i++) {
+        struct command_queue *cq = sq->ready_queues.queues[i];
         message_queue_free(&cq->ready_queue);
+    }
+    for (i=0; i<sq->stalled_queues.count; i++) {
+        struct command_queue *cq = sq->stalled_queues.queues[i];
         message_queue_free(&cq->stalled_queue);
     }
+    free(sq->ready_queues.queues);
+    free(sq->stalled_queues.queues);
     pthread_mutex_unlock(&sq->lock);
     pollreactor_free(&sq->pr);
     free(sq);
@@ -879,9 +1028,18 @@ serialqueue_send_batch(struct serialqueue *sq, struct command_queue *cq
 
     // Add list to cq->stalled_queue
     pthread_mutex_lock(&sq->lock);
-    if (list_empty(&cq->ready_queue) && list_empty(&cq->stalled_queue))
-        list_add_tail(&cq->node, &sq->pending_queues);
-    list_join_tail(msgs, &cq->stalled_queue);
+    if (list_empty(&cq->stalled_queue)) {
+        if (list_empty(&cq->ready_queue))
+            cq->pending_seq = sq->pending_seq++;
+        // Each heap must have room for every pending command queue
+        int count = sq->ready_queues.count + sq->stalled_queues.count + 1;
+        cqheap_reserve(&sq->ready_queues, count);
+        cqheap_reserve(&sq->stalled_queues, count);
+        list_join_tail(msgs, &cq->stalled_queue);
+        cqheap_add(&sq->stalled_queues, cq);
+    } else {
+        list_join_tail(msgs, &cq->stalled_queue);
+    }
     sq->stalled_bytes += len;
     int mustwake = 0;
     if (qm->min_clock < sq->need_kick_clock) {
@@ -911,6 +1069,28 @@ serialqueue_send(struct serialqueue *sq, struct command_queue *cq
     serialqueue_send_batch(sq, cq, &msgs);
 }
 
+// Schedule the transmission of several messages at once.  The
+// messages are stored back to back in 'data' and 'lens' contains the
+// length of each message.  Queuing them together allows the
+// background thread to pack them densely into message blocks.
+void
+serialqueue_send_multi(struct serialqueue *sq, struct command_queue *cq
+                       , uint8_t *data, int *lens, int count
+                       , uint64_t min_clock, uint64_t req_clock)
+{
+    struct list_head msgs;
+    list_init(&msgs);
+    int i;
+    for (i=0; i<count; i++) {
+        struct queue_message *qm = message_fill(data, lens[i]);
+        qm->min_clock = min_clock;
+        qm->req_clock = req_clock;
+        list_add_tail(&qm->node, &msgs);
+        data += lens[i];
+    }
+    serialqueue_send_batch(sq, cq, &msgs);
+}
+
 // Like serialqueue_send() but also builds the message to be sent
 void
 serialqueue_encode_and_send(struct serialqueue *sq, struct command_queue *cq
@@ -927,40 +1107,54 @@ serialqueue_encode_and_send(struct serialqueue *sq, struct command_queue *cq
     serialqueue_send_batch(sq, cq, &msgs);
 }
 
-// Return a message read from the serial port (or wait for one if none
-// available)
-void
-serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
+// Return the messages read from the serial port (or wait for one if
+// none available).  Up to 'max' messages are copied to 'q' and the
+// number of messages copied is returned (or -1 if the serial port
+// is shutting down).
+int
+serialqueue_pull_batch(struct serialqueue *sq, struct pull_queue_message *q
+                       , int max)
 {
     pthread_mutex_lock(&sq->lock);
     // Wait for message to be available
     while (list_empty(&sq->receive_queue)) {
-        if (pollreactor_is_exit(&sq->pr))
-            goto exit;
+        if (pollreactor_is_exit(&sq->pr)) {
+            pthread_mutex_unlock(&sq->lock);
+            return -1;
+        }
         sq->receive_waiting = 1;
         int ret = pthread_cond_wait(&sq->cond, &sq->lock);
         if (ret)
             report_errno("pthread_cond_wait", ret);
     }
 
-    // Remove message from queue
-    struct queue_message *qm = list_first_entry(
-        &sq->receive_queue, struct queue_message, node);
-    list_del(&qm->node);
+    // Remove messages from queue
+    int count = 0;
+    while (count < max && !list_empty(&sq->receive_queue)) {
+        struct queue_message *qm = list_first_entry(
+            &sq->receive_queue, struct queue_message, node);
+        list_del(&qm->node);
 
-    // Copy message
-    memcpy(pqm->msg, qm->msg, qm->len);
-    pqm->len = qm->len;
-    pqm->sent_time = qm->sent_time;
-    pqm->receive_time = qm->receive_time;
-    debug_queue_add(&sq->old_receive, qm);
+        // Copy message
+        struct pull_queue_message *pqm = &q[count++];
+        memcpy(pqm->msg, qm->msg, qm->len);
+        pqm->len = qm->len;
+        pqm->sent_time = qm->sent_time;
+        pqm->receive_time = qm->receive_time;
+        debug_queue_add(&sq->old_receive, qm);
+    }
 
     pthread_mutex_unlock(&sq->lock);
-    return;
+    return count;
+}
 
-exit:
-    pqm->len = -1;
-    pthread_mutex_unlock(&sq->lock);
+// Return a message read from the serial port (or wait for one if none
+// available)
+void
+serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
+{
+    if (serialqueue_pull_batch(sq, pqm, 1) < 0)
+        pqm->len = -1;
 }
 
 void
@@ -998,12 +1192,14 @@ serialqueue_get_stats(struct serialqueue *sq, char *buf, int len)
              " send_seq=%u receive_seq=%u retransmit_seq=%u"
              " srtt=%.3f rttvar=%.3f rto=%.3f"
              " ready_bytes=%u stalled_bytes=%u"
+             " fast_retransmits=%u timeout_retransmits=%u"
              , stats.bytes_write, stats.bytes_read
              , stats.bytes_retransmit, stats.bytes_invalid
              , (int)stats.send_seq, (int)stats.receive_seq
              , (int)stats.retransmit_seq
              , stats.srtt, stats.rttvar, stats.rto
-             , stats.ready_bytes, stats.stalled_bytes);
+             , stats.ready_bytes, stats.stalled_bytes
+             , stats.fast_retransmits, stats.timeout_retransmits);
 }
 
 // Extract old messages stored in the debug queues
@@ -14,7 +14,7 @@
 // This code is writtin in C (instead of python) for processing
 // efficiency - the repetitive integer math is vastly faster in C.
 
-#include <math.h> // sqrt
+#include <math.h> // sqrt, pow
 #include <stddef.h> // offsetof
 #include <stdint.h> // uint32_t
 #include <stdio.h> // fprintf
@@ -36,6 +36,9 @@ struct stepcompress {
     struct list_head msg_queue;
     uint32_t queue_step_msgid, set_next_step_dir_msgid, oid;
     int sdir, invert_sdir;
+    // Position tracking (in units of steps)
+    int64_t commanded_pos;
+    double mcu_freq, time_scale, inv_step_dist, velocity_factor, accel_factor;
 };
 
 
@@ -277,22 +280,74 @@ check_line(struct stepcompress *sc, struct step_move move)
 
 // Allocate a new 'stepcompress' object
 struct stepcompress *
-stepcompress_alloc(uint32_t max_error, uint32_t queue_step_msgid
-                   , uint32_t set_next_step_dir_msgid, uint32_t invert_sdir
-                   , uint32_t oid)
+stepcompress_alloc(uint32_t oid)
 {
     struct stepcompress *sc = malloc(sizeof(*sc));
     memset(sc, 0, sizeof(*sc));
-    sc->max_error = max_error;
     list_init(&sc->msg_queue);
-    sc->queue_step_msgid = queue_step_msgid;
-    sc->set_next_step_dir_msgid = set_next_step_dir_msgid;
     sc->oid = oid;
     sc->sdir = -1;
-    sc->invert_sdir = !!invert_sdir;
+    sc->time_scale = 1.;
     return sc;
 }
 
+// Fill message id information
+void
+stepcompress_fill(struct stepcompress *sc, uint32_t max_error
+                  , uint32_t queue_step_msgid, uint32_t set_next_step_dir_msgid
+                  , uint32_t invert_sdir)
+{
+    sc->max_error = max_error;
+    sc->queue_step_msgid = queue_step_msgid;
+    sc->set_next_step_dir_msgid = set_next_step_dir_msgid;
+    sc->invert_sdir = !!invert_sdir;
+}
+
+// Calculate the velocity and acceleration conversion factors (a move
+// lasts time_scale times longer on the mcu clock than in print time)
+static void
+update_factors(struct stepcompress *sc)
+{
+    double freq = sc->mcu_freq * sc->time_scale;
+    sc->velocity_factor = sc->inv_step_dist / freq;
+    sc->accel_factor = sc->inv_step_dist / pow(freq, 2.);
+}
+
+// Set the factors used to convert times and distances to clock ticks
+// and steps
+void
+stepcompress_set_scale(struct stepcompress *sc, double mcu_freq
+                       , double step_dist)
+{
+    sc->mcu_freq = mcu_freq;
+    sc->inv_step_dist = 1. / step_dist;
+    update_factors(sc);
+}
+
+// Set the ratio of mcu time to print time used for the durations,
+// velocities, and accelerations of moves (mcu clocks that are
+// synchronized to another mcu do not run at the nominal rate)
+void
+stepcompress_set_time_scale(struct stepcompress *sc, double time_scale)
+{
+    sc->time_scale = time_scale;
+    update_factors(sc);
+}
+
+// Return the commanded position of the stepper (in steps)
+int64_t
+stepcompress_get_position(struct stepcompress *sc)
+{
+    return sc->commanded_pos;
+}
+
+// Set the commanded position of the stepper (in steps)
+void
+stepcompress_set_position(struct stepcompress *sc, int64_t pos)
+{
+    sc->commanded_pos = pos;
+}
+
 // Free memory associated with a 'stepcompress' object
 void
 stepcompress_free(struct stepcompress *sc)
@@ -460,6 +515,7 @@ stepcompress_push(struct stepcompress *sc, double step_clock, int32_t sdir)
     if (ret)
         return ret;
     sc->queue_next = qnext;
+    sc->commanded_pos += sdir ? 1 : -1;
     return 0;
 }
 
@@ -662,6 +718,201 @@ stepcompress_push_delta(
 }
 
 
+/****************************************************************
+ * Move to step conversions
+ ****************************************************************/
+
+// The functions in this section take start times in seconds (on the
+// mcu clock), durations in print time seconds, and distances in
+// millimeters.  They track the commanded position of the stepper so
+// that a move may be scheduled with a single call.
+
+// Schedule steps at constant acceleration along the stepper's axis
+int32_t
+stepcompress_step_const(struct stepcompress *sc, double mcu_time
+                        , double start_pos, double dist, double start_v
+                        , double accel)
+{
+    double inv_step_dist = sc->inv_step_dist;
+    double step_offset = sc->commanded_pos - start_pos * inv_step_dist;
+    int32_t count = stepcompress_push_const(
+        sc, mcu_time * sc->mcu_freq, step_offset, dist * inv_step_dist
+        , start_v * sc->velocity_factor, accel * sc->accel_factor);
+    if (count == ERROR_RET)
+        return ERROR_RET;
+    sc->commanded_pos += count;
+    return 0;
+}
+
+// Schedule steps for a delta tower
+int32_t
+stepcompress_step_delta(struct stepcompress *sc, double mcu_time
+                        , double dist, double start_v, double accel
+                        , double height_base, double startxy_d, double arm_d
+                        , double movez_r)
+{
+    double inv_step_dist = sc->inv_step_dist;
+    double height = sc->commanded_pos - height_base * inv_step_dist;
+    int32_t count = stepcompress_push_delta(
+        sc, mcu_time * sc->mcu_freq, dist * inv_step_dist
+        , start_v * sc->velocity_factor, accel * sc->accel_factor
+        , height, startxy_d * inv_step_dist, arm_d * inv_step_dist, movez_r);
+    if (count == ERROR_RET)
+        return ERROR_RET;
+    sc->commanded_pos += count;
+    return 0;
+}
+
+// Schedule the acceleration, cruising, deceleration, and retraction
+// (used by extruder pressure advance) phases of a move
+int32_t
+stepcompress_push_trapezoid(
+    struct stepcompress *sc, double mcu_time, double start_pos
+    , double accel_d, double cruise_d, double decel_d, double retract_d
+    , double start_v, double cruise_v, double decel_v, double retract_v
+    , double accel, double accel_t, double cruise_t, double decel_t)
+{
+    int32_t ret;
+    // Acceleration steps
+    if (accel_d) {
+        ret = stepcompress_step_const(
+            sc, mcu_time, start_pos, accel_d, start_v, accel);
+        if (ret)
+            return ret;
+        start_pos += accel_d;
+        mcu_time += accel_t * sc->time_scale;
+    }
+    // Cruising steps
+    if (cruise_d) {
+        ret = stepcompress_step_const(
+            sc, mcu_time, start_pos, cruise_d, cruise_v, 0.);
+        if (ret)
+            return ret;
+        start_pos += cruise_d;
+        mcu_time += cruise_t * sc->time_scale;
+    }
+    // Deceleration steps
+    if (decel_d) {
+        ret = stepcompress_step_const(
+            sc, mcu_time, start_pos, decel_d, decel_v, -accel);
+        if (ret)
+            return ret;
+        start_pos += decel_d;
+        mcu_time += decel_t * sc->time_scale;
+    }
+    // Retraction steps
+    if (retract_d) {
+        ret = stepcompress_step_const(
+            sc, mcu_time, start_pos, -retract_d, retract_v, accel);
+        if (ret)
+            return ret;
+    }
+    return 0;
+}
+
+// Schedule the steps of a move on a list of steppers that each move
+// linearly with the toolhead (cartesian and corexy style kinematics)
+int32_t
+stepcompress_push_move(
+    struct stepcompress **sc_list, int sc_num, double mcu_time
+    , double *start_pos, double *axes_d, double move_d
+    , double accel_r, double cruise_r, double decel_r
+    , double accel_t, double cruise_t
+    , double start_v, double cruise_v, double accel)
+{
+    int i;
+    for (i=0; i<sc_num; i++) {
+        double axis_d = axes_d[i];
+        if (!axis_d)
+            continue;
+        double axis_r = fabs(axis_d) / move_d;
+        double axis_cruise_v = cruise_v * axis_r;
+        int32_t ret = stepcompress_push_trapezoid(
+            sc_list[i], mcu_time, start_pos[i]
+            , accel_r * axis_d, cruise_r * axis_d, decel_r * axis_d, 0.
+            , start_v * axis_r, axis_cruise_v, axis_cruise_v, 0.
+            , accel * axis_r, accel_t, cruise_t, 0.);
+        if (ret)
+            return ret;
+    }
+    return 0;
+}
+
+// Schedule the steps of a move on the towers of a delta robot
+int32_t
+stepcompress_push_delta_move(
+    struct stepcompress **sc_list, int sc_num, double mcu_time
+    , double *towers, double arm_length2
+    , double *start_pos, double *axes_d, double move_d
+    , double accel_r, double cruise_r, double decel_r
+    , double accel_t, double cruise_t
+    , double start_v, double cruise_v, double accel)
+{
+    double movexy_r = 1., movez_r = 0., inv_movexy_d = 1. / move_d;
+    if (!axes_d[0] && !axes_d[1]) {
+        // Z only move
+        movez_r = axes_d[2] * inv_movexy_d;
+        movexy_r = inv_movexy_d = 0.;
+    } else if (axes_d[2]) {
+        // XY+Z move
+        double movexy_d = sqrt(pow(axes_d[0], 2.) + pow(axes_d[1], 2.));
+        movexy_r = movexy_d * inv_movexy_d;
+        movez_r = axes_d[2] * inv_movexy_d;
+        inv_movexy_d = 1. / movexy_d;
+    }
+    double accel_d = accel_r * move_d;
+    double cruise_d = cruise_r * move_d;
+    double decel_d = decel_r * move_d;
+
+    int i;
+    for (i=0; i<sc_num; i++) {
+        // Calculate a virtual tower along the line of movement at
+        // the point closest to this stepper's tower.
+        struct stepcompress *sc = sc_list[i];
+        double towerx_d = towers[i*2] - start_pos[0];
+        double towery_d = towers[i*2+1] - start_pos[1];
+        double vt_startxy_d = ((towerx_d*axes_d[0] + towery_d*axes_d[1])
+                               * inv_movexy_d);
+        double tangentxy_d2 = (pow(towerx_d, 2.) + pow(towery_d, 2.)
+                               - pow(vt_startxy_d, 2.));
+        double vt_arm_d = sqrt(arm_length2 - tangentxy_d2);
+        double vt_startz = start_pos[2];
+
+        // Generate steps
+        double t = mcu_time;
+        int32_t ret;
+        if (accel_d) {
+            ret = stepcompress_step_delta(
+                sc, t, accel_d, start_v, accel
+                , vt_startz, vt_startxy_d, vt_arm_d, movez_r);
+            if (ret)
+                return ret;
+            vt_startz += accel_d * movez_r;
+            vt_startxy_d -= accel_d * movexy_r;
+            t += accel_t * sc->time_scale;
+        }
+        if (cruise_d) {
+            ret = stepcompress_step_delta(
+                sc, t, cruise_d, cruise_v, 0.
+                , vt_startz, vt_startxy_d, vt_arm_d, movez_r);
+            if (ret)
+                return ret;
+            vt_startz += cruise_d * movez_r;
+            vt_startxy_d -= cruise_d * movexy_r;
+            t += cruise_t * sc->time_scale;
+        }
+        if (decel_d) {
+            ret = stepcompress_step_delta(
+                sc, t, decel_d, cruise_v, -accel
+                , vt_startz, vt_startxy_d, vt_arm_d, movez_r);
+            if (ret)
+                return ret;
+        }
+    }
+    return 0;
+}
+
+
 /****************************************************************
  * Step compress synchronization
  ****************************************************************/
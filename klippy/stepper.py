@@ -44,15 +44,21 @@ class PrinterStepper:
                 self.homing_endstop_accuracy = self.homing_stepper_phases
         self.position_min = self.position_endstop = self.position_max = None
         endstop_pin = config.get('endstop_pin', None)
-        step_pin = config.get('step_pin')
-        dir_pin = config.get('dir_pin')
-        mcu = printer.mcu
+        mcu, step_pin = printer.lookup_pin_mcu(config.get('step_pin'))
+        dir_mcu, dir_pin = printer.lookup_pin_mcu(config.get('dir_pin'))
+        if dir_mcu is not mcu:
+            raise config.error("step_pin and dir_pin must be on the same mcu")
         self.mcu_stepper = mcu.create_stepper(step_pin, dir_pin)
         self.mcu_stepper.set_step_distance(self.step_dist)
         enable_pin = config.get('enable_pin', None)
         if enable_pin is not None:
-            self.mcu_enable = mcu.create_digital_out(enable_pin, 0)
+            enable_mcu, enable_pin = printer.lookup_pin_mcu(enable_pin)
+            self.mcu_enable = enable_mcu.create_digital_out(enable_pin, 0)
         if endstop_pin is not None:
+            endstop_mcu, endstop_pin = printer.lookup_pin_mcu(endstop_pin)
+            if endstop_mcu is not mcu:
+                raise config.error(
+                    "endstop_pin and step_pin must be on the same mcu")
             self.mcu_endstop = mcu.create_endstop(endstop_pin)
             self.mcu_endstop.add_stepper(self.mcu_stepper)
             self.position_min = config.getfloat('position_min', 0.)
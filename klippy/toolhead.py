@@ -3,23 +3,45 @@
 # Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math, logging
-import cartesian, corexy, delta, extruder
+import math, logging, bisect
+import cartesian, corexy, delta, extruder, homing, chelper
 
 # Common suffixes: _d is distance (in mm), _v is velocity (in
 #   mm/second), _v2 is velocity squared (mm^2/s^2), _t is time (in
 #   seconds), _r is ratio (scalar between 0.0 and 1.0)
 
-# Class to track each move request
-class Move:
-    def __init__(self, toolhead, start_pos, end_pos, speed):
+# Class to track each move request.  Move objects are recycled (see
+# ToolHead.alloc_move()) so all fields are declared up front.
+class Move(object):
+    __slots__ = (
+        'toolhead', 'start_pos', 'end_pos', 'accel', 'is_kinematic_move',
+        'axes_d', 'move_d', 'min_move_t',
+        'max_start_v2', 'max_cruise_v2', 'delta_v2',
+        'max_smoothed_v2', 'smooth_delta_v2',
+        'accel_r', 'cruise_r', 'decel_r', 'start_v', 'cruise_v', 'end_v',
+        'accel_t', 'cruise_t', 'decel_t',
+        'extrude_r', 'extrude_max_corner_v')
+    def __init__(self, toolhead):
         self.toolhead = toolhead
-        self.start_pos = tuple(start_pos)
-        self.end_pos = tuple(end_pos)
+        self.start_pos = [0., 0., 0., 0.]
+        self.end_pos = [0., 0., 0., 0.]
+        self.axes_d = [0., 0., 0., 0.]
+        self.accel_r = self.cruise_r = self.decel_r = 0.
+        self.start_v = self.cruise_v = self.end_v = 0.
+        self.accel_t = self.cruise_t = self.decel_t = 0.
+        self.extrude_r = self.extrude_max_corner_v = 0.
+    def setup(self, start_pos, end_pos, speed):
+        toolhead = self.toolhead
+        self.start_pos[:] = start_pos
+        self.end_pos[:] = end_pos
         self.accel = toolhead.max_accel
         self.is_kinematic_move = True
-        self.axes_d = axes_d = [end_pos[i] - start_pos[i] for i in (0, 1, 2, 3)]
-        self.move_d = move_d = math.sqrt(sum([d*d for d in axes_d[:3]]))
+        axes_d = self.axes_d
+        axes_d[0] = dx = end_pos[0] - start_pos[0]
+        axes_d[1] = dy = end_pos[1] - start_pos[1]
+        axes_d[2] = dz = end_pos[2] - start_pos[2]
+        axes_d[3] = end_pos[3] - start_pos[3]
+        self.move_d = move_d = math.sqrt(dx*dx + dy*dy + dz*dz)
         if not move_d:
             # Extrude only move
             self.move_d = move_d = abs(axes_d[3])
@@ -81,36 +103,109 @@ class Move:
         self.accel_t = accel_r * self.move_d / ((start_v + cruise_v) * 0.5)
         self.cruise_t = cruise_r * self.move_d / cruise_v
         self.decel_t = decel_r * self.move_d / ((end_v + cruise_v) * 0.5)
-    def move(self):
-        # Generate step times for the move
-        next_move_time = self.toolhead.get_next_move_time()
-        if self.is_kinematic_move:
-            self.toolhead.kin.move(next_move_time, self)
-        if self.axes_d[3]:
-            self.toolhead.extruder.move(next_move_time, self)
-        self.toolhead.update_move_time(
-            self.accel_t + self.cruise_t + self.decel_t)
 
 LOOKAHEAD_FLUSH_TIME = 0.250
+LAZY_CHECK_EPSILON = 1e-15
 
 # Class to track a list of pending move requests and to facilitate
 # "look-ahead" across moves to reduce acceleration between moves.
 class MoveQueue:
-    def __init__(self):
+    def __init__(self, toolhead):
+        self.toolhead = toolhead
         self.extruder_lookahead = None
         self.queue = []
         self.leftover = 0
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        self._reset_lazy_check()
     def reset(self):
         del self.queue[:]
         self.leftover = 0
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        self._reset_lazy_check()
+    # Incremental lazy flush check.  A lazy traversal flushes moves
+    # once it finds a second move that can accelerate (from the end of
+    # the queue).  The first such move is the last move that can't
+    # reach its max_smoothed_v2 from the stop at the end of the queue
+    # (the "limited" move).  Appending moves never changes the
+    # smoothed_v2 of a limited move or of any move before it, so after
+    # a traversal that flushed nothing only the moves after the last
+    # limited move need to be checked again.  The moves after it are
+    # tracked with the running sum of their smooth_delta_v2 so that
+    # the next limited move can be found without a traversal.
+    def _reset_lazy_check(self):
+        self.lazy_limited = None
+        self.lazy_sum_v2 = 0.
+        self.lazy_stack_pos = 0
+        self.lazy_stack_v2 = []
+        self.lazy_stack_index = []
+    def _add_lazy_move(self, index, move):
+        # The move becomes limited once the sum of smooth_delta_v2 from
+        # it to the end of the queue exceeds its max_smoothed_v2.  Keep
+        # the moves that are not followed by a move that becomes
+        # limited first (their thresholds are increasing).
+        threshold_v2 = move.max_smoothed_v2 + self.lazy_sum_v2
+        self.lazy_sum_v2 += move.smooth_delta_v2
+        stack_v2 = self.lazy_stack_v2
+        while (len(stack_v2) > self.lazy_stack_pos
+               and stack_v2[-1] >= threshold_v2):
+            stack_v2.pop()
+            self.lazy_stack_index.pop()
+        stack_v2.append(threshold_v2)
+        self.lazy_stack_index.append(index)
+    def _note_lazy_traversal(self, limited):
+        # A full lazy traversal flushed nothing - track the moves after
+        # the last limited move
+        self._reset_lazy_check()
+        if limited is None:
+            limited = self.leftover - 1
+        self.lazy_limited = limited
+        queue = self.queue
+        for i in range(limited + 1, len(queue)):
+            self._add_lazy_move(i, queue[i])
+    def _check_lazy_flush(self):
+        # Returns True if a full traversal is needed
+        sum_v2 = self.lazy_sum_v2
+        margin = sum_v2 * (len(self.queue) + 4) * LAZY_CHECK_EPSILON
+        stack_v2 = self.lazy_stack_v2
+        pos = bisect.bisect_left(stack_v2, sum_v2 + margin,
+                                 self.lazy_stack_pos)
+        if pos == self.lazy_stack_pos:
+            # The last limited move is unchanged - nothing to flush
+            return False
+        if stack_v2[pos-1] > sum_v2 - margin:
+            # Too close to call with the rounding of the running sum
+            return True
+        # Repeat the traversal between the new and the old last limited
+        # moves (the moves after the new one can't accelerate and the
+        # moves before the old one are unchanged)
+        limited = self.lazy_stack_index[pos-1]
+        queue = self.queue
+        next_smoothed_v2 = queue[limited].max_smoothed_v2
+        delayed = False
+        for i in range(limited-1, max(self.lazy_limited, self.leftover)-1, -1):
+            move = queue[i]
+            reachable_smoothed_v2 = next_smoothed_v2 + move.smooth_delta_v2
+            smoothed_v2 = min(move.max_smoothed_v2, reachable_smoothed_v2)
+            if smoothed_v2 < reachable_smoothed_v2:
+                if (smoothed_v2 + move.smooth_delta_v2 > next_smoothed_v2
+                    or delayed):
+                    # Found a second move that can accelerate
+                    return True
+            else:
+                delayed = True
+            next_smoothed_v2 = smoothed_v2
+        self.lazy_limited = limited
+        self.lazy_stack_pos = pos
+        return False
     def set_flush_time(self, flush_time):
         self.junction_flush = flush_time
     def set_extruder(self, extruder):
         self.extruder_lookahead = extruder.lookahead
     def flush(self, lazy=False):
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        if (lazy and self.lazy_limited is not None
+            and not self._check_lazy_flush()):
+            return
         update_flush_count = lazy
         queue = self.queue
         flush_count = len(queue)
@@ -119,6 +214,7 @@ class MoveQueue:
         # after the last move.
         delayed = []
         next_end_v2 = next_smoothed_v2 = peak_cruise_v2 = 0.
+        limited = None
         for i in range(flush_count-1, self.leftover-1, -1):
             move = queue[i]
             reachable_start_v2 = next_end_v2 + move.delta_v2
@@ -131,9 +227,12 @@ class MoveQueue:
                     or delayed):
                     # This move can decelerate or this is a full accel
                     # move after a full decel move
-                    if update_flush_count and peak_cruise_v2:
-                        flush_count = i
-                        update_flush_count = False
+                    if update_flush_count:
+                        if peak_cruise_v2:
+                            flush_count = i
+                            update_flush_count = False
+                        else:
+                            limited = i
                     peak_cruise_v2 = min(move.max_cruise_v2, (
                         smoothed_v2 + reachable_smoothed_v2) * .5)
                     if delayed:
@@ -154,21 +253,28 @@ class MoveQueue:
                 delayed.append((move, start_v2, next_end_v2))
             next_end_v2 = start_v2
             next_smoothed_v2 = smoothed_v2
-        if update_flush_count:
+        if lazy and (update_flush_count or not flush_count):
+            # No moves can be flushed yet
+            self._note_lazy_traversal(limited)
             return
+        self._reset_lazy_check()
         # Allow extruder to do its lookahead
         move_count = self.extruder_lookahead(queue, flush_count, lazy)
         # Generate step times for all moves ready to be flushed
-        for move in queue[:move_count]:
-            move.move()
+        if move_count:
+            self.toolhead.process_moves(queue[:move_count])
         # Remove processed moves from the queue
         self.leftover = flush_count - move_count
         del queue[:move_count]
     def add_move(self, move):
         self.queue.append(move)
         if len(self.queue) == 1:
+            if self.lazy_limited is not None:
+                self._add_lazy_move(0, move)
             return
         move.calc_junction(self.queue[-2])
+        if self.lazy_limited is not None:
+            self._add_lazy_move(len(self.queue) - 1, move)
         self.junction_flush -= move.min_move_t
         if self.junction_flush <= 0.:
             # There are enough queued moves to return to zero velocity
@@ -176,13 +282,71 @@ class MoveQueue:
             # least one move can be flushed.
             self.flush(lazy=True)
 
+# Alternative MoveQueue that stores the lookahead parameters of each
+# queued move in C arrays and performs the flush calculations in C.
+class ArrayMoveQueue(MoveQueue):
+    def __init__(self, toolhead):
+        MoveQueue.__init__(self, toolhead)
+        self.ffi_main, self.ffi_lib = chelper.get_ffi()
+        self.lookahead = self.ffi_main.gc(
+            self.ffi_lib.lookahead_alloc(), self.ffi_lib.lookahead_free)
+    def reset(self):
+        MoveQueue.reset(self)
+        self.ffi_lib.lookahead_reset(self.lookahead)
+    def flush(self, lazy=False):
+        self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        queue = self.queue
+        flush_count = self.ffi_lib.lookahead_flush(
+            self.lookahead, self.leftover, lazy)
+        if flush_count < 0:
+            return
+        # Copy the calculated junctions to the move objects
+        junctions = self.ffi_lib.lookahead_get_junctions(self.lookahead)
+        for i in range(self.leftover, flush_count):
+            move = queue[i]
+            mj = junctions[i]
+            move.accel_r = mj.accel_r
+            move.cruise_r = mj.cruise_r
+            move.decel_r = mj.decel_r
+            move.start_v = mj.start_v
+            move.cruise_v = mj.cruise_v
+            move.end_v = mj.end_v
+            move.accel_t = mj.accel_t
+            move.cruise_t = mj.cruise_t
+            move.decel_t = mj.decel_t
+        # Allow extruder to do its lookahead
+        move_count = self.extruder_lookahead(queue, flush_count, lazy)
+        # Generate step times for all moves ready to be flushed
+        if move_count:
+            self.toolhead.process_moves(queue[:move_count])
+        # Remove processed moves from the queue
+        self.leftover = flush_count - move_count
+        del queue[:move_count]
+        self.ffi_lib.lookahead_expire(self.lookahead, move_count)
+    def add_move(self, move):
+        queue = self.queue
+        if queue:
+            move.calc_junction(queue[-1])
+        queue.append(move)
+        self.ffi_lib.lookahead_add_move(
+            self.lookahead, move.move_d, move.max_start_v2, move.max_cruise_v2
+            , move.delta_v2, move.max_smoothed_v2, move.smooth_delta_v2)
+        if len(queue) == 1:
+            return
+        self.junction_flush -= move.min_move_t
+        if self.junction_flush <= 0.:
+            self.flush(lazy=True)
+
 STALL_TIME = 0.100
+COALESCE_MAX_MOVES = 64
 
 # Main code to track events (and their timing) on the printer toolhead
 class ToolHead:
     def __init__(self, printer, config):
         self.printer = printer
         self.reactor = printer.reactor
+        self.mcu = printer.mcu
+        self.all_mcus = printer.get_mcus()
         self.extruder = extruder.DummyExtruder()
         kintypes = {'cartesian': cartesian.CartKinematics,
                     'corexy': corexy.CoreXYKinematics,
@@ -195,9 +359,19 @@ class ToolHead:
             , above=0., maxval=self.max_accel)
         self.junction_deviation = config.getfloat(
             'junction_deviation', 0.02, above=0.)
-        self.move_queue = MoveQueue()
+        queuetypes = {'object': MoveQueue, 'array': ArrayMoveQueue}
+        self.move_queue = config.getchoice(
+            'move_queue', queuetypes, 'object')(self)
         self.move_queue.set_extruder(self.extruder)
         self.commanded_pos = [0., 0., 0., 0.]
+        self.move_pool = []
+        # Collinear move coalescing
+        self.coalesce_tolerance = config.getfloat(
+            'move_coalesce_tolerance', 0., minval=0.)
+        self.coalesce_move = None
+        self.coalesce_speed = 0.
+        self.coalesce_points = []
+        self.move_count = self.merge_count = 0
         # Print time tracking
         self.buffer_time_low = config.getfloat(
             'buffer_time_low', 1.000, above=0.)
@@ -227,34 +401,59 @@ class ToolHead:
         for e in extruder.get_printer_extruders(printer):
             e.set_max_jerk(xy_halt, self.max_speed, self.max_accel)
     # Print time tracking
+    def _flush_moves(self, flush_time):
+        for m in self.all_mcus:
+            m.flush_moves(flush_time, self.print_time)
+    def _get_buffer_time(self, eventtime, print_time):
+        # The mcu with the least buffered time limits the queue
+        return min([m.get_print_buffer_time(eventtime, print_time)
+                    for m in self.all_mcus])
     def update_move_time(self, movetime):
         self.print_time += movetime
         flush_to_time = self.print_time - self.move_flush_time
-        self.printer.mcu.flush_moves(flush_to_time)
+        self._flush_moves(flush_to_time)
+    def process_moves(self, moves):
+        # Generate step times for a batch of moves and then flush the
+        # mcu step queues once for the whole batch
+        move_time = self.get_next_move_time()
+        kin_move = self.kin.move
+        extruder_move = self.extruder.move
+        for move in moves:
+            if move.is_kinematic_move:
+                kin_move(move_time, move)
+            if move.axes_d[3]:
+                extruder_move(move_time, move)
+            move_time += move.accel_t + move.cruise_t + move.decel_t
+        self.print_time = move_time
+        self._flush_moves(move_time - self.move_flush_time)
+        # The moves are retired - make them available for reuse
+        self.move_pool.extend(moves)
     def get_next_move_time(self):
         if self.synch_print_time:
             curtime = self.reactor.monotonic()
             if self.print_time:
-                buffer_time = self.printer.mcu.get_print_buffer_time(
-                    curtime, self.print_time)
+                buffer_time = self._get_buffer_time(curtime, self.print_time)
                 self.print_time += max(self.buffer_time_start - buffer_time, 0.)
                 if self.forced_synch:
                     self.print_stall += 1
                     self.forced_synch = False
             else:
-                self.printer.mcu.set_print_start_time(curtime)
+                for m in self.all_mcus:
+                    m.set_print_start_time(curtime)
                 self.print_time = self.buffer_time_start
                 self._reset_motor_off()
             self.reactor.update_timer(self.flush_timer, self.reactor.NOW)
             self.synch_print_time = False
         return self.print_time
     def _flush_lookahead(self, must_synch=False):
+        if self.coalesce_move is not None:
+            self._flush_coalesce()
         synch_print_time = self.synch_print_time
         self.move_queue.flush()
         if synch_print_time or must_synch:
             self.synch_print_time = True
             self.move_queue.set_flush_time(self.buffer_time_high)
-            self.printer.mcu.flush_moves(self.print_time)
+            self._flush_moves(self.print_time)
     def get_last_move_time(self):
         self._flush_lookahead()
         return self.get_next_move_time()
@@ -273,8 +472,7 @@ class ToolHead:
             return
         # Check if there are lots of queued moves and stall if so
         while 1:
-            buffer_time = self.printer.mcu.get_print_buffer_time(
-                eventtime, self.print_time)
+            buffer_time = self._get_buffer_time(eventtime, self.print_time)
             stall_time = buffer_time - self.buffer_time_high
             if stall_time <= 0.:
                 break
@@ -290,8 +488,7 @@ class ToolHead:
                 if not self.print_time:
                     return self.reactor.NEVER
             print_time = self.print_time
-            buffer_time = self.printer.mcu.get_print_buffer_time(
-                eventtime, print_time)
+            buffer_time = self._get_buffer_time(eventtime, print_time)
             if buffer_time > self.buffer_time_low:
                 # Running normally - reschedule check
                 return eventtime + buffer_time - self.buffer_time_low
@@ -325,6 +522,13 @@ class ToolHead:
             self.force_shutdown()
         return self.reactor.NEVER
     # Movement commands
+    def alloc_move(self, start_pos, end_pos, speed):
+        if self.move_pool:
+            move = self.move_pool.pop()
+        else:
+            move = Move(self)
+        move.setup(start_pos, end_pos, speed)
+        return move
     def get_position(self):
         return list(self.commanded_pos)
     def set_position(self, newpos):
@@ -333,17 +537,84 @@ class ToolHead:
         self.kin.set_position(newpos)
     def move(self, newpos, speed):
         speed = min(speed, self.max_speed)
-        move = Move(self, self.commanded_pos, newpos, speed)
+        move = self.alloc_move(self.commanded_pos, newpos, speed)
         if not move.move_d:
+            self.move_pool.append(move)
             return
         if move.is_kinematic_move:
             self.kin.check_move(move)
         if move.axes_d[3]:
             self.extruder.check_move(move)
         self.commanded_pos[:] = newpos
-        self.move_queue.add_move(move)
+        if self.coalesce_tolerance:
+            self._coalesce(move, speed)
+        else:
+            self.move_queue.add_move(move)
         if self.print_time > self.need_check_stall:
             self._check_stall()
+    # Collinear move coalescing
+    def _flush_coalesce(self):
+        self.move_queue.add_move(self.coalesce_move)
+        self.coalesce_move = None
+        del self.coalesce_points[:]
+    def _coalesce(self, move, speed):
+        self.move_count += 1
+        cmove = self.coalesce_move
+        if cmove is not None:
+            merged_move = self._merge_moves(cmove, move, speed)
+            if merged_move is not None:
+                self.coalesce_move = merged_move
+                self.coalesce_points.append(cmove.end_pos[:3])
+                self.merge_count += 1
+                self.move_pool.append(cmove)
+                self.move_pool.append(move)
+                return
+            self._flush_coalesce()
+        if not move.is_kinematic_move:
+            self.move_queue.add_move(move)
+            return
+        self.coalesce_move = move
+        self.coalesce_speed = speed
+    def _merge_moves(self, cmove, move, speed):
+        if (speed != self.coalesce_speed or not move.is_kinematic_move
+            or len(self.coalesce_points) >= COALESCE_MAX_MOVES):
+            return None
+        # Moves must have the same extrusion ratio
+        extrude, cextrude = move.axes_d[3], cmove.axes_d[3]
+        if extrude or cextrude:
+            if extrude * cextrude <= 0.:
+                return None
+            if (move.extrude_r > cmove.extrude_r * extruder.EXTRUDE_DIFF_IGNORE
+                or cmove.extrude_r > move.extrude_r*extruder.EXTRUDE_DIFF_IGNORE):
+                return None
+        # All the intermediate points must be within the chord
+        # tolerance of the new line and must advance along it
+        start_pos, end_pos = cmove.start_pos, move.end_pos
+        sx, sy, sz = start_pos[:3]
+        dx, dy, dz = end_pos[0] - sx, end_pos[1] - sy, end_pos[2] - sz
+        chord_d2 = dx*dx + dy*dy + dz*dz
+        max_dev_d2 = self.coalesce_tolerance**2 * chord_d2
+        last_proj = 0.
+        for pos in self.coalesce_points + [cmove.end_pos]:
+            px, py, pz = pos[0] - sx, pos[1] - sy, pos[2] - sz
+            proj = px*dx + py*dy + pz*dz
+            if proj <= last_proj or proj >= chord_d2:
+                return None
+            # Squared distance from the line (scaled by chord_d2)
+            dev_d2 = (px*px + py*py + pz*pz) * chord_d2 - proj*proj
+            if dev_d2 > max_dev_d2:
+                return None
+            last_proj = proj
+        # Check the merged move the same way as any other move
+        merged_move = self.alloc_move(start_pos, end_pos, speed)
+        try:
+            self.kin.check_move(merged_move)
+            if merged_move.axes_d[3]:
+                self.extruder.check_move(merged_move)
+        except homing.EndstopError:
+            self.move_pool.append(merged_move)
+            return None
+        return merged_move
     def home(self, homing_state):
         self.kin.home(homing_state)
     def dwell(self, delay):
@@ -378,16 +649,24 @@ class ToolHead:
         print_time = self.print_time
         if print_time:
             is_active = True
-            buffer_time = max(0., self.printer.mcu.get_print_buffer_time(
-                eventtime, print_time))
+            buffer_time = max(0., self._get_buffer_time(eventtime, print_time))
         else:
             is_active = eventtime < self.last_print_end_time + 60.
-        return is_active, "print_time=%.3f buffer_time=%.3f print_stall=%d" % (
+        msg = "print_time=%.3f buffer_time=%.3f print_stall=%d" % (
             print_time, buffer_time, self.print_stall)
+        if self.coalesce_tolerance:
+            merge_ratio = 0.
+            if self.move_count:
+                merge_ratio = float(self.merge_count) / self.move_count
+            msg += " merge_ratio=%.3f" % (merge_ratio,)
+        return is_active, msg
     def force_shutdown(self):
         try:
-            self.printer.mcu.force_shutdown()
+            for m in self.all_mcus:
+                m.force_shutdown()
             self.move_queue.reset()
+            self.coalesce_move = None
+            del self.coalesce_points[:]
             self.reset_print_time()
         except:
             logging.exception("Exception in force_shutdown")
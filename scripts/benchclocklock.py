@@ -0,0 +1,101 @@
+#!/usr/bin/env python2
+# Measure main thread clock query latency while status messages arrive
+#
+# Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, threading
+
+MCU_FREQ = 16000000.
+SLOW_TIME = 0.000020
+
+def status_params(starttime, clock_offset=0):
+    now = time.time()
+    clock = int((now - starttime) * MCU_FREQ) + clock_offset
+    return {'#name': 'status', 'clock': clock & 0xffffffff,
+            'high': clock >> 32, '#sent_time': now - 0.0005,
+            '#receive_time': now}
+
+# Load the initial clock like the get_uptime response in connect()
+# does (supports both the clock_state and the older attribute layout)
+def seed_clock(sr, params):
+    clock = (params['high'] << 32) | params['clock']
+    with sr.lock:
+        if hasattr(sr, 'clock_state'):
+            sr._update_clock(params['#sent_time'], params['#receive_time']
+                             , clock)
+        else:
+            sr.last_ack_clock = clock
+            sr.last_ack_time = params['#receive_time']
+            sr._add_clock_sample(params['#sent_time'], sr.last_ack_time
+                                 , clock)
+
+# Dispatch status messages as fast as possible, with the same handler
+# lookup under the lock that the receive thread performs
+def status_thread(sr, starttime, stop, counts):
+    count = 0
+    while not stop:
+        params = status_params(starttime)
+        with sr.lock:
+            hdl = sr.handlers.get((params['#name'], None), sr.handle_default)
+        hdl(params)
+        count += 1
+    counts.append(count)
+
+def measure(sr, duration):
+    latencies = []
+    endtime = time.time() + duration
+    while time.time() < endtime:
+        st = time.time()
+        sr.get_clock(st)
+        sr.translate_clock(12345)
+        sr.get_last_clock()
+        latencies.append(time.time() - st)
+    slow = [l for l in latencies if l > SLOW_TIME]
+    total = sum(latencies)
+    latencies.sort()
+    return ("calls=%d mean=%.2fus p99.9=%.1fus max=%.1fus"
+            " slow(>%dus)=%d (%.1fms)" % (
+                len(latencies), total * 1000000. / len(latencies),
+                latencies[len(latencies) * 999 // 1000] * 1000000.,
+                latencies[-1] * 1000000., SLOW_TIME * 1000000.,
+                len(slow), sum(slow) * 1000.))
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-k", "--klippy", type="string", dest="klippy",
+                    default=os.path.join(os.path.dirname(__file__),
+                                         '../klippy'),
+                    help="klippy directory to benchmark")
+    opts.add_option("-t", "--time", type="float", dest="duration",
+                    default=2., help="seconds to measure each case")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    sys.path.insert(0, options.klippy)
+    import reactor, serialhdl
+    sr = serialhdl.SerialReader(reactor.Reactor(), '/dev/null', 250000)
+    rfd, wfd = os.pipe()
+    sr.serialqueue = sr.ffi_lib.serialqueue_alloc(wfd, 1)
+    # Build a clock estimate from two samples one second apart
+    starttime = time.time()
+    seed_clock(sr, status_params(starttime))
+    time.sleep(1.)
+    sr.handle_status(status_params(starttime))
+    print "idle      %s" % (measure(sr, options.duration),)
+    stop = []
+    counts = []
+    thread = threading.Thread(
+        target=status_thread, args=(sr, starttime, stop, counts))
+    thread.start()
+    res = measure(sr, options.duration)
+    stop.append(1)
+    thread.join()
+    print "contended %s status_msgs=%d" % (res, counts[0])
+    sr.ffi_lib.serialqueue_exit(sr.serialqueue)
+    sr.ffi_lib.serialqueue_free(sr.serialqueue)
+    sr.serialqueue = None
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python2
+# Count the Move objects created while running a G-Code file in batch mode
+#
+# Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, resource, tempfile, shutil
+
+# Wrap a method so that 'func' is called with its arguments first
+def wrap_method(cls, name, func):
+    orig = cls.__dict__[name]
+    def wrapper(self, *args):
+        func(self, *args)
+        return orig(self, *args)
+    setattr(cls, name, wrapper)
+
+def main():
+    usage = "%prog [options] <config file> <gcode file> <dictionary>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-k", "--klippy", type="string", dest="klippy",
+                    default=os.path.join(os.path.dirname(__file__),
+                                         '../klippy'),
+                    help="klippy directory to benchmark")
+    options, args = opts.parse_args()
+    if len(args) != 3:
+        opts.error("Incorrect number of arguments")
+    conffile, gcodefile, dictfile = args
+    sys.path.insert(0, options.klippy)
+    import klippy, toolhead
+    # Count Move objects and track the length of the lookahead queue
+    stats = {'moves': 0, 'queue': 0}
+    def note_move(move, *args):
+        stats['moves'] += 1
+    def note_queue(mq, move):
+        stats['queue'] = max(stats['queue'], len(mq.queue) + 1)
+    wrap_method(toolhead.Move, '__init__', note_move)
+    for name in ['MoveQueue', 'ArrayMoveQueue']:
+        cls = getattr(toolhead, name, None)
+        if cls is not None and 'add_move' in cls.__dict__:
+            wrap_method(cls, 'add_move', note_queue)
+    # Run klippy in batch mode
+    tmpdir = tempfile.mkdtemp()
+    sys.argv = [os.path.join(options.klippy, 'klippy.py'), conffile,
+                '-i', gcodefile, '-o', os.path.join(tmpdir, 'out.serial'),
+                '-d', dictfile, '-l', os.path.join(tmpdir, 'klippy.log')]
+    starttime = time.time()
+    try:
+        klippy.main()
+    finally:
+        shutil.rmtree(tmpdir)
+    elapsed = time.time() - starttime
+    lines = sum(1 for line in open(gcodefile))
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print "%d lines: %d Move objects, peak lookahead queue %d moves" % (
+        lines, stats['moves'], stats['queue'])
+    print "wall time %.1fs, peak RSS %.1fMB" % (elapsed, maxrss / 1024.)
+
+if __name__ == '__main__':
+    main()
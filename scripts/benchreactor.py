@@ -0,0 +1,129 @@
+#!/usr/bin/env python2
+# Micro-benchmark of the reactor timer, fd, and greenlet pause code
+#
+# Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, random
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import reactor
+
+# Register 'count' timers that are scheduled far in the future (like
+# heater and stats timers waiting for their next update).  Note that
+# the benchmarks return a due time after calling end() so that the
+# reactor doesn't sleep before noticing it should exit.
+def add_idle_timers(r, count):
+    waketime = r.monotonic() + 3600.
+    return [r.register_timer((lambda e: r.NEVER), waketime)
+            for i in range(count)]
+
+# Register 'count' pipes that never become readable
+def add_idle_fds(r, count):
+    fds = [os.pipe() for i in range(count)]
+    for rfd, wfd in fds:
+        r.register_fd(rfd, (lambda e: None))
+    return fds
+
+# A single timer that rearms itself 'loops' times
+def bench_rearm(r, loops):
+    state = [0]
+    def callback(eventtime):
+        state[0] += 1
+        if state[0] >= loops:
+            r.end()
+            return eventtime
+        return eventtime
+    r.register_timer(callback, r.NOW)
+    r.run()
+
+# A timer callback that pauses its greenlet 'loops' times
+def bench_pause(r, loops):
+    def callback(eventtime):
+        for i in range(loops):
+            eventtime = r.pause(eventtime)
+        r.end()
+        return eventtime
+    r.register_timer(callback, r.NOW)
+    r.run()
+
+# Timers that reschedule each other at random times
+def bench_churn(r, loops):
+    rnd = random.Random(0)
+    timers = add_idle_timers(r, 64)
+    state = [0]
+    def callback(eventtime):
+        state[0] += 1
+        if state[0] >= loops:
+            r.end()
+            return eventtime
+        for t in rnd.sample(timers, 4):
+            r.update_timer(t, eventtime + rnd.random())
+        return eventtime
+    r.register_timer(callback, r.NOW)
+    r.run()
+
+# Send lines through a pipe one at a time (like a host streaming
+# G-Code) while a stats timer runs every 10ms
+def bench_stream(r, loops):
+    rfd, wfd = os.pipe()
+    latencies = []
+    state = [r.monotonic()]
+    def process(eventtime):
+        os.read(rfd, 4096)
+        latencies.append(r.monotonic() - state[0])
+        if len(latencies) >= loops:
+            r.end()
+            r.update_timer(stats_timer, r.NOW)
+            return
+        state[0] = r.monotonic()
+        os.write(wfd, "G1 X10 Y10 F6000\n")
+    def stats(eventtime):
+        return eventtime + .010
+    r.register_fd(rfd, process)
+    stats_timer = r.register_timer(stats, r.NOW)
+    os.write(wfd, "G1 X10 Y10 F6000\n")
+    r.run()
+    latencies.sort()
+    return "dispatch latency p50=%.1fus p99=%.1fus" % (
+        latencies[len(latencies) // 2] * 1000000.,
+        latencies[len(latencies) * 99 // 100] * 1000000.)
+
+BENCHMARKS = [("rearm", bench_rearm), ("pause", bench_pause),
+              ("churn", bench_churn), ("stream", bench_stream)]
+REACTORS = {"select": reactor.SelectReactor, "poll": reactor.PollReactor,
+            "epoll": reactor.EPollReactor}
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-t", "--timers", type="int", dest="timers", default=500,
+                    help="number of idle timers to register")
+    opts.add_option("-f", "--fds", type="int", dest="fds", default=16,
+                    help="number of idle file descriptors to register")
+    opts.add_option("-r", "--reactor", type="choice", dest="reactor",
+                    choices=sorted(REACTORS), default=None,
+                    help="reactor implementation (default is automatic)")
+    opts.add_option("-l", "--loops", type="int", dest="loops", default=20000,
+                    help="number of iterations of each benchmark")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    reactor_class = REACTORS.get(options.reactor, reactor.Reactor)
+    print "Using %s with %d idle timers and %d idle fds" % (
+        reactor_class.__name__, options.timers, options.fds)
+    for name, func in BENCHMARKS:
+        r = reactor_class()
+        add_idle_timers(r, options.timers)
+        fds = add_idle_fds(r, options.fds)
+        starttime = time.time()
+        res = func(r, options.loops)
+        elapsed = time.time() - starttime
+        for rfd, wfd in fds:
+            os.close(rfd)
+            os.close(wfd)
+        print "%-6s %d loops: %.3fs (%.2fus per loop) %s" % (
+            name, options.loops, elapsed, elapsed * 1000000. / options.loops,
+            res or "")
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,7 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 
 import sys, os, subprocess, optparse, logging, shlex, socket, time
-import json, zlib
+import json, zlib, struct
 sys.path.append('./klippy')
 import msgproto
 
@@ -202,6 +202,10 @@ def build_identify(cmd_by_id, msg_to_id, responses, static_strings
         if i % 8 == 0:
             out.append('\n   ')
         out.append(" 0x%02x," % (ord(zdata[i]),))
+    # The crc32 and size of the identify data (so hosts can cache it)
+    crc = zlib.crc32(zdata) & 0xffffffff
+    info = struct.pack('<II', crc, len(zdata))
+    infoout = ["0x%02x" % (ord(c),) for c in info]
     fmt = """
 const uint8_t command_identify_data[] PROGMEM = {%s
 };
@@ -209,8 +213,14 @@ const uint8_t command_identify_data[] PROGMEM = {%s
 // Identify size = %d (%d uncompressed)
 const uint32_t command_identify_size PROGMEM
     = ARRAY_SIZE(command_identify_data);
+
+// Identify crc32 = 0x%08x
+const uint8_t command_identify_info[] PROGMEM = {
+    %s
+};
 """
-    return data, fmt % (''.join(out), len(zdata), len(data))
+    return data, fmt % (''.join(out), len(zdata), len(data)
+                        , crc, ', '.join(infoout))
 
 
 ######################################################################
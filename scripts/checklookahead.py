@@ -0,0 +1,224 @@
+#!/usr/bin/env python2
+# Compare the incremental lazy lookahead of MoveQueue to a full traversal
+#
+# Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, random, math, time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import toolhead, extruder
+
+JUNCTION_FIELDS = ['accel_r', 'cruise_r', 'decel_r', 'start_v', 'cruise_v',
+                   'end_v', 'accel_t', 'cruise_t', 'decel_t']
+
+# MoveQueue that runs the full lookahead traversal on every flush (the
+# implementation before the incremental lazy check)
+class ReferenceMoveQueue(toolhead.MoveQueue):
+    def flush(self, lazy=False):
+        self.junction_flush = toolhead.LOOKAHEAD_FLUSH_TIME
+        update_flush_count = lazy
+        queue = self.queue
+        flush_count = len(queue)
+        delayed = []
+        next_end_v2 = next_smoothed_v2 = peak_cruise_v2 = 0.
+        for i in range(flush_count-1, self.leftover-1, -1):
+            move = queue[i]
+            reachable_start_v2 = next_end_v2 + move.delta_v2
+            start_v2 = min(move.max_start_v2, reachable_start_v2)
+            reachable_smoothed_v2 = next_smoothed_v2 + move.smooth_delta_v2
+            smoothed_v2 = min(move.max_smoothed_v2, reachable_smoothed_v2)
+            if smoothed_v2 < reachable_smoothed_v2:
+                if (smoothed_v2 + move.smooth_delta_v2 > next_smoothed_v2
+                    or delayed):
+                    if update_flush_count and peak_cruise_v2:
+                        flush_count = i
+                        update_flush_count = False
+                    peak_cruise_v2 = min(move.max_cruise_v2, (
+                        smoothed_v2 + reachable_smoothed_v2) * .5)
+                    if delayed:
+                        if not update_flush_count and i < flush_count:
+                            for m, ms_v2, me_v2 in delayed:
+                                mc_v2 = min(peak_cruise_v2, ms_v2)
+                                m.set_junction(min(ms_v2, mc_v2), mc_v2
+                                               , min(me_v2, mc_v2))
+                        del delayed[:]
+                if not update_flush_count and i < flush_count:
+                    cruise_v2 = min((start_v2 + reachable_start_v2) * .5
+                                    , move.max_cruise_v2, peak_cruise_v2)
+                    move.set_junction(min(start_v2, cruise_v2), cruise_v2
+                                      , min(next_end_v2, cruise_v2))
+            else:
+                delayed.append((move, start_v2, next_end_v2))
+            next_end_v2 = start_v2
+            next_smoothed_v2 = smoothed_v2
+        if update_flush_count:
+            return
+        move_count = self.extruder_lookahead(queue, flush_count, lazy)
+        if move_count:
+            self.toolhead.process_moves(queue[:move_count])
+        self.leftover = flush_count - move_count
+        del queue[:move_count]
+
+# Stand-in for the extruder that delays flushes like pressure advance
+class FakeExtruder(extruder.DummyExtruder):
+    def __init__(self, lookahead_time):
+        self.pressure_advance_lookahead_time = lookahead_time
+    def lookahead(self, moves, flush_count, lazy):
+        return extruder.PrinterExtruder.lookahead.im_func(
+            self, moves, flush_count, lazy)
+
+# Stand-in for the toolhead that records the moves it is given
+class FakeToolHead:
+    def __init__(self, options, queuetype):
+        self.max_accel = options.accel
+        self.max_accel_to_decel = options.accel * .5
+        self.junction_deviation = options.junction_deviation
+        self.extruder = FakeExtruder(options.lookahead_time)
+        self.move_queue = queuetype(self)
+        self.move_queue.set_extruder(self.extruder)
+        self.results = []
+        self.queued = 0
+        # Time the lazy flushes made by add_move()
+        self.lazy_time = 0.
+        flush = self.move_queue.flush
+        def timed_flush(lazy=False):
+            start_time = time.time()
+            flush(lazy)
+            self.lazy_time += time.time() - start_time
+        self.move_queue.flush = timed_flush
+    def process_moves(self, moves):
+        # Note the number of moves queued when each move is flushed
+        for move in moves:
+            self.results.append(tuple(
+                [getattr(move, f) for f in JUNCTION_FIELDS]
+                + [move.extrude_max_corner_v, self.queued]))
+    def run(self, moves):
+        move_queue = self.move_queue
+        for start_pos, end_pos, speed, accel in moves:
+            move = toolhead.Move(self)
+            move.setup(start_pos, end_pos, speed)
+            if accel:
+                move.limit_speed(speed, accel)
+            self.queued += 1
+            move_queue.add_move(move)
+        lazy_time = self.lazy_time
+        move_queue.flush()
+        return self.results, lazy_time
+
+# Move streams
+def accel_stream(rnd, count):
+    # Tiny segments with a low acceleration that never reach their
+    # cruise speed - every lazy flush finds nothing to flush
+    moves = []
+    pos = [0., 0., 0., 0.]
+    angle = 0.
+    for i in range(count):
+        dist = .005 + rnd.random() * .01
+        angle += rnd.uniform(-.001, .001)
+        new_pos = [pos[0] + dist * math.cos(angle)
+                   , pos[1] + dist * math.sin(angle), 0.
+                   , pos[3] + dist * .05]
+        moves.append((pos, new_pos, 30., 1.))
+        pos = new_pos
+    return moves
+
+def mixed_stream(rnd, count):
+    # Runs of slowly accelerating segments broken up by corners, speed
+    # changes, and longer moves
+    moves = []
+    pos = [0., 0., 0., 0.]
+    angle = 0.
+    speed, accel = 3., .2
+    for i in range(count):
+        dist = .005 + rnd.random() * .01
+        if rnd.random() < .005:
+            angle += rnd.choice([rnd.uniform(-1., 1.), math.pi])
+        if rnd.random() < .005:
+            speed = rnd.uniform(1., 5.)
+            accel = rnd.uniform(.05, .5)
+        if rnd.random() < .002:
+            dist = rnd.uniform(1., 50.)
+        angle += rnd.uniform(-.001, .001)
+        new_pos = [pos[0] + dist * math.cos(angle)
+                   , pos[1] + dist * math.sin(angle), 0.
+                   , pos[3] + dist * .05]
+        moves.append((pos, new_pos, speed, accel))
+        pos = new_pos
+    return moves
+
+def random_stream(rnd, count):
+    # Segments with random lengths, directions, speeds, and accels
+    moves = []
+    pos = [0., 0., 0., 0.]
+    angle = 0.
+    for i in range(count):
+        if rnd.random() < .1:
+            dist = rnd.random() * 50.
+        else:
+            dist = .01 + rnd.random() * rnd.choice([.1, 1., 5.])
+        angle += rnd.choice([0., 0., rnd.uniform(-.3, .3), math.pi
+                             , rnd.uniform(-math.pi, math.pi)])
+        new_pos = [pos[0] + dist * math.cos(angle)
+                   , pos[1] + dist * math.sin(angle), pos[2]
+                   , pos[3] + dist * .05]
+        if rnd.random() < .02:
+            # Z hop
+            new_pos[2] += .2
+        speed = rnd.choice([5., 30., 100., 200., rnd.uniform(1., 300.)])
+        accel = rnd.choice([0., 0., 0., rnd.uniform(100., 3000.)])
+        moves.append((pos, new_pos, speed, accel))
+        pos = new_pos
+    return moves
+
+def compare(options, moves):
+    ref, ref_time = FakeToolHead(options, ReferenceMoveQueue).run(moves)
+    res, res_time = FakeToolHead(options, toolhead.MoveQueue).run(moves)
+    if len(ref) != len(res):
+        return ["flushed %d moves expected %d" % (len(res), len(ref))
+                ], ref_time, res_time
+    errors = ["move %d: %s expected %s" % (i, res[i], ref[i])
+              for i in range(len(ref)) if res[i] != ref[i]]
+    return errors, ref_time, res_time
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--count", type="int", dest="count", default=2000,
+                    help="number of moves in each random stream")
+    opts.add_option("-r", "--runs", type="int", dest="runs", default=20,
+                    help="number of random streams")
+    opts.add_option("-a", "--accel-count", type="int", dest="accel_count",
+                    default=50000, help="number of moves in the"
+                    " accelerating stream")
+    opts.add_option("--accel", type="float", dest="accel", default=3000.,
+                    help="toolhead max_accel")
+    opts.add_option("--junction-deviation", type="float",
+                    dest="junction_deviation", default=.02,
+                    help="toolhead junction_deviation")
+    opts.add_option("--lookahead-time", type="float", dest="lookahead_time",
+                    default=.010, help="pressure advance lookahead time")
+    opts.add_option("-s", "--seed", type="int", dest="seed", default=0,
+                    help="random number generator seed")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    rnd = random.Random(options.seed)
+    failures = 0
+    streams = [("accel", accel_stream(rnd, options.accel_count))]
+    for i in range(options.runs):
+        streams.append(("mixed%d" % (i,), mixed_stream(rnd, options.count)))
+        streams.append(("random%d" % (i,), random_stream(rnd, options.count)))
+    for name, moves in streams:
+        errors, ref_time, res_time = compare(options, moves)
+        print ("%s: %d moves, lazy flush time full %.3fs"
+               " incremental %.3fs: %d errors" % (
+            name, len(moves), ref_time, res_time, len(errors)))
+        for err in errors[:10]:
+            print "FAIL %s" % (err,)
+        if errors:
+            failures += 1
+    if failures:
+        sys.exit(-1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python2
+# Check the generated message encoders/parsers against the generic code
+#
+# Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, random, zlib, json
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import msgproto
+
+# Message formats covering every parameter type (used when no data
+# dictionary is given)
+DEFAULT_FORMATS = [
+    "empty", "get_uptime", "set_u32 v=%u", "set_i32 v=%i",
+    "set_u16 v=%hu", "set_i16 v=%hi", "set_byte v=%c",
+    "set_str s=%s", "set_pstr s=%.*s", "set_buf s=%*s",
+    "queue_step oid=%c interval=%u count=%hu add=%hi",
+    "mixed a=%i b=%s c=%hu d=%*s e=%c f=%.*s g=%hi h=%u",
+]
+
+# Values at and around the encoding length boundaries
+INT_EDGES = [0, 1, 0x1f, 0x20, 0x5f, 0x60, 0xfff, 0x1000, 0x2fff, 0x3000,
+             0x7ffff, 0x80000, 0x17ffff, 0x180000, 0x3ffffff, 0x4000000,
+             0xbffffff, 0xc000000, 0x7fffffff]
+
+# Size of each integer type (by its maximum encoded length)
+INT_BITS = {5: 32, 3: 16, 2: 8}
+
+def random_value(rnd, t):
+    if not t.is_int:
+        return str(bytearray(rnd.randrange(256)
+                             for i in range(rnd.randrange(48))))
+    bits = INT_BITS[t.max_length]
+    if t.signed:
+        low, high = -(1 << (bits - 1)), (1 << (bits - 1)) - 1
+    else:
+        low, high = 0, (1 << bits) - 1
+    if rnd.random() < .25:
+        v = rnd.choice(INT_EDGES) * rnd.choice([1, -1])
+        return min(high, max(low, v))
+    return rnd.randint(low, high)
+
+# Call a function and return its result (or the type of exception)
+def call(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    except Exception as e:
+        return type(e)
+
+def check_format(rnd, msgid, msgformat, loops):
+    mf = msgproto.MessageFormat(msgid, msgformat)
+    generic = msgproto.MessageFormat
+    for i in range(loops):
+        params = [random_value(rnd, t) for name, t in mf.param_names]
+        by_name = { name: v for (name, t), v in zip(mf.param_names, params) }
+        # Encoding
+        expect = generic.encode(mf, *params)
+        res = mf.encode(*params)
+        if res != expect:
+            return "encode%s: %s vs %s" % (tuple(params), res, expect)
+        res = mf.encode_by_name(**by_name)
+        if res != expect:
+            return "encode_by_name(%s): %s vs %s" % (by_name, res, expect)
+        # Parsing of valid and random data
+        for data in [expect, [msgid] + [rnd.randrange(256) for j in range(
+                rnd.randrange(2 + 6 * len(params)))]]:
+            data = bytearray(data)
+            expect_parse = call(generic.parse, mf, data, 0)
+            res = call(mf.parse, data, 0)
+            if res != expect_parse:
+                return "parse(%s): %s vs %s" % (
+                    list(data), res, expect_parse)
+    return None
+
+def load_dictionary(filename):
+    data = open(filename, 'rb').read()
+    try:
+        data = zlib.decompress(data)
+    except zlib.error:
+        pass
+    data = json.loads(data)
+    parsers = data.get('commands', []) + data.get('responses', [])
+    return [(int(msgid), msgformat)
+            for msgid, msgformat in data.get('messages', {}).items()
+            if int(msgid) in parsers]
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-d", "--dictionary", type="string", dest="dictionary",
+                    help="check the messages in a data dictionary file")
+    opts.add_option("-l", "--loops", type="int", dest="loops", default=2000,
+                    help="number of random values to check per message")
+    opts.add_option("-s", "--seed", type="int", dest="seed", default=0,
+                    help="random number generator seed")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    if options.dictionary is not None:
+        formats = load_dictionary(options.dictionary)
+    else:
+        formats = [(i + 1, f) for i, f in enumerate(DEFAULT_FORMATS)]
+    rnd = random.Random(options.seed)
+    failures = 0
+    for msgid, msgformat in sorted(formats):
+        err = check_format(rnd, msgid, msgformat, options.loops)
+        if err is not None:
+            print "FAIL %s: %s" % (msgformat, err)
+            failures += 1
+    print "Checked %d messages with %d random values each: %d failures" % (
+        len(formats), options.loops, failures)
+    if failures:
+        sys.exit(-1)
+
+if __name__ == '__main__':
+    main()
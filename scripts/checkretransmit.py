@@ -0,0 +1,260 @@
+#!/usr/bin/env python2
+# Check serialqueue retransmits against a lossy pty stand-in for the mcu
+#
+# Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, random, time, threading, tty, select
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import chelper, msgproto
+
+SERIAL_BAUD = 250000.
+BITS_PER_BYTE = 10.
+MCU_FREQ = 16000000.
+VALUE_FORMAT = "set_value value=%u"
+VALUE_MSGID = 10
+
+CF_NEED_SYNC, CF_NEED_VALID = 1<<0, 1<<1
+
+# Stand-in for the mcu side of the serial link.  The block framing,
+# sequence checking, and ack/nak replies follow command_get_message()
+# in src/command.c.  Faults are injected on the blocks the mcu reads
+# and on the replies it writes.
+class LossyMCU:
+    def __init__(self, fd, options):
+        self.fd = fd
+        self.options = options
+        self.rnd = random.Random(options.seed)
+        self.msgparser = msgproto.MessageParser()
+        self.value_format = msgproto.MessageFormat(VALUE_MSGID, VALUE_FORMAT)
+        self.input = bytearray()
+        self.sync_state = 0
+        self.next_sequence = msgproto.MESSAGE_DEST | 1
+        self.block_count = self.ack_count = 0
+        self.next_value = 0
+        self.errors = []
+        self.stats = dict.fromkeys(['dropped', 'corrupted', 'naks', 'acks'
+                                    , 'dropped_acks', 'delayed_acks'], 0)
+        self.replies = []
+        self.reply_time = 0.
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.done = False
+    # Fault injection
+    def check_block_fault(self, msglen):
+        self.block_count += 1
+        opts = self.options
+        if ((opts.drop_every and not self.block_count % opts.drop_every)
+            or self.rnd.random() < opts.loss):
+            # Block lost on the wire
+            self.stats['dropped'] += 1
+            del self.input[:msglen]
+            return True
+        if self.rnd.random() < opts.corrupt:
+            # Flip a bit in the block (the crc check then rejects it)
+            self.stats['corrupted'] += 1
+            bit = self.rnd.randrange(msglen * 8)
+            self.input[bit // 8] ^= 1 << (bit % 8)
+            return True
+        return False
+    def send_reply(self, is_ack):
+        opts = self.options
+        delay = opts.latency
+        if is_ack:
+            self.stats['acks'] += 1
+            self.ack_count += 1
+            if (opts.drop_ack_every
+                and not self.ack_count % opts.drop_ack_every):
+                self.stats['dropped_acks'] += 1
+                return
+            if (opts.delay_ack_every
+                and not self.ack_count % opts.delay_ack_every):
+                self.stats['delayed_acks'] += 1
+                delay += opts.ack_delay
+        else:
+            self.stats['naks'] += 1
+        msg = self.msgparser.encode(self.next_sequence, "")
+        # Replies share one serial line, so they are delivered in order
+        with self.lock:
+            self.reply_time = max(time.time() + delay, self.reply_time)
+            self.replies.append((self.reply_time, msg))
+            self.cond.notify()
+    def reply_thread(self):
+        while 1:
+            with self.lock:
+                while not self.replies and not self.done:
+                    self.cond.wait()
+                if self.done:
+                    return
+                reply_time, msg = self.replies[0]
+                now = time.time()
+                if reply_time > now:
+                    self.cond.wait(reply_time - now)
+                    continue
+                del self.replies[0]
+            os.write(self.fd, msg)
+    # Block handling (see command_get_message() in src/command.c)
+    def get_message(self):
+        buf = self.input
+        if buf and self.sync_state & CF_NEED_SYNC:
+            return self.need_sync()
+        if len(buf) < msgproto.MESSAGE_MIN:
+            return None
+        msglen = buf[msgproto.MESSAGE_POS_LEN]
+        if msglen < msgproto.MESSAGE_MIN or msglen > msgproto.MESSAGE_MAX:
+            return self.error()
+        msgseq = buf[msgproto.MESSAGE_POS_SEQ]
+        if (msgseq & ~msgproto.MESSAGE_SEQ_MASK) != msgproto.MESSAGE_DEST:
+            return self.error()
+        if len(buf) < msglen:
+            return None
+        if self.msgparser.check_packet(buf) != msglen:
+            return self.error()
+        if self.check_block_fault(msglen):
+            return False
+        self.sync_state &= ~CF_NEED_VALID
+        if msgseq != self.next_sequence:
+            # Lost message - discard messages until it is retransmitted
+            del buf[:msglen]
+            self.send_reply(False)
+            return False
+        self.next_sequence = (((msgseq + 1) & msgproto.MESSAGE_SEQ_MASK)
+                              | msgproto.MESSAGE_DEST)
+        self.send_reply(True)
+        block = buf[:msglen]
+        del buf[:msglen]
+        return block
+    def error(self):
+        if self.input[0] == msgproto.MESSAGE_SYNC_BYTE:
+            # Ignore (do not nak) leading SYNC bytes
+            del self.input[:1]
+            return False
+        self.sync_state |= CF_NEED_SYNC
+        return self.need_sync()
+    def need_sync(self):
+        pos = self.input.find(msgproto.MESSAGE_SYNC)
+        if pos >= 0:
+            self.sync_state &= ~CF_NEED_SYNC
+            del self.input[:pos+1]
+        else:
+            del self.input[:]
+        if self.sync_state & CF_NEED_VALID:
+            return False
+        self.sync_state |= CF_NEED_VALID
+        self.send_reply(False)
+        return False
+    def handle_block(self, block):
+        pos = msgproto.MESSAGE_HEADER_SIZE
+        while pos < len(block) - msgproto.MESSAGE_TRAILER_SIZE:
+            params, pos = self.value_format.parse(block, pos)
+            if params['value'] != self.next_value:
+                self.errors.append("got value %d expected %d" % (
+                    params['value'], self.next_value))
+            self.next_value = params['value'] + 1
+    def run(self, count):
+        rt = threading.Thread(target=self.reply_thread)
+        rt.start()
+        endtime = time.time() + self.options.timeout
+        while self.next_value < count and time.time() < endtime:
+            res = select.select([self.fd], [], [], .100)
+            if not res[0]:
+                continue
+            self.input.extend(os.read(self.fd, 4096))
+            while 1:
+                block = self.get_message()
+                if block is None:
+                    break
+                if block:
+                    self.handle_block(block)
+        with self.lock:
+            self.done = True
+            self.cond.notify()
+        rt.join()
+
+def parse_stats(stats):
+    return dict(s.split('=', 1) for s in stats.split())
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--count", type="int", dest="count", default=5000,
+                    help="number of commands to send")
+    opts.add_option("-l", "--loss", type="float", dest="loss", default=0.,
+                    help="probability a block is lost")
+    opts.add_option("-c", "--corrupt", type="float", dest="corrupt",
+                    default=0., help="probability a block is corrupted")
+    opts.add_option("--drop-every", type="int", dest="drop_every",
+                    default=0, help="lose every Nth block")
+    opts.add_option("--drop-ack-every", type="int", dest="drop_ack_every",
+                    default=0, help="lose every Nth ack")
+    opts.add_option("--delay-ack-every", type="int", dest="delay_ack_every",
+                    default=0, help="delay every Nth ack (and the replies"
+                    " after it) by --ack-delay")
+    opts.add_option("--ack-delay", type="float", dest="ack_delay",
+                    default=.100, help="extra delay of a delayed ack")
+    opts.add_option("--latency", type="float", dest="latency", default=0.,
+                    help="delay of every reply from the mcu")
+    opts.add_option("--burst", type="int", dest="burst", default=20,
+                    help="number of commands queued at a time")
+    opts.add_option("--interval", type="float", dest="interval",
+                    default=.001, help="time between bursts of commands")
+    opts.add_option("--timeout", type="float", dest="timeout", default=60.,
+                    help="maximum run time")
+    opts.add_option("-s", "--seed", type="int", dest="seed", default=0,
+                    help="random number generator seed")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+
+    # Setup pty and serialqueue
+    host_fd, mcu_fd = os.openpty()
+    tty.setraw(host_fd)
+    tty.setraw(mcu_fd)
+    ffi_main, ffi_lib = chelper.get_ffi()
+    sq = ffi_lib.serialqueue_alloc(host_fd, 0)
+    ffi_lib.serialqueue_set_baud_adjust(sq, BITS_PER_BYTE / SERIAL_BAUD)
+    ffi_lib.serialqueue_set_clock_est(sq, MCU_FREQ, time.time(), 0)
+    cq = ffi_lib.serialqueue_alloc_commandqueue()
+
+    # Stream commands to the stand-in
+    mcu = LossyMCU(mcu_fd, options)
+    mt = threading.Thread(target=mcu.run, args=(options.count,))
+    starttime = time.time()
+    mt.start()
+    value_format = msgproto.MessageFormat(VALUE_MSGID, VALUE_FORMAT)
+    for i in range(0, options.count, options.burst):
+        for value in range(i, min(i + options.burst, options.count)):
+            cmd = value_format.encode(value)
+            ffi_lib.serialqueue_send(sq, cq, cmd, len(cmd), 0, 0)
+        time.sleep(options.interval)
+    mt.join()
+    runtime = time.time() - starttime
+
+    # Report results
+    stats_buf = ffi_main.new('char[4096]')
+    ffi_lib.serialqueue_get_stats(sq, stats_buf, len(stats_buf))
+    stats = parse_stats(ffi_main.string(stats_buf))
+    ffi_lib.serialqueue_exit(sq)
+    ffi_lib.serialqueue_free(sq)
+    ffi_lib.serialqueue_free_commandqueue(cq)
+    os.close(host_fd)
+    os.close(mcu_fd)
+    print "mcu: %s" % (" ".join(["%s=%d" % (k, v)
+                                 for k, v in sorted(mcu.stats.items())]),)
+    print "host: %s" % (" ".join([
+        "%s=%s" % (k, stats.get(k, '?')) for k in [
+            'bytes_write', 'bytes_retransmit', 'fast_retransmits'
+            , 'timeout_retransmits', 'rto']]),)
+    errors = list(mcu.errors)
+    if mcu.next_value != options.count:
+        errors.append("received %d of %d commands" % (
+            mcu.next_value, options.count))
+    for err in errors[:10]:
+        print "FAIL %s" % (err,)
+    print "Sent %d commands in %.3fs: %d errors" % (
+        options.count, runtime, len(errors))
+    if errors:
+        sys.exit(-1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python2
+# Script to convert a G-Code file to the pre-parsed binary format
+#
+# Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, mmap
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import gcode, gcodebin
+
+MOVE_PARAMS = {'X': 0, 'Y': 1, 'Z': 2, 'E': 3, 'F': 4}
+
+# Parse a line the same way GCodeParser.process_commands() does.
+# Returns None for lines that don't issue a command, a ('G0'/'G1',
+# fields) tuple for moves that take the G0/G1 fast path, or a (None,
+# line) tuple for all other commands.
+def parse_line(line):
+    line = origline = line.strip()
+    cpos = line.find(';')
+    if cpos >= 0:
+        line = line[:cpos]
+    if not line.strip():
+        return None
+    if not gcode.GCodeParser.move_r.match(line):
+        return None, origline
+    fields = [None, None, None, None, None]
+    try:
+        for param in line.split()[1:]:
+            text = param[1:]
+            value = float(text)
+            if value - value != 0:
+                # Leave nan and inf values to the generic G-Code path
+                return None, origline
+            fields[MOVE_PARAMS[param[0]]] = (text, value)
+    except ValueError:
+        return None, origline
+    if fields[4] is not None and fields[4][1] / 60. <= 0.:
+        return None, origline
+    return line[:2], fields
+
+def convert(infile, outfile):
+    outfile.write(gcodebin.HEADER)
+    counts = [0, 0]
+    for line in infile:
+        res = parse_line(line)
+        if res is None:
+            continue
+        cmd, params = res
+        if cmd is None:
+            outfile.write(gcodebin.encode_text(params))
+            counts[1] += 1
+        else:
+            outfile.write(gcodebin.encode_move(cmd == 'G1', params))
+            counts[0] += 1
+    return counts
+
+# Decode the binary file and check it against the G-Code file
+def verify(infile, binfile):
+    data = mmap.mmap(binfile.fileno(), 0, access=mmap.ACCESS_READ)
+    if data[:len(gcodebin.HEADER)] != gcodebin.HEADER:
+        return "Invalid header"
+    pos, records = gcodebin.Decoder().decode(
+        data, len(gcodebin.HEADER), len(data))
+    expected = []
+    for line in infile:
+        res = parse_line(line)
+        if res is None:
+            continue
+        cmd, params = res
+        if cmd is not None:
+            params = [p and p[1] for p in params]
+        expected.append((cmd, params))
+    if len(records) != len(expected):
+        return "Record count mismatch (%d vs %d)" % (
+            len(records), len(expected))
+    for i, (record, exp) in enumerate(zip(records, expected)):
+        if repr(record) != repr(exp):
+            return "Record %d mismatch: %s vs %s" % (i, record, exp)
+    return None
+
+def main():
+    usage = "%prog [options] <gcode file> <output file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-v", "--verify", action="store_true", dest="verify",
+                    help="decode the output and compare it to the input")
+    options, args = opts.parse_args()
+    if len(args) != 2:
+        opts.error("Incorrect number of arguments")
+    infilename, outfilename = args
+
+    infile = open(infilename, 'rb')
+    outfile = open(outfilename, 'wb')
+    moves, others = convert(infile, outfile)
+    infile.close()
+    outfile.close()
+    print "Wrote %d moves and %d other commands (%d bytes to %d bytes)" % (
+        moves, others, os.path.getsize(infilename),
+        os.path.getsize(outfilename))
+    if options.verify:
+        err = verify(open(infilename, 'rb'), open(outfilename, 'rb'))
+        if err is not None:
+            sys.stderr.write("Verify failed: %s\n" % (err,))
+            sys.exit(-1)
+        print "Verify ok"
+
+if __name__ == '__main__':
+    main()
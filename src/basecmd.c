@@ -256,6 +256,12 @@ command_identify(uint32_t *args)
 {
     uint32_t offset = args[0];
     uint8_t count = args[1];
+    if (offset == IDENTIFY_INFO_OFFSET) {
+        // Report the crc32 and size of the identify data
+        sendf("identify_response offset=%u data=%.*s"
+              , offset, sizeof(command_identify_info), command_identify_info);
+        return;
+    }
     uint32_t isize = READP(command_identify_size);
     if (offset >= isize)
         count = 0;
@@ -54,6 +54,8 @@ extern const struct command_parser command_index[];
 extern const uint8_t command_index_size;
 extern const uint8_t command_identify_data[];
 extern const uint32_t command_identify_size;
+extern const uint8_t command_identify_info[8];
+#define IDENTIFY_INFO_OFFSET 0xffffffff // identify offset to request info
 const struct command_encoder *ctr_lookup_encoder(const char *str);
 const struct command_encoder *ctr_lookup_output(const char *str);
 uint8_t ctr_lookup_static_string(const char *str);